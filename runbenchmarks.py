@@ -0,0 +1,240 @@
+"""Micro-benchmarks for django-ucamwebauth hot paths.
+
+Usage: python runbenchmarks.py [benchmark ...]
+
+Runs every benchmark if none is named.
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+import timeit
+from datetime import datetime
+import django
+from django.conf import settings
+
+settings.configure(
+    DEBUG=False,
+    ALLOWED_HOSTS=['testserver'],
+    SECRET_KEY='benchmarks',
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:', }},
+    TIME_ZONE='Europe/London',
+    USE_TZ=True,
+    ROOT_URLCONF='ucamwebauth.urls',
+    INSTALLED_APPS=(
+        'django.contrib.admin',
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django.contrib.messages',
+        'ucamwebauth',
+    ),
+    AUTHENTICATION_BACKENDS=('ucamwebauth.backends.RavenAuthBackend', ),
+    SESSION_ENGINE='django.contrib.sessions.backends.cache',
+    UCAMWEBAUTH_LOGIN_URL='https://demo.raven.cam.ac.uk/auth/authenticate.html',
+    UCAMWEBAUTH_LOGOUT_URL='https://demo.raven.cam.ac.uk/auth/logout.html',
+    UCAMWEBAUTH_CERTS={901: """-----BEGIN CERTIFICATE-----
+MIIDzTCCAzagAwIBAgIBADANBgkqhkiG9w0BAQQFADCBpjELMAkGA1UEBhMCR0Ix
+EDAOBgNVBAgTB0VuZ2xhbmQxEjAQBgNVBAcTCUNhbWJyaWRnZTEgMB4GA1UEChMX
+VW5pdmVyc2l0eSBvZiBDYW1icmlkZ2UxLTArBgNVBAsTJENvbXB1dGluZyBTZXJ2
+aWNlIERFTU8gUmF2ZW4gU2VydmljZTEgMB4GA1UEAxMXUmF2ZW4gREVNTyBwdWJs
+aWMga2V5IDEwHhcNMDUwNzI2MTMyMTIwWhcNMDUwODI1MTMyMTIwWjCBpjELMAkG
+A1UEBhMCR0IxEDAOBgNVBAgTB0VuZ2xhbmQxEjAQBgNVBAcTCUNhbWJyaWRnZTEg
+MB4GA1UEChMXVW5pdmVyc2l0eSBvZiBDYW1icmlkZ2UxLTArBgNVBAsTJENvbXB1
+dGluZyBTZXJ2aWNlIERFTU8gUmF2ZW4gU2VydmljZTEgMB4GA1UEAxMXUmF2ZW4g
+REVNTyBwdWJsaWMga2V5IDEwgZ8wDQYJKoZIhvcNAQEBBQADgY0AMIGJAoGBALhF
+i9tIZvjYQQRfOzP3cy5ujR91ZntQnQehldByHlchHRmXwA1ot/e1WlHPgIjYkFRW
+lSNcSDM5r7BkFu69zM66IHcF80NIopBp+3FYqi5uglEDlpzFrd+vYllzw7lBzUnp
+CrwTxyO5JBaWnFMZrQkSdspXv89VQUO4V4QjXV7/AgMBAAGjggEHMIIBAzAdBgNV
+HQ4EFgQUgjC6WtA4jFf54kxlidhFi8w+0HkwgdMGA1UdIwSByzCByIAUgjC6WtA4
+jFf54kxlidhFi8w+0HmhgaykgakwgaYxCzAJBgNVBAYTAkdCMRAwDgYDVQQIEwdF
+bmdsYW5kMRIwEAYDVQQHEwlDYW1icmlkZ2UxIDAeBgNVBAoTF1VuaXZlcnNpdHkg
+b2YgQ2FtYnJpZGdlMS0wKwYDVQQLEyRDb21wdXRpbmcgU2VydmljZSBERU1PIFJh
+dmVuIFNlcnZpY2UxIDAeBgNVBAMTF1JhdmVuIERFTU8gcHVibGljIGtleSAxggEA
+MAwGA1UdEwQFMAMBAf8wDQYJKoZIhvcNAQEEBQADgYEAsdyB+9szctHHIHE+S2Kg
+LSxbGuFG9yfPFIqaSntlYMxKKB5ba/tIAMzyAOHxdEM5hi1DXRsOok3ElWjOw9oN
+6Psvk/hLUN+YfC1saaUs3oh+OTfD7I4gRTbXPgsd6JgJQ0TQtuGygJdaht9cRBHW
+wOq24EIbX5LquL9w+uvnfXw=
+-----END CERTIFICATE-----
+"""},
+    UCAMWEBAUTH_TIMEOUT=60,
+    TEMPLATES=[
+        {
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+            'OPTIONS': {
+                'context_processors': [
+                    'django.contrib.messages.context_processors.messages',
+                ],
+            },
+        },
+    ]
+)
+django.setup()
+
+from django.test.utils import override_settings  # noqa: E402
+
+
+def report(name, number, seconds):
+    print("%-50s %10.0f ops/s %10.2f us/op" % (name, number / seconds, seconds * 1e6 / number))
+
+
+def bench_error_path(number=20000):
+    """Throughput of DefaultErrorBehaviour.process_exception for a flood of junk WLS responses"""
+    from django.contrib import messages
+    from django.contrib.auth.models import AnonymousUser
+    from django.contrib.messages.storage.fallback import FallbackStorage
+    from django.contrib.sessions.backends.cache import SessionStore
+    from django.http import HttpResponseServerError, HttpResponseForbidden
+    from django.template.loader import get_template
+    from django.test import RequestFactory
+    from ucamwebauth import MalformedResponseError, InvalidResponseError, PublicKeyNotFoundError, \
+        UserNotAuthorised, OtherStatusCode
+    from ucamwebauth.middleware import DefaultErrorBehaviour
+
+    class LegacyErrorBehaviour():
+        """DefaultErrorBehaviour as of django-ucamwebauth 1.4.8, for comparison"""
+        def process_exception(self, request, exception):
+            if exception.__class__ == MalformedResponseError or \
+                    exception.__class__ == InvalidResponseError or \
+                    exception.__class__ == OtherStatusCode or \
+                    exception.__class__ == PublicKeyNotFoundError:
+                template = get_template("ucamwebauth_500.html")
+                messages.error(request, str(exception))
+                return HttpResponseServerError(template.render({}, request))
+            elif exception.__class__ == UserNotAuthorised:
+                template = get_template("ucamwebauth_403.html")
+                messages.error(request, str(exception))
+                return HttpResponseForbidden(template.render({}, request))
+
+    factory = RequestFactory()
+
+    def make_request():
+        request = factory.get('/raven_return/', {'WLS-Response': 'junk'})
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+        request.user = AnonymousUser()
+        return request
+
+    exception = UserNotAuthorised("Authentication successful but you are not authorised to access this site")
+    for name, middleware, anonymous_messages in (("legacy", LegacyErrorBehaviour(), True),
+                                                 ("dispatch table", DefaultErrorBehaviour(), True),
+                                                 ("dispatch table, no anonymous messages",
+                                                  DefaultErrorBehaviour(), False)):
+        with override_settings(UCAMWEBAUTH_ERROR_MESSAGES_FOR_ANONYMOUS=anonymous_messages):
+            requests = [make_request() for _ in range(number)]
+            it = iter(requests)
+            seconds = timeit.timeit(lambda: middleware.process_exception(next(it), exception), number=number)
+        report("error path (%s)" % name, number, seconds)
+
+
+def bench_import_time(number=5):
+    """Import time (python -X importtime, best of number runs) of the package and its parts, in fresh interpreters"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=root)
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+    for module in ('ucamwebauth', 'ucamwebauth.protocol', 'ucamwebauth.gateway', 'ucamwebauth.response'):
+        best = None
+        for _ in range(number):
+            stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], cwd=root,
+                                    env=env, stderr=subprocess.PIPE, check=True).stderr.decode()
+            # "import time: self [us] | cumulative | imported package", nested imports are indented
+            cumulative = 0
+            for line in stderr.splitlines():
+                fields = line.split('|')
+                if line.startswith('import time:') and fields[2].startswith(' ucamwebauth'):
+                    cumulative += int(fields[1])
+            best = cumulative if best is None else min(best, cumulative)
+        print("%-50s %10.2f ms" % ("import %s" % module, best / 1000.0))
+
+
+_setup_lock = threading.Lock()
+
+
+def _scaling_worker(name, seconds, barrier, results):
+    """Runs the RavenResponse or authenticate benchmark for seconds in a thread or process of bench_scaling, once
+    every worker is ready, and puts the number of operations in results"""
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test import RequestFactory
+    from ucamwebauth.backends import RavenAuthBackend
+    from ucamwebauth.response import RavenResponse
+    from ucamwebauth.tests import create_wls_response
+
+    try:
+        with _setup_lock:
+            # Every thread (and process) has its own in-memory database, so that the database is not shared
+            call_command('migrate', verbosity=0)
+        request = RequestFactory().get('/raven_return/', {
+            'WLS-Response': create_wls_response(raven_issue=datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))})
+        if name == 'response':
+            def operation():
+                RavenResponse(request)
+        else:
+            backend = RavenAuthBackend()
+
+            def operation():
+                backend.authenticate(request)
+        # Creates the user and fills the caches
+        operation()
+    except Exception:
+        barrier.abort()
+        results.put(None)
+        raise
+
+    barrier.wait()
+    count = 0
+    stop = time.time() + seconds
+    while time.time() < stop:
+        operation()
+        count += 1
+    connection.close()
+    results.put(count)
+
+
+def bench_scaling(seconds=2):
+    """Throughput of RavenResponse and RavenAuthBackend.authenticate in 1 to os.cpu_count() threads and processes"""
+    import multiprocessing
+    import queue
+    context = multiprocessing.get_context('spawn')
+    cores = os.cpu_count() or 1
+    workers = sorted(set([2 ** i for i in range(cores.bit_length())] + [cores]))
+    for name in ('response', 'authenticate'):
+        for mode in ('threads', 'processes'):
+            single = None
+            for n in workers:
+                if mode == 'threads':
+                    barrier, results = threading.Barrier(n), queue.Queue()
+                    pool = [threading.Thread(target=_scaling_worker, args=(name, seconds, barrier, results))
+                            for _ in range(n)]
+                else:
+                    barrier, results = context.Barrier(n), context.Queue()
+                    pool = [context.Process(target=_scaling_worker, args=(name, seconds, barrier, results))
+                            for _ in range(n)]
+                for worker in pool:
+                    worker.start()
+                counts = [results.get() for _ in range(n)]
+                for worker in pool:
+                    worker.join()
+                if None in counts:
+                    raise RuntimeError("A worker of the %s benchmark failed" % name)
+                total = sum(counts)
+                # Throughput per core, as long as there are no more workers than cores
+                per_worker = total / float(seconds) / n
+                single = single or per_worker
+                print("%-50s %10.0f ops/s %10.0f ops/s/core %5.0f%% scaling" % (
+                    "scaling (%s, %d %s)" % (name, n, mode), total / float(seconds), per_worker,
+                    100 * per_worker / single))
+
+
+BENCHMARKS = {
+    'error_path': bench_error_path,
+    'import_time': bench_import_time,
+    'scaling': bench_scaling,
+}
+
+
+if __name__ == '__main__':
+    for benchmark in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[benchmark]()
@@ -2,14 +2,27 @@ import logging
 from django.core.management import execute_from_command_line
 from django.conf import settings
 
+MIDDLEWARE = (
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+)
+
 settings.configure(
     DEBUG=False,
-    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'test.db', }},
+    SECRET_KEY='ucamwebauth-tests',
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'test.db', },
+               # Only used by the tests of UCAMWEBAUTH_READ_DATABASE
+               'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'test_replica.db', }},
     TIME_ZONE='Europe/London',
     USE_TZ=True,
     SITE_ID=1,
     ROOT_URLCONF='ucamwebauth.urls',
     INSTALLED_APPS=(
+        'django.contrib.admin',
         'django.contrib.auth',
         'django.contrib.contenttypes',
         'django.contrib.sessions',
@@ -19,14 +32,9 @@ settings.configure(
         'ucamwebauth',
     ),
     AUTHENTICATION_BACKENDS=('ucamwebauth.backends.RavenAuthBackend', ),
-    MIDDLEWARE_CLASSES=(
-        'django.contrib.sessions.middleware.SessionMiddleware',
-        'django.middleware.common.CommonMiddleware',
-        'django.middleware.csrf.CsrfViewMiddleware',
-        'django.contrib.auth.middleware.AuthenticationMiddleware',
-        'django.contrib.messages.middleware.MessageMiddleware',
-        'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    ),
+    MIDDLEWARE_CLASSES=MIDDLEWARE,
+    # Django >= 1.10 reads MIDDLEWARE, older versions MIDDLEWARE_CLASSES
+    MIDDLEWARE=MIDDLEWARE,
     UCAMWEBAUTH_LOGIN_URL='https://demo.raven.cam.ac.uk/auth/authenticate.html',
     UCAMWEBAUTH_LOGOUT_URL='https://demo.raven.cam.ac.uk/auth/logout.html',
     UCAMWEBAUTH_CERTS={901: """-----BEGIN CERTIFICATE-----
@@ -0,0 +1,131 @@
+from django.contrib import admin
+from django.contrib.admin.sites import NotRegistered
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import User
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.utils.functional import cached_property
+from ucamwebauth.models import UserProfile
+from ucamwebauth.utils import setting
+
+try:
+    action = admin.action
+except AttributeError:
+    # django < 3.2
+    def action(description):
+        def decorator(function):
+            function.short_description = description
+            return function
+        return decorator
+
+
+class CappedCountPaginator(Paginator):
+    """A paginator that counts at most UCAMWEBAUTH_ADMIN_COUNT_LIMIT (default 10000) objects, so that the change lists
+    of very large tables do not run a full table COUNT(*). When the count reaches the limit, every page can still be
+    requested, and the page after each page that is read is listed as long as there are more objects."""
+
+    def __init__(self, *args, **kwargs):
+        super(CappedCountPaginator, self).__init__(*args, **kwargs)
+        # The highest page number known to exist past the counted ones
+        self.last_page = 0
+
+    @cached_property
+    def count(self):
+        if not hasattr(self.object_list, 'values'):
+            return len(self.object_list)
+        # SELECT COUNT(*) FROM (SELECT ... LIMIT n), which stops scanning after n rows
+        return self.object_list.values('pk')[:self.limit].count()
+
+    @cached_property
+    def limit(self):
+        return setting('UCAMWEBAUTH_ADMIN_COUNT_LIMIT', default=10000)
+
+    @cached_property
+    def capped(self):
+        """Whether the count stopped at the limit, so that there may be more objects"""
+        return hasattr(self.object_list, 'values') and self.count >= self.limit
+
+    @property
+    def num_pages(self):
+        return max(super(CappedCountPaginator, self).num_pages, self.last_page)
+
+    def validate_number(self, number):
+        if not self.capped:
+            return super(CappedCountPaginator, self).validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger("That page number is not an integer")
+        if number < 1:
+            raise EmptyPage("That page number is less than 1")
+        return number
+
+    def page(self, number):
+        if not self.capped:
+            return super(CappedCountPaginator, self).page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        # One more object than the page holds tells whether there is a next page
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not object_list and number > 1:
+            raise EmptyPage("That page contains no results")
+        self.last_page = max(self.last_page, number + 1 if len(object_list) > self.per_page else number)
+        return Page(object_list[:self.per_page], number, self)
+
+
+@action(description="Mark the selected profiles as raven for life")
+def set_raven_for_life(modeladmin, request, queryset):
+    updated = queryset.update(raven_for_life=True)
+    modeladmin.message_user(request, "%d profiles marked as raven for life" % updated)
+
+
+@action(description="Mark the selected profiles as not raven for life")
+def clear_raven_for_life(modeladmin, request, queryset):
+    updated = queryset.update(raven_for_life=False)
+    modeladmin.message_user(request, "%d profiles marked as not raven for life" % updated)
+
+
+@admin.register(UserProfile)
+class UserProfileAdmin(admin.ModelAdmin):
+    list_display = ('user', 'raven_for_life')
+    list_filter = ('raven_for_life', )
+    list_select_related = ('user', )
+    search_fields = ('^user__username', )
+    raw_id_fields = ('user', )
+    readonly_fields = ('attributes_json', )
+    actions = [set_raven_for_life, clear_raven_for_life]
+    paginator = CappedCountPaginator
+    show_full_result_count = False
+
+
+class UserProfileInline(admin.StackedInline):
+    model = UserProfile
+    can_delete = False
+    fields = ('raven_for_life', 'attributes_json')
+    readonly_fields = ('attributes_json', )
+
+
+class RavenUserAdmin(UserAdmin):
+    """The admin of User with the profile inline and the raven_for_life flag in the change list. It replaces the
+    default one if UCAMWEBAUTH_ADMIN_USER_PROFILE is True."""
+    inlines = list(UserAdmin.inlines) + [UserProfileInline]
+    list_display = UserAdmin.list_display + ('raven_for_life', )
+    list_filter = UserAdmin.list_filter + ('profile__raven_for_life', )
+    list_select_related = ('profile', )
+    paginator = CappedCountPaginator
+    show_full_result_count = False
+
+    def raven_for_life(self, user):
+        try:
+            return user.profile.raven_for_life
+        except UserProfile.DoesNotExist:
+            return False
+    raven_for_life.boolean = True
+    raven_for_life.admin_order_field = 'profile__raven_for_life'
+
+
+if setting('UCAMWEBAUTH_ADMIN_USER_PROFILE', default=False):
+    try:
+        admin.site.unregister(User)
+    except NotRegistered:
+        pass
+    admin.site.register(User, RavenUserAdmin)
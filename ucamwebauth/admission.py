@@ -0,0 +1,122 @@
+"""Admission control for raven_return (and for the logins of raven_login through a sibling site, see ucamwebauth.sso).
+
+Checking a WLS response (an RSA signature verification) and provisioning the user (database writes) are the expensive
+part of a login. In a login storm, limiting how many run at once keeps the workers available for the users that are
+already logged in: the logins over the limit are shed straight away with a TooManyLoginsError, which
+DefaultErrorBehaviour turns into a 503 response with a Retry-After header.
+
+UCAMWEBAUTH_MAX_CONCURRENT_LOGINS limits the logins in progress in each process.
+UCAMWEBAUTH_CLUSTER_MAX_CONCURRENT_LOGINS limits them across every process sharing the UCAMWEBAUTH_ADMISSION_CACHE
+cache (default 'default'), which must support atomic incr/decr (e.g. memcached or redis).
+"""
+import logging
+import threading
+from django.core.cache import caches
+from ucamwebauth.exceptions import TooManyLoginsError
+from ucamwebauth.utils import setting
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'ucamwebauth-admission:in-flight'
+
+
+class AdmissionController(object):
+    """Counts the logins in progress in this process (and in the cluster) and sheds the ones over the limits"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Logins in progress in this process
+        self.in_flight = 0
+        # Highest value of in_flight so far
+        self.peak = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def acquire(self):
+        """Admits a login, which must be followed by release(ticket) once the login is done.
+        @return The ticket to pass to release()
+        @exception TooManyLoginsError if the login is shed"""
+        limit = setting('UCAMWEBAUTH_MAX_CONCURRENT_LOGINS')
+        cluster_limit = setting('UCAMWEBAUTH_CLUSTER_MAX_CONCURRENT_LOGINS')
+        with self.lock:
+            if limit is not None and self.in_flight >= limit:
+                self.shed += 1
+                raise self._error()
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+        cluster = False
+        if cluster_limit is not None:
+            try:
+                count = self._cluster_incr()
+                cluster = count is not None
+                over = cluster and count > cluster_limit
+            except Exception:
+                # The limit is a safeguard: logins go on if the cache is down
+                logger.exception("Could not count the logins in progress in the cluster")
+                over = False
+            if over:
+                self.release(cluster)
+                with self.lock:
+                    self.shed += 1
+                raise self._error()
+
+        with self.lock:
+            self.admitted += 1
+        return cluster
+
+    def release(self, ticket):
+        """Ends a login admitted by acquire()"""
+        with self.lock:
+            self.in_flight -= 1
+        if ticket:
+            try:
+                _cache().decr(CACHE_KEY)
+            except Exception:
+                # The counter expired (see _cluster_incr) or the cache is down
+                pass
+
+    def stats(self):
+        """Returns the counters of this process (and the number of logins in progress in the cluster, if limited)"""
+        with self.lock:
+            stats = {'in_flight': self.in_flight, 'peak': self.peak, 'admitted': self.admitted, 'shed': self.shed}
+        if setting('UCAMWEBAUTH_CLUSTER_MAX_CONCURRENT_LOGINS') is not None:
+            try:
+                stats['cluster_in_flight'] = _cluster_count()
+            except Exception:
+                stats['cluster_in_flight'] = None
+        return stats
+
+    @staticmethod
+    def _cluster_incr():
+        cache = _cache()
+        # The counter expires, so that the logins of processes that died while counted are eventually forgotten (at
+        # the cost of miscounting the logins in progress when it does)
+        cache.add(CACHE_KEY, 0, setting('UCAMWEBAUTH_ADMISSION_CACHE_TIMEOUT', default=300))
+        try:
+            return cache.incr(CACHE_KEY)
+        except ValueError:
+            # The counter expired between add() and incr()
+            return None
+
+    @staticmethod
+    def _error():
+        retry_after = setting('UCAMWEBAUTH_RETRY_AFTER', default=5)
+        return TooManyLoginsError("Too many logins are in progress, please try again in %d seconds" % retry_after,
+                                  retry_after=retry_after)
+
+
+def _cache():
+    return caches[setting('UCAMWEBAUTH_ADMISSION_CACHE', default='default')]
+
+
+def _cluster_count():
+    return _cache().get(CACHE_KEY, 0)
+
+
+controller = AdmissionController()
+
+
+def stats():
+    """Returns the admission counters of this process, see AdmissionController.stats"""
+    return controller.stats()
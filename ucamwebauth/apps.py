@@ -0,0 +1,18 @@
+from django.apps import AppConfig
+
+
+class UcamWebauthConfig(AppConfig):
+    name = 'ucamwebauth'
+    verbose_name = 'Raven authentication'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.signals import user_logged_in, user_logged_out
+        from django.db.models.signals import post_save
+        from ucamwebauth import principals, replica, sessions
+        from ucamwebauth.models import UserProfile
+        user_logged_in.connect(sessions.record_login, dispatch_uid='ucamwebauth.sessions.record_login')
+        user_logged_in.connect(principals.record_login, dispatch_uid='ucamwebauth.principals.record_login')
+        user_logged_out.connect(sessions.record_logout, dispatch_uid='ucamwebauth.sessions.record_logout')
+        post_save.connect(replica.user_saved, sender=get_user_model(), dispatch_uid='ucamwebauth.replica.user_saved')
+        post_save.connect(replica.profile_saved, sender=UserProfile, dispatch_uid='ucamwebauth.replica.profile_saved')
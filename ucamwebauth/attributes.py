@@ -0,0 +1,190 @@
+"""Directory attributes of the users, fetched at login.
+
+UCAMWEBAUTH_ATTRIBUTE_PROVIDERS is a list of dotted paths to callables that take a principal and return a dict of
+attributes (e.g. display name, institution, groups). At login, RavenAuthBackend calls them all concurrently, waits at
+most UCAMWEBAUTH_ATTRIBUTE_TIMEOUT seconds for them, merges the results (later providers win) and stores them in
+UserProfile.attributes. Providers that fail or do not answer in time are left out, and such an incomplete result
+does not replace the attributes already stored in the profile. A provider that hangs keeps its
+worker, so at most UCAMWEBAUTH_ATTRIBUTE_MAX_IN_FLIGHT calls of each provider run at a time: further calls are skipped
+as if they had timed out, and a hung provider cannot take over the whole pool.
+
+The attributes of each principal are cached in the UCAMWEBAUTH_ATTRIBUTE_CACHE cache. They are fresh for
+UCAMWEBAUTH_ATTRIBUTE_TTL seconds; for UCAMWEBAUTH_ATTRIBUTE_STALE_TTL seconds after that, logins use the stale
+attributes and refresh them in the background, so that they are never blocked on a slow directory. A background
+refresh that is incomplete keeps the stale attributes, which are retried at the next login.
+
+The providers are called by daemon threads (UCAMWEBAUTH_ATTRIBUTE_WORKERS of them), and so are the background refreshes:
+the process never waits for them to exit, and a call still running when it does is abandoned.
+"""
+import logging
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from ucamwebauth.utils import setting
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = 'ucamwebauth-attributes:'
+
+# Provider calls waiting for a worker, and the worker threads
+_calls = queue.Queue()
+_workers = []
+_lock = threading.Lock()
+# Principals whose attributes are being refreshed in the background
+_refreshing = set()
+# Provider -> number of its calls submitted and not finished yet
+_in_flight = {}
+
+
+def get_providers():
+    return [import_string(provider) for provider in setting('UCAMWEBAUTH_ATTRIBUTE_PROVIDERS', default=())]
+
+
+def enabled():
+    return bool(setting('UCAMWEBAUTH_ATTRIBUTE_PROVIDERS'))
+
+
+def _cache():
+    return caches[setting('UCAMWEBAUTH_ATTRIBUTE_CACHE', default='default')]
+
+
+class Call(object):
+    """A call of a provider, run by a worker thread"""
+
+    def __init__(self, provider, principal):
+        self.provider = provider
+        self.principal = principal
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.provider(self.principal)
+        except Exception as e:
+            self.exception = e
+        finally:
+            with _lock:
+                _in_flight[self.provider] -= 1
+            self.done.set()
+
+
+def _work():
+    while True:
+        _calls.get().run()
+
+
+def _start_workers():
+    # Unlike those of concurrent.futures, these threads are not joined at exit, so a hung provider cannot block it
+    with _lock:
+        while len(_workers) < setting('UCAMWEBAUTH_ATTRIBUTE_WORKERS', default=8):
+            worker = threading.Thread(target=_work, name='ucamwebauth-attributes-%d' % len(_workers))
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+
+
+def _submit(provider, principal):
+    """Submits a call of provider, unless it already has UCAMWEBAUTH_ATTRIBUTE_MAX_IN_FLIGHT calls running.
+    @return The Call, or None"""
+    with _lock:
+        if _in_flight.get(provider, 0) >= setting('UCAMWEBAUTH_ATTRIBUTE_MAX_IN_FLIGHT', default=2):
+            return None
+        _in_flight[provider] = _in_flight.get(provider, 0) + 1
+    if not _workers:
+        _start_workers()
+    call = Call(provider, principal)
+    _calls.put(call)
+    return call
+
+
+def fetch(principal, providers=None):
+    """Calls every provider concurrently for principal.
+    @return (merged attributes, whether every provider answered in time)"""
+    if providers is None:
+        providers = get_providers()
+    calls = [_submit(provider, principal) for provider in providers]
+    deadline = time.time() + setting('UCAMWEBAUTH_ATTRIBUTE_TIMEOUT', default=2)
+    for call in calls:
+        if call is not None:
+            call.done.wait(max(deadline - time.time(), 0))
+    attributes = {}
+    complete = True
+    for provider, call in zip(providers, calls):
+        if call is None:
+            logger.warning("Attribute provider %s skipped for %s: too many calls still running", provider, principal)
+            complete = False
+        elif not call.done.is_set():
+            # The provider keeps its worker until it returns, but the login does not wait for it
+            logger.warning("Attribute provider %s timed out for %s", provider, principal)
+            complete = False
+        elif call.exception is not None:
+            logger.error("Attribute provider %s failed for %s: %s", provider, principal, call.exception)
+            complete = False
+        else:
+            attributes.update(call.result or {})
+    return attributes, complete
+
+
+def _store(principal, attributes, complete):
+    ttl = setting('UCAMWEBAUTH_ATTRIBUTE_TTL', default=3600)
+    # Incomplete results are stored as already stale, so that the next login retries in the background
+    fetched = time.time() if complete else time.time() - ttl
+    _cache().set(CACHE_PREFIX + principal, {'attributes': attributes, 'fetched': fetched, 'complete': complete},
+                 ttl + setting('UCAMWEBAUTH_ATTRIBUTE_STALE_TTL', default=86400))
+
+
+def refresh(principal, keep_stale=False):
+    """Fetches the attributes of principal and caches them.
+    @param keep_stale  Whether to leave the cached attributes alone if some provider fails or times out
+    @return The attributes fetched"""
+    attributes, complete = fetch(principal)
+    if complete or not keep_stale:
+        _store(principal, attributes, complete)
+    else:
+        logger.warning("Incomplete refresh of the attributes of %s, the stale ones are kept", principal)
+    return attributes
+
+
+def _refresh_in_background(principal):
+    with _lock:
+        if principal in _refreshing:
+            return
+        _refreshing.add(principal)
+
+    def run():
+        try:
+            refresh(principal, keep_stale=True)
+        except Exception:
+            logger.exception("Could not refresh the attributes of %s", principal)
+        finally:
+            with _lock:
+                _refreshing.discard(principal)
+
+    thread = threading.Thread(target=run, name='ucamwebauth-attributes-refresh')
+    thread.daemon = True
+    thread.start()
+
+
+def lookup(principal):
+    """Looks up the attributes of principal: from the cache if they are fresh, from the cache (refreshing them in the
+    background) if they are stale, and from the providers otherwise.
+    @return (attributes, whether every provider answered when they were fetched)"""
+    entry = _cache().get(CACHE_PREFIX + principal)
+    if entry is None:
+        attributes, complete = fetch(principal)
+        _store(principal, attributes, complete)
+        return attributes, complete
+    if entry['fetched'] + setting('UCAMWEBAUTH_ATTRIBUTE_TTL', default=3600) <= time.time():
+        _refresh_in_background(principal)
+    return entry['attributes'], entry.get('complete', True)
+
+
+def get_attributes(principal):
+    """Returns the attributes of principal, see lookup"""
+    return lookup(principal)[0]
@@ -0,0 +1,272 @@
+"""Structured audit events for Raven authentications.
+
+Every authentication attempt handled by RavenAuthBackend is reported to the 'ucamwebauth.audit' logger as a record
+with an ``auth_event`` attribute holding a dict with the event type ('success' or 'failure'), the failure class, the
+principal, the kid, the age of the WLS response and the client IP. Failures with an exception are also logged, as
+before, to the 'ucamwebauth.backends' logger, whatever the level, sampling and rate caps of the audit logger.
+
+Unless UCAMWEBAUTH_AUDIT_ASYNC is False, the records are handed to the loggers by a background thread through a
+bounded queue (UCAMWEBAUTH_AUDIT_QUEUE_SIZE), so that the login never waits for the log handlers. Records that do not
+fit in the queue are dropped and counted in `dropped`.
+
+Events can be sampled and rate capped per event type (or per failure class) with the UCAMWEBAUTH_AUDIT_SAMPLE_RATES
+and UCAMWEBAUTH_AUDIT_RATE_LIMITS settings. AsyncAuditHandler also moves the I/O of a handler out of the calling
+thread, for records of other loggers.
+"""
+import atexit
+import importlib
+import logging
+import random
+import threading
+import time
+import weakref
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    QueueHandler = QueueListener = None
+from ucamwebauth.utils import setting
+
+logger = logging.getLogger(__name__)
+# The logger of the failures before there was an audit log, which existing LOGGING configurations may rely on
+legacy_logger = logging.getLogger('ucamwebauth.backends')
+
+SUCCESS = 'success'
+FAILURE = 'failure'
+
+
+class RateLimiter(object):
+    """A token bucket that admits at most `rate` events per second, with bursts of up to `rate` events"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def admit(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+# Number of events discarded by sampling or rate caps, per key, and by a full queue ('queue')
+dropped = {}
+_dropped_lock = threading.Lock()
+
+
+def _drop(key):
+    with _dropped_lock:
+        dropped[key] = dropped.get(key, 0) + 1
+
+
+def _lookup(config, event, failure):
+    """Settings can be given per failure class name, falling back to the event type"""
+    if failure is not None and failure in config:
+        return failure, config[failure]
+    return event, config.get(event)
+
+
+def _admit(event, failure):
+    key, rate = _lookup(setting('UCAMWEBAUTH_AUDIT_SAMPLE_RATES', default={}), event, failure)
+    if rate is not None and random.random() >= rate:
+        _drop(key)
+        return False
+
+    key, limit = _lookup(setting('UCAMWEBAUTH_AUDIT_RATE_LIMITS', default={}), event, failure)
+    if limit is not None:
+        limiter = _rate_limiters.get(key)
+        if limiter is None or limiter.rate != limit:
+            with _rate_limiters_lock:
+                limiter = _rate_limiters[key] = RateLimiter(limit)
+        if not limiter.admit():
+            _drop(key)
+            return False
+    return True
+
+
+def auth_event(event, request=None, response=None, exception=None, failure=None, principal=None):
+    """Reports an authentication event to the audit log.
+    @param event  SUCCESS or FAILURE
+    @param request  The HttpRequest that carried the WLS response
+    @param response  The RavenResponse, if the WLS response could be parsed
+    @param exception  The exception that caused the failure, if any
+    @param failure  A name for the failure, defaults to the class name of exception
+    @param principal  The authenticated identity, defaults to the principal of response
+    """
+    if failure is None and exception is not None:
+        failure = type(exception).__name__
+    records = []
+
+    # The legacy record does not depend on the level, sampling or rate caps of the audit logger
+    if event == FAILURE and exception is not None and legacy_logger.isEnabledFor(logging.ERROR):
+        records.append(legacy_logger.makeRecord(legacy_logger.name, logging.ERROR, __file__, 0, "%s: %s",
+                                                (failure, str(exception)), None))
+
+    level = logging.INFO if event == SUCCESS else logging.ERROR
+    if logger.isEnabledFor(level) and _admit(event, failure):
+        records.append(_audit_record(event, level, request, response, exception, failure, principal))
+
+    for record in records:
+        if setting('UCAMWEBAUTH_AUDIT_ASYNC', default=True):
+            _dispatcher.put(record)
+        else:
+            _emit(record)
+
+
+def _audit_record(event, level, request, response, exception, failure, principal):
+    data = {
+        'event': event,
+        'failure': failure,
+        'error': None if exception is None else str(exception),
+        'principal': principal,
+        'kid': None,
+        'age': None,
+        'ip': None,
+    }
+    if response is not None:
+        if principal is None:
+            data['principal'] = response.principal
+        data['kid'] = response.kid
+        if response.issue is not None:
+            data['age'] = time.time() - response.issue
+    if request is not None:
+        data['ip'] = request.META.get('REMOTE_ADDR')
+
+    # The message is only formatted by the handlers, which may well happen outside the request thread
+    if event == SUCCESS:
+        return logger.makeRecord(logger.name, level, __file__, 0, "Raven authentication success for %s",
+                                 (data['principal'], ), None, extra={'auth_event': data})
+    return logger.makeRecord(logger.name, level, __file__, 0, "Raven authentication failure for %s: %s: %s",
+                             (data['principal'], failure, data['error']), None, extra={'auth_event': data})
+
+
+def _emit(record):
+    logging.getLogger(record.name).handle(record)
+
+
+class Dispatcher(object):
+    """Hands audit records to the loggers from a background thread"""
+
+    def __init__(self):
+        self.queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, record):
+        """Queues record for the background thread, or drops it if the queue is full"""
+        if self.thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _drop('queue')
+
+    def flush(self):
+        """Waits until every queued record has been handled"""
+        if self.queue is not None:
+            self.queue.join()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.queue = queue.Queue(setting('UCAMWEBAUTH_AUDIT_QUEUE_SIZE', default=10000))
+            thread = threading.Thread(target=self._run, name='ucamwebauth-audit')
+            thread.daemon = True
+            thread.start()
+            self.thread = thread
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                _emit(record)
+            except Exception:
+                # Handler errors are reported by the handlers themselves (handleError); nothing must kill the thread
+                pass
+            finally:
+                self.queue.task_done()
+
+
+_dispatcher = Dispatcher()
+
+
+def flush():
+    """Waits until the audit records queued so far have been handed to the loggers"""
+    _dispatcher.flush()
+
+
+# The AsyncAuditHandler instances that are still open, closed at exit
+_handlers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_handlers():
+    for handler in list(_handlers):
+        handler.close()
+
+
+if QueueHandler is not None:
+    class AsyncAuditHandler(QueueHandler):
+        """A logging handler that hands records over to a bounded queue which is drained by a background thread
+        that writes them to the target handler. The request thread never blocks: if the queue is full, the record is
+        dropped and counted in `dropped`.
+
+        It can be used from the LOGGING setting:
+
+            'audit': {
+                'class': 'ucamwebauth.audit.AsyncAuditHandler',
+                'target': {'class': 'logging.FileHandler', 'filename': '/var/log/raven-audit.log'},
+                'maxsize': 10000,
+            }
+        """
+
+        def __init__(self, target=None, maxsize=10000, fmt=None):
+            QueueHandler.__init__(self, queue.Queue(maxsize))
+            if target is None:
+                target = logging.StreamHandler()
+            elif isinstance(target, dict):
+                target = dict(target)
+                module_name, class_name = target.pop('class').rsplit('.', 1)
+                target = getattr(importlib.import_module(module_name), class_name)(**target)
+            if fmt is not None:
+                target.setFormatter(logging.Formatter(fmt))
+            self.target = target
+            self.dropped = 0
+            self.dropped_lock = threading.Lock()
+            self.listener = QueueListener(self.queue, target, respect_handler_level=True)
+            self.listener.start()
+            _handlers.add(self)
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                with self.dropped_lock:
+                    self.dropped += 1
+
+        def prepare(self, record):
+            # Formatting is left to the target handler, in the listener thread.
+            return record
+
+        def close(self):
+            if self.listener is not None:
+                # Flushes the records left in the queue
+                self.listener.stop()
+                self.listener = None
+                self.target.close()
+            _handlers.discard(self)
+            QueueHandler.close(self)
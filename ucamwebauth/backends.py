@@ -1,13 +1,15 @@
 import django
-import logging
+from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import RemoteUserBackend
-from ucamwebauth import RavenResponse
+from django.db import router
+from ucamwebauth import RavenResponse, attributes, audit, principals, profiles
 from ucamwebauth.exceptions import UserNotAuthorised, OtherStatusCode
-from ucamwebauth.models import UserProfile
+from ucamwebauth.models import UserProfile, encode_attributes
+from ucamwebauth.principals import RavenUser
+from ucamwebauth.profiling import profiled
+from ucamwebauth.replica import is_pinned
 from ucamwebauth.utils import setting
 
-logger = logging.getLogger(__name__)
-
 
 # We inherit the automatic-user-creation code from RemoteUserBackend.
 class RavenAuthBackend(RemoteUserBackend):
@@ -15,44 +17,146 @@ class RavenAuthBackend(RemoteUserBackend):
     'ucamwebauth.backends.RavenAuthBackend' to AUTHENTICATION_BACKENDS
     in your django settings.py."""
 
-    def authenticate(self, request=None, remote_user=None):
+    def authenticate(self, request=None, remote_user=None, raven_ticket=None):
         """Checks a response from the Raven server and sees if it is valid.  If
         it is, returns the User with the same username as the Raven username.
+        @param raven_ticket  An identity recorded by a sibling site (see ucamwebauth.sso), used instead of the
+        response from the Raven server
         @return User object, or None if authentication failed"""
+        # django.contrib.auth.authenticate matches the credentials against the signature of this method, so the
+        # profiling wrapper goes around the body instead
+        return self._authenticate(request, raven_ticket)
+
+    @profiled('authenticate')
+    def _authenticate(self, request, raven_ticket):
+        if raven_ticket is not None:
+            return self._authenticate_principal(request, raven_ticket['principal'], raven_ticket['ver'],
+                                                raven_ticket['ptags'])
 
         # Check that everything is correct, and return
         try:
             response = RavenResponse(request)
         except Exception as e:
-            logger.error("%s: %s" % (type(e).__name__, e))
+            audit.auth_event(audit.FAILURE, request, exception=e)
             raise
 
+        if request is not None:
+            # Lets the views use the verified response (e.g. the ptags) after authentication
+            request.raven_response = response
+
         if not response.validate():
-            raise OtherStatusCode("The WLS returned status %d: %s" %
-                                  (response.status, response.STATUS[response.status]))
+            e = OtherStatusCode("The WLS returned status %d: %s" % (response.status, response.STATUS[response.status]))
+            audit.auth_event(audit.FAILURE, request, response, exception=e)
+            raise e
 
-        if (response.ver == 3) and (setting('UCAMWEBAUTH_NOT_CURRENT', default=False) is False) and \
-                ('current' not in response.ptags):
-            logger.error("%s: %s" % ("UserNotAuthorised", "Authentication successful but you are not authorised to "
-                                                          "access this site"))
-            raise UserNotAuthorised("Authentication successful but you are not authorised to access this site")
+        return self._authenticate_principal(request, response.principal, response.ver, response.ptags, response)
 
-        if django.VERSION[0] <= 1 and django.VERSION[1] <= 10:
-            user = super(RavenAuthBackend, self).authenticate(response.principal)
+    @staticmethod
+    def _check_current(request, principal, ver, ptags, response):
+        """@exception UserNotAuthorised if the principal is not current and UCAMWEBAUTH_NOT_CURRENT is not set"""
+        if (ver == 3) and (setting('UCAMWEBAUTH_NOT_CURRENT', default=False) is False) and ('current' not in ptags):
+            e = UserNotAuthorised("Authentication successful but you are not authorised to access this site")
+            audit.auth_event(audit.FAILURE, request, response, exception=e, principal=principal)
+            raise e
+
+    def _authenticate_principal(self, request, principal, ver, ptags, response=None):
+        """Returns the User for a principal authenticated by Raven, creating it if allowed, or None"""
+        self._check_current(request, principal, ver, ptags, response)
+
+        # Existing users are looked up on the replica (if any). The primary is used for users that are not there
+        # (yet) or were written recently, and then for the profile too, so that reads after a write are consistent.
+        replica = setting('UCAMWEBAUTH_READ_DATABASE')
+        if replica:
+            user = self._get_from_replica(replica, **{get_user_model().USERNAME_FIELD: self.clean_username(principal)})
+            if user is not None and is_pinned(user.pk):
+                user = None
         else:
-            user = super(RavenAuthBackend, self).authenticate(request, response.principal)
+            user = None
+        if user is None:
+            replica = None
+            if django.VERSION[0] <= 1 and django.VERSION[1] <= 10:
+                user = super(RavenAuthBackend, self).authenticate(principal)
+            else:
+                user = super(RavenAuthBackend, self).authenticate(request, principal)
+        elif not self.user_can_authenticate(user):
+            user = None
 
-        # creates (if necessary) the UserProfile model and update the raven_for_life property from the RavenResponse
         if user:
-            profile = UserProfile.objects.get_or_create(user=user)[0]
-            raven_for_life = 'current' not in response.ptags
-            if profile.raven_for_life != raven_for_life:
-                profile.raven_for_life = raven_for_life
-                profile.save()
+            audit.auth_event(audit.SUCCESS, request, response, principal=principal)
+        else:
+            audit.auth_event(audit.FAILURE, request, response, failure='UnknownUser', principal=principal)
+
+        # creates (if necessary) the UserProfile model and update the raven_for_life property from the RavenResponse
+        # (and the directory attributes, see ucamwebauth.attributes)
+        if user and ptags is not None:
+            fields = {'raven_for_life': 'current' not in ptags}
+            if attributes.enabled():
+                user_attributes, complete = attributes.lookup(principal)
+                # Attributes missing a provider that failed or timed out must not replace the stored ones
+                if complete:
+                    fields['attributes_json'] = encode_attributes(user_attributes)
+            if setting('UCAMWEBAUTH_DEFER_PROFILE_UPDATES', default=False):
+                profiles.defer_update(user, **fields)
+            else:
+                profile = UserProfile.objects.using(replica).filter(user_id=user.pk).first() if replica else None
+                if profile is None:
+                    profile = UserProfile.objects.get_or_create(user=user, defaults=fields)[0]
+                changed = [name for name, value in fields.items() if getattr(profile, name) != value]
+                if changed:
+                    for name in changed:
+                        setattr(profile, name, fields[name])
+                    profile.save(using=router.db_for_write(UserProfile), update_fields=changed)
+
+        timer = getattr(request, 'ucamwebauth_timing', None)
+        if timer is not None:
+            timer.mark('provision')
 
         return user
 
+    def get_user(self, user_id):
+        replica = setting('UCAMWEBAUTH_READ_DATABASE')
+        if replica and not is_pinned(user_id):
+            user = self._get_from_replica(replica, pk=user_id)
+            if user is not None:
+                return user if self.user_can_authenticate(user) else None
+        # Without a replica, or if the user has not reached it yet or was written recently
+        return super(RavenAuthBackend, self).get_user(user_id)
+
+    @staticmethod
+    def _get_from_replica(replica, **lookup):
+        """Returns the user matching lookup in the replica database, or None"""
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.db_manager(replica).get(**lookup)
+        except UserModel.DoesNotExist:
+            return None
+        # Later saves of the user (e.g. of last_login) must go to the primary
+        user._state.db = router.db_for_write(UserModel)
+        return user
+
     # Backwards compatibility: honour UCAMWEBAUTH_CREATE_USER.
     @property
     def create_unknown_user(self):
         return setting('UCAMWEBAUTH_CREATE_USER', default=True)
+
+
+class RavenPrincipalBackend(RavenAuthBackend):
+    """An authentication backend that returns a RavenUser (see ucamwebauth.principals) instead of a User, for sites
+    that only need the principal and the ptags of their users. No User or UserProfile is read or written. To use,
+    set AUTHENTICATION_BACKENDS to ['ucamwebauth.backends.RavenPrincipalBackend'] in your django settings.py."""
+
+    def _authenticate_principal(self, request, principal, ver, ptags, response=None):
+        """Returns a RavenUser for a principal authenticated by Raven"""
+        self._check_current(request, principal, ver, ptags, response)
+        user = RavenUser(principal, ptags)
+        audit.auth_event(audit.SUCCESS, request, response, principal=principal)
+
+        timer = getattr(request, 'ucamwebauth_timing', None)
+        if timer is not None:
+            timer.mark('provision')
+
+        return user
+
+    def get_user(self, user_id):
+        # The identity is in the session (see ucamwebauth.principals)
+        return principals.get_user(user_id)
@@ -21,3 +21,16 @@ class UserNotAuthorised(Exception):
 class OtherStatusCode(Exception):
     """Raised if the status code is not 200"""
     pass
+
+
+class InvalidTokenError(Exception):
+    """Raised if an identity token is malformed, has a bad signature or has expired"""
+    pass
+
+
+class TooManyLoginsError(Exception):
+    """Raised if a login is shed because too many are already in progress (see ucamwebauth.admission)"""
+
+    def __init__(self, message, retry_after=None):
+        super(TooManyLoginsError, self).__init__(message)
+        self.retry_after = retry_after
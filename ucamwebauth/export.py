@@ -0,0 +1,82 @@
+"""Streaming export of the users and their raven_for_life flag, shared by the export_raven_users management command and
+the raven_export view.
+
+The rows are read with one query (the profile is LEFT OUTER JOINed through values_list) and fetched in chunks, so
+memory use does not grow with the number of users.
+"""
+import csv
+import json
+from datetime import datetime, time
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+FIELDS = ('username', 'raven_for_life', 'last_login')
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson; charset=utf-8'}
+
+
+def parse_when(value):
+    """Parses a date (midnight) or date and time given as a filter.
+    @exception ValueError if value is neither"""
+    when = parse_datetime(value)
+    if when is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError("%r is not a date or a date and time" % value)
+        when = datetime.combine(day, time())
+    if settings.USE_TZ and timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+
+def get_rows(raven_for_life=None, last_login_after=None, last_login_before=None, chunk_size=2000):
+    """Yields a (username, raven_for_life, last_login) tuple per user, in primary key order.
+    @param raven_for_life  Only the users with (True) or without (False) the raven_for_life flag, or all of them (None)
+    @param last_login_after  Only the users that last logged in at or after this datetime
+    @param last_login_before  Only the users that last logged in before this datetime"""
+    users = User.objects.order_by('pk')
+    if raven_for_life:
+        users = users.filter(profile__raven_for_life=True)
+    elif raven_for_life is not None:
+        # Users without a profile are not raven for life
+        users = users.filter(Q(profile__raven_for_life=False) | Q(profile__isnull=True))
+    if last_login_after is not None:
+        users = users.filter(last_login__gte=last_login_after)
+    if last_login_before is not None:
+        users = users.filter(last_login__lt=last_login_before)
+    rows = users.values_list('username', 'profile__raven_for_life', 'last_login')
+    rows = rows.iterator(chunk_size=chunk_size) if django.VERSION[0] >= 2 else rows.iterator()
+    for username, flag, last_login in rows:
+        yield username, bool(flag), last_login
+
+
+class _Echo(object):
+    """The file-like object csv.writer writes the lines to, so that each line is returned instead of buffered"""
+
+    def write(self, value):
+        return value
+
+
+def format_csv(rows):
+    """Yields the CSV lines (with a header) of rows"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for username, raven_for_life, last_login in rows:
+        yield writer.writerow((username, raven_for_life, last_login.isoformat() if last_login else ''))
+
+
+def format_jsonl(rows):
+    """Yields one JSON object per line of rows"""
+    for username, raven_for_life, last_login in rows:
+        yield json.dumps({'username': username, 'raven_for_life': raven_for_life,
+                          'last_login': last_login.isoformat() if last_login else None}) + '\n'
+
+
+def export(output_format, **filters):
+    """Yields the lines of the export of the users matching filters (see get_rows) in output_format"""
+    rows = get_rows(**filters)
+    return format_csv(rows) if output_format == 'csv' else format_jsonl(rows)
@@ -0,0 +1,205 @@
+"""Raven authentication for bare WSGI and ASGI applications, without Django.
+
+RavenWSGIMiddleware and RavenASGIMiddleware require a Raven login for every request to the application they wrap.
+They redirect unauthenticated users to the WLS, check the WLS response when the user comes back to `return_path`, and
+then keep the identity of the user in a cookie signed with `secret_key` (see ucamwebauth.tokens), so that later
+requests only cost an HMAC check. The identity is passed on to the application as the 'ucamwebauth.identity' entry
+of the WSGI environ or ASGI scope, and as REMOTE_USER in the WSGI environ.
+
+Either `return_url` or `allowed_hosts` must be given: a WLS response is only accepted for the URL of this
+application, never for one built from an unchecked Host header, which would let any other Raven site replay the
+responses of its users here.
+"""
+try:
+    from urlparse import parse_qs
+    from Cookie import SimpleCookie, CookieError
+except ImportError:
+    from urllib.parse import parse_qs
+    from http.cookies import SimpleCookie, CookieError
+from ucamwebauth.exceptions import UserNotAuthorised, OtherStatusCode, InvalidTokenError
+from ucamwebauth.protocol import WLSResponse, StaticKeyStore, build_login_url
+from ucamwebauth.tokens import TokenSigner
+
+IDENTITY_KEY = 'ucamwebauth.identity'
+
+REASONS = {303: 'See Other', 400: 'Bad Request', 403: 'Forbidden', 500: 'Internal Server Error'}
+
+
+class RavenGateway(object):
+    """The part of the middlewares that does not depend on the server interface. It decides, for a request described
+    by its URL and cookies, whether the request goes through to the application or is answered with a redirect or
+    an error."""
+
+    def __init__(self, login_url, certs, secret_key, return_path='/raven_return/', return_url=None,
+                 allowed_hosts=None, cookie_name='ucamwebauth_identity', cookie_ttl=3600, timeout=30, desc='',
+                 iact='', msg='', not_current=False, keys=None):
+        """@param login_url  The URL of the WLS (see UCAMWEBAUTH_LOGIN_URL)
+        @param certs  The certificates of the WLS (see UCAMWEBAUTH_CERTS), unless keys is given
+        @param secret_key  The key used to sign the identity cookie
+        @param return_path  The path (below the application root) the WLS sends the users back to
+        @param return_url  The absolute URL of return_path
+        @param allowed_hosts  The host names (with an optional port) the application is served under, if return_url
+        is not given: return_url is then built from the Host header of the request, once it is found in this list
+        @param cookie_ttl  The lifetime in seconds of the identity cookie
+        @param not_current  Whether users that are not current members of the University are let in (see
+        UCAMWEBAUTH_NOT_CURRENT)
+        @param keys  An object whose get(kid) method returns the certificate of the WLS with id kid (see
+        ucamwebauth.protocol.StaticKeyStore)
+        @exception ValueError if neither return_url nor allowed_hosts is given"""
+        if return_url is None and not allowed_hosts:
+            raise ValueError("RavenGateway needs return_url or allowed_hosts")
+        self.login_url = login_url
+        self.keys = keys if keys is not None else StaticKeyStore(certs)
+        self.signer = TokenSigner(secret_key, ttl=cookie_ttl)
+        self.return_path = return_path
+        self.return_url = return_url
+        self.allowed_hosts = frozenset(host.lower() for host in allowed_hosts or ())
+        self.cookie_name = cookie_name
+        self.timeout = timeout
+        self.desc = desc
+        self.iact = iact
+        self.msg = msg
+        self.not_current = not_current
+
+    def handle(self, scheme, host, root_path, path, query_string, cookie_header):
+        """@return (identity, None) if the request can go through to the application, or (None, (status, headers,
+        body)) with the response to send otherwise"""
+        if path == self.return_path:
+            return None, self._return(scheme, host, root_path, query_string)
+
+        identity = self._identity(cookie_header)
+        if identity is not None:
+            return identity, None
+
+        return_url = self._return_url(scheme, host, root_path)
+        if return_url is None:
+            return None, self._error(400, "host not allowed")
+        next_url = root_path + path
+        if query_string:
+            next_url += '?' + query_string
+        location = build_login_url(self.login_url, return_url, self.desc, self.iact, self.msg,
+                                   params=[('next', next_url)])
+        return None, (303, [('Location', location)], b'')
+
+    def _return_url(self, scheme, host, root_path):
+        """@return The URL the WLS responses must be issued for, or None if host is not allowed"""
+        if self.return_url is not None:
+            return self.return_url
+        host = host.lower()
+        # The port is optional in allowed_hosts
+        if host not in self.allowed_hosts and host.rsplit(':', 1)[0] not in self.allowed_hosts:
+            return None
+        return '%s://%s%s%s' % (scheme, host, root_path, self.return_path)
+
+    def _identity(self, cookie_header):
+        if not cookie_header:
+            return None
+        try:
+            cookie = SimpleCookie(cookie_header).get(self.cookie_name)
+        except CookieError:
+            return None
+        if cookie is None:
+            return None
+        try:
+            return self.signer.verify(cookie.value)
+        except InvalidTokenError:
+            return None
+
+    def _return(self, scheme, host, root_path, query_string):
+        try:
+            response_str = parse_qs(query_string)['WLS-Response'][0]
+        except KeyError:
+            return self._error(500, "no WLS-Response")
+        return_url = self._return_url(scheme, host, root_path)
+        if return_url is None:
+            return self._error(400, "host not allowed")
+        try:
+            response = WLSResponse(response_str, return_url, self.keys, timeout=self.timeout, iact=self.iact)
+            if not response.validate():
+                raise OtherStatusCode("The WLS returned status %d: %s" %
+                                      (response.status, response.STATUS[response.status]))
+            if response.ver == 3 and not self.not_current and 'current' not in response.ptags:
+                raise UserNotAuthorised("Authentication successful but you are not authorised to access this site")
+        except UserNotAuthorised as e:
+            return self._error(403, str(e))
+        except Exception as e:
+            return self._error(500, str(e))
+
+        # Only redirect within the application
+        next_url = response.params.get('next', [''])[0]
+        if not next_url.startswith('/') or next_url.startswith('//'):
+            next_url = root_path + '/'
+
+        cookie = '%s=%s; Max-Age=%d; Path=%s; HttpOnly; SameSite=Lax' % (
+            self.cookie_name, self.signer.sign(response.principal, response.ptags, response.issue), self.signer.ttl,
+            root_path or '/')
+        if scheme == 'https':
+            cookie += '; Secure'
+        return 303, [('Location', next_url), ('Set-Cookie', cookie)], b''
+
+    @staticmethod
+    def _error(status, message):
+        return status, [('Content-Type', 'text/plain; charset=utf-8')], message.encode('utf-8')
+
+
+class RavenWSGIMiddleware(object):
+    """Requires a Raven login for every request to a WSGI application. Takes the same keyword arguments as
+    RavenGateway."""
+
+    def __init__(self, app, **kwargs):
+        self.app = app
+        self.gateway = RavenGateway(**kwargs)
+
+    def __call__(self, environ, start_response):
+        host = environ.get('HTTP_HOST')
+        if not host:
+            host = environ['SERVER_NAME']
+            if environ['SERVER_PORT'] not in ('80', '443'):
+                host += ':' + environ['SERVER_PORT']
+        identity, response = self.gateway.handle(environ['wsgi.url_scheme'], host, environ.get('SCRIPT_NAME', ''),
+                                                 environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', ''),
+                                                 environ.get('HTTP_COOKIE'))
+        if response is None:
+            environ[IDENTITY_KEY] = identity
+            environ['REMOTE_USER'] = identity['principal']
+            return self.app(environ, start_response)
+
+        status, headers, body = response
+        start_response('%d %s' % (status, REASONS[status]), headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+
+class RavenASGIMiddleware(object):
+    """Requires a Raven login for every HTTP request to an ASGI application. Takes the same keyword arguments as
+    RavenGateway."""
+
+    def __init__(self, app, **kwargs):
+        self.app = app
+        self.gateway = RavenGateway(**kwargs)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        host = cookie = None
+        for name, value in scope['headers']:
+            if name == b'host':
+                host = value.decode('latin-1')
+            elif name == b'cookie':
+                cookie = value.decode('latin-1') if cookie is None else cookie + '; ' + value.decode('latin-1')
+        if host is None:
+            server_host, server_port = scope['server']
+            host = server_host if server_port in (80, 443) else '%s:%d' % (server_host, server_port)
+
+        identity, response = self.gateway.handle(scope['scheme'], host, scope.get('root_path', ''), scope['path'],
+                                                 scope['query_string'].decode('latin-1'), cookie)
+        if response is None:
+            scope = dict(scope)
+            scope[IDENTITY_KEY] = identity
+            return await self.app(scope, receive, send)
+
+        status, headers, body = response
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        headers.append((b'content-length', str(len(body)).encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
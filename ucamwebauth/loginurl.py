@@ -0,0 +1,81 @@
+"""Cached construction of the URL of authentication requests to the WLS.
+
+Only the params (the page to go back to after the login) of an authentication request usually vary between requests.
+The rest of its URL depends on the settings and, through the return URL, on the scheme, host and script prefix of the
+request, so it is built once per (scheme, host, script prefix) and reused until the settings change. Both these parts
+and the encoded params of the most common 'next' values are kept in LRU caches of at most
+UCAMWEBAUTH_LOGIN_URL_CACHE_SIZE entries (the hosts are only bounded by ALLOWED_HOSTS, which may be '*').
+
+The {% raven_login_url %} template tag (load the 'raven' library) renders the same URL, for direct links to the WLS
+that skip the redirect through raven_login.
+"""
+import threading
+from collections import OrderedDict
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+try:
+    from django.urls import get_script_prefix
+except ImportError:
+    from django.core.urlresolvers import get_script_prefix
+from ucamwebauth.protocol import login_url_parts, encode_params
+from ucamwebauth.utils import setting, get_return_url
+
+# (scheme, host, script prefix) -> (prefix, suffix) of the URL
+_parts = OrderedDict()
+# next -> encoded params
+_params = OrderedDict()
+_lock = threading.Lock()
+
+
+@receiver(setting_changed)
+def clear_caches(**kwargs):
+    with _lock:
+        _parts.clear()
+        _params.clear()
+
+
+def _lookup(cache, key):
+    """Returns the value of key in the LRU cache, or None"""
+    with _lock:
+        # Moved to the end: the least recently used entries are at the start
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+
+
+def _store(cache, key, value):
+    with _lock:
+        cache[key] = value
+        while len(cache) > setting('UCAMWEBAUTH_LOGIN_URL_CACHE_SIZE', default=1024):
+            cache.popitem(last=False)
+
+
+def _get_parts(request):
+    key = (request.scheme, request.get_host(), get_script_prefix())
+    parts = _lookup(_parts, key)
+    if parts is not None:
+        return parts
+    # aauth is ignored as v3 only supports 'pwd', therefore we do not need it.
+    parts = login_url_parts(setting('UCAMWEBAUTH_LOGIN_URL'), get_return_url(request),
+                            desc=setting('UCAMWEBAUTH_DESC', default=''), iact=setting('UCAMWEBAUTH_IACT', default=''),
+                            msg=setting('UCAMWEBAUTH_MSG', default=''), fail=setting('UCAMWEBAUTH_FAIL', default=''))
+    _store(_parts, key, parts)
+    return parts
+
+
+def _get_params(next_url):
+    if next_url is None:
+        return ''
+    params = _lookup(_params, next_url)
+    if params is None:
+        params = encode_params([('next', next_url)])
+        _store(_params, next_url, params)
+    return params
+
+
+def get_login_url(request, next_url=None):
+    """Returns the URL of an authentication request to the WLS, for a user of request that should be sent to next_url
+    (if not None) after the login"""
+    prefix, suffix = _get_parts(request)
+    return prefix + _get_params(next_url) + suffix
@@ -0,0 +1,37 @@
+import io
+from django.core.management.base import BaseCommand, CommandError
+from ucamwebauth import export
+
+
+class Command(BaseCommand):
+    help = ("Writes every user with their raven_for_life flag and last login, as CSV or JSON lines. The users are "
+            "read in chunks, so memory use does not depend on the number of users.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=export.FORMATS, default='csv', help="Output format (default csv)")
+        parser.add_argument('--output', help="File to write to (default: the standard output)")
+        flag = parser.add_mutually_exclusive_group()
+        flag.add_argument('--raven-for-life', dest='raven_for_life', action='store_true', default=None,
+                          help="Only the users that are raven for life")
+        flag.add_argument('--not-raven-for-life', dest='raven_for_life', action='store_false',
+                          help="Only the users that are not raven for life")
+        parser.add_argument('--last-login-after', help="Only the users that last logged in at or after this date")
+        parser.add_argument('--last-login-before', help="Only the users that last logged in before this date")
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help="Number of users fetched from the database at a time (default 2000)")
+
+    def handle(self, *args, **options):
+        filters = {'raven_for_life': options['raven_for_life'], 'chunk_size': options['chunk_size']}
+        for name in ('last_login_after', 'last_login_before'):
+            if options[name]:
+                try:
+                    filters[name] = export.parse_when(options[name])
+                except ValueError as e:
+                    raise CommandError(str(e))
+        lines = export.export(options['format'], **filters)
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
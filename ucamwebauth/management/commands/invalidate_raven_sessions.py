@@ -0,0 +1,30 @@
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from ucamwebauth import sessions
+
+
+class Command(BaseCommand):
+    help = ("Ends every session of the given users (e.g. when they leave the University or their account is "
+            "compromised), using the session index maintained when UCAMWEBAUTH_SESSION_INDEX is enabled.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', nargs='*', help="Username (CRSid) of a user whose sessions are ended")
+        parser.add_argument('--prune', action='store_true',
+                            help="Also remove the index entries of the sessions that have expired")
+
+    def handle(self, *args, **options):
+        if not options['username'] and not options['prune']:
+            raise CommandError("Give at least one username, or --prune")
+        users = User.objects.filter(username__in=options['username'])
+        unknown = set(options['username']) - set(user.username for user in users)
+        if unknown:
+            raise CommandError("Unknown users: %s" % ', '.join(sorted(unknown)))
+        for user in users:
+            try:
+                ended = sessions.invalidate_sessions(user)
+            except ImproperlyConfigured as e:
+                raise CommandError(str(e))
+            self.stdout.write("%s: %d sessions ended" % (user.username, ended))
+        if options['prune']:
+            self.stdout.write("%d expired sessions removed from the index" % sessions.prune_expired())
@@ -0,0 +1,156 @@
+import csv
+import io
+import json
+import sys
+import tempfile
+import time
+from importlib import import_module
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from ucamwebauth.models import UserProfile
+from ucamwebauth.utils import setting
+
+CURRENT = 'current'
+NOT_CURRENT = 'not-current'
+
+
+def read_feed(stream):
+    """Yields (crn, current) pairs from CSV lines of the form 'crn,current' or 'crn,not-current'"""
+    for line_number, row in enumerate(csv.reader(stream), 1):
+        if not row or row[0].startswith('#'):
+            continue
+        if len(row) != 2 or row[1].strip() not in (CURRENT, NOT_CURRENT):
+            raise CommandError("Line %d: expected 'crn,%s' or 'crn,%s', got %r" %
+                               (line_number, CURRENT, NOT_CURRENT, ','.join(row)))
+        yield row[0].strip(), row[1].strip() == CURRENT
+
+
+def chunks(iterable, size):
+    chunk = {}
+    for crn, current in iterable:
+        chunk[crn] = current
+        if len(chunk) >= size:
+            yield chunk
+            chunk = {}
+    if chunk:
+        yield chunk
+
+
+def spool(feed):
+    """Reads the whole feed into a temporary file, so that a malformed record is found before any profile is changed.
+    @return The temporary file, at its start"""
+    spooled = tempfile.TemporaryFile('w+')
+    try:
+        for crn, current in feed:
+            spooled.write(json.dumps([crn, current]) + '\n')
+        spooled.seek(0)
+    except BaseException:
+        spooled.close()
+        raise
+    return spooled
+
+
+def read_spool(spooled):
+    for line in spooled:
+        crn, current = json.loads(line)
+        yield crn, current
+
+
+def _iterator(queryset, chunk_size):
+    """Iterates over queryset without caching its rows"""
+    return queryset.iterator(chunk_size=chunk_size) if django.VERSION[0] >= 2 else queryset.iterator()
+
+
+class Command(BaseCommand):
+    help = ("Updates UserProfile.raven_for_life of every user in a feed of (CRN, current/not-current) records, without "
+            "waiting for the users to log in again. The feed is read from a CSV file (or '-' for the standard input) "
+            "or, if no file is given, from the callable named by UCAMWEBAUTH_STATUS_FEED, which must return an "
+            "iterable of (crn, current) pairs. The whole feed is read before any profile is changed, so a malformed "
+            "record changes nothing; the chunks are then committed one by one, unless --atomic is given.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed', nargs='?', help="CSV file with 'crn,current' or 'crn,not-current' lines")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of feed records diffed and updated per query (default 500)")
+        parser.add_argument('--dry-run', action='store_true', help="Report the changes without saving them")
+        parser.add_argument('--atomic', action='store_true',
+                            help="Apply the whole feed in one transaction instead of committing each chunk. The "
+                                 "updated profiles stay locked, and logins that save them wait, until the end")
+
+    def handle(self, *args, **options):
+        if options['feed'] == '-':
+            self.sync(read_feed(sys.stdin), options)
+        elif options['feed']:
+            with io.open(options['feed'], newline='') as stream:
+                self.sync(read_feed(stream), options)
+        else:
+            feed = setting('UCAMWEBAUTH_STATUS_FEED')
+            if feed is None:
+                raise CommandError("No feed file given and UCAMWEBAUTH_STATUS_FEED is not set")
+            module_name, function_name = feed.rsplit('.', 1)
+            self.sync(getattr(import_module(module_name), function_name)(), options)
+
+    def sync(self, feed, options):
+        start = time.time()
+        if options['atomic']:
+            # A malformed record found after earlier chunks have been written rolls them back with the rest
+            with transaction.atomic():
+                records, updated, created = self.sync_chunks(feed, options)
+        else:
+            # A transaction over a feed of millions of records would hold the row locks of every updated profile
+            # until the end. The feed is read (and so validated) first, then each chunk is committed on its own
+            spooled = spool(feed)
+            try:
+                records, updated, created = self.sync_chunks(read_spool(spooled), options)
+            finally:
+                spooled.close()
+        duration = max(time.time() - start, 1e-6)
+        self.stdout.write("%d records, %d profiles updated, %d profiles created in %.1fs (%.0f rows/s)%s" %
+                          (records, updated, created, duration, records / duration,
+                           " (dry run)" if options['dry_run'] else ""))
+
+    def sync_chunks(self, feed, options):
+        """@return (number of records, number of profiles updated, number of profiles created)"""
+        records = updated = created = 0
+        for chunk in chunks(feed, options['chunk_size']):
+            records += len(chunk)
+            chunk_updated, chunk_created = self.sync_chunk(chunk, options['dry_run'])
+            updated += chunk_updated
+            created += chunk_created
+        return records, updated, created
+
+    def sync_chunk(self, chunk, dry_run):
+        """Diffs a chunk of the feed (crn -> current) against the profiles and fixes the ones that differ.
+        @return (number of profiles updated, number of profiles created)"""
+        set_raven_for_life = []
+        clear_raven_for_life = []
+        seen = set()
+        profiles = UserProfile.objects.filter(user__username__in=list(chunk)) \
+            .values_list('pk', 'user__username', 'raven_for_life')
+        for pk, username, raven_for_life in _iterator(profiles, len(chunk)):
+            seen.add(username)
+            # A user is raven for life if not current
+            expected = not chunk[username]
+            if raven_for_life != expected:
+                (set_raven_for_life if expected else clear_raven_for_life).append(pk)
+
+        # Users that have not logged in since UserProfile was introduced have no profile yet
+        missing = [crn for crn in chunk if crn not in seen]
+        new_profiles = []
+        if missing:
+            users = User.objects.filter(username__in=missing).values_list('pk', 'username')
+            new_profiles = [UserProfile(user_id=pk, raven_for_life=not chunk[username])
+                            for pk, username in _iterator(users, len(missing))]
+
+        if not dry_run and (set_raven_for_life or clear_raven_for_life or new_profiles):
+            # raven_for_life is a boolean, so the whole chunk is updated with at most two UPDATE queries
+            with transaction.atomic():
+                if set_raven_for_life:
+                    UserProfile.objects.filter(pk__in=set_raven_for_life).update(raven_for_life=True)
+                if clear_raven_for_life:
+                    UserProfile.objects.filter(pk__in=clear_raven_for_life).update(raven_for_life=False)
+                if new_profiles:
+                    UserProfile.objects.bulk_create(new_profiles)
+        return len(set_raven_for_life) + len(clear_raven_for_life), len(new_profiles)
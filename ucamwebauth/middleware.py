@@ -1,23 +1,122 @@
 from django.contrib import messages
 from django.http import HttpResponseServerError, HttpResponseForbidden
 from django.template.loader import get_template
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    # django < 1.10
+    MiddlewareMixin = object
 from ucamwebauth import MalformedResponseError, InvalidResponseError, PublicKeyNotFoundError, UserNotAuthorised, \
-    OtherStatusCode
+    OtherStatusCode, TooManyLoginsError, principals, sessions
+from ucamwebauth.utils import setting, HttpResponseServiceUnavailable
 
 
-class DefaultErrorBehaviour():
-    """ A middleware that catches django-ucamwebauth exceptions and show HTTP 500 or HTTP 403 error messages,
+class DefaultErrorBehaviour(MiddlewareMixin):
+    """ A middleware that catches django-ucamwebauth exceptions and show HTTP 500, 503 or HTTP 403 error messages,
     depending of the error. Furthermore, it uses templates that can be rewritten by a developer.
     """
+
+    # Exception class -> (template name, response class). Subclasses of these exceptions are handled by the entry of
+    # their nearest ancestor.
+    HANDLERS = {
+        MalformedResponseError: ("ucamwebauth_500.html", HttpResponseServerError),
+        InvalidResponseError: ("ucamwebauth_500.html", HttpResponseServerError),
+        OtherStatusCode: ("ucamwebauth_500.html", HttpResponseServerError),
+        PublicKeyNotFoundError: ("ucamwebauth_500.html", HttpResponseServerError),
+        UserNotAuthorised: ("ucamwebauth_403.html", HttpResponseForbidden),
+        TooManyLoginsError: ("ucamwebauth_503.html", HttpResponseServiceUnavailable),
+    }
+
+    def __init__(self, get_response=None):
+        if MiddlewareMixin is object:
+            self.get_response = get_response
+        else:
+            super(DefaultErrorBehaviour, self).__init__(get_response)
+        # Resolved handlers for every exception class seen so far, including the ones that we do not handle (None),
+        # so that the MRO is only walked once per class.
+        self._dispatch = {}
+        # Templates are loaded once and reused for every error response.
+        self._templates = {}
+
     def process_exception(self, request, exception):
-        if exception.__class__ == MalformedResponseError or \
-                exception.__class__ == InvalidResponseError or \
-                exception.__class__ == OtherStatusCode or \
-                exception.__class__ == PublicKeyNotFoundError:
-            template = get_template("ucamwebauth_500.html")
-            messages.error(request, str(exception))
-            return HttpResponseServerError(template.render({}, request))
-        elif exception.__class__ == UserNotAuthorised:
-            template = get_template("ucamwebauth_403.html")
+        try:
+            handler = self._dispatch[exception.__class__]
+        except KeyError:
+            handler = self._resolve(exception.__class__)
+
+        if handler is None:
+            return None
+
+        template_name, response_class = handler
+        try:
+            template = self._templates[template_name]
+        except KeyError:
+            template = self._templates[template_name] = get_template(template_name)
+
+        # Shed logins must stay cheap, so they never touch the (session-backed) messages framework
+        if not isinstance(exception, TooManyLoginsError) and self._use_messages(request):
             messages.error(request, str(exception))
-            return HttpResponseForbidden(template.render({}, request))
+            context = {}
+        else:
+            # Skip the (session-backed) messages framework and hand the error message straight to the template.
+            context = {'error_message': str(exception)}
+        response = response_class(template.render(context, request))
+        retry_after = getattr(exception, 'retry_after', None)
+        if retry_after is not None:
+            response['Retry-After'] = str(retry_after)
+        return response
+
+    def _resolve(self, exception_class):
+        handler = None
+        for klass in exception_class.__mro__:
+            if klass in self.HANDLERS:
+                handler = self.HANDLERS[klass]
+                break
+        self._dispatch[exception_class] = handler
+        return handler
+
+    @staticmethod
+    def _use_messages(request):
+        """Anonymous users only get a messages entry if UCAMWEBAUTH_ERROR_MESSAGES_FOR_ANONYMOUS is True (default)"""
+        if setting('UCAMWEBAUTH_ERROR_MESSAGES_FOR_ANONYMOUS', default=True):
+            return True
+        user = getattr(request, 'user', None)
+        if user is None:
+            return False
+        is_authenticated = user.is_authenticated
+        # is_authenticated is a method in django < 1.10
+        if callable(is_authenticated):
+            is_authenticated = is_authenticated()
+        return bool(is_authenticated)
+
+
+class SessionIndexMiddleware(MiddlewareMixin):
+    """A middleware that keeps the session index (UCAMWEBAUTH_SESSION_INDEX) up to date when the key of a session
+    changes after the login, e.g. when update_session_auth_hash cycles it after a password change. It must come after
+    SessionMiddleware.
+    """
+
+    def process_request(self, request):
+        session = getattr(request, 'session', None)
+        # session_key does not load the session
+        request._ucamwebauth_session_key = None if session is None else session.session_key
+
+    def process_response(self, request, response):
+        old_session_key = getattr(request, '_ucamwebauth_session_key', None)
+        if old_session_key is not None:
+            sessions.record_rotation(old_session_key, request.session.session_key)
+        return response
+
+
+class RavenPrincipalMiddleware(MiddlewareMixin):
+    """A middleware that lets RavenPrincipalBackend read the identity of the user from the session of the request (see
+    ucamwebauth.principals). It must come after SessionMiddleware and before AuthenticationMiddleware. The session is
+    unbound when the response is returned, so request.user must be read by then (e.g. not only while streaming).
+    """
+
+    def process_request(self, request):
+        principals.bind_session(getattr(request, 'session', None))
+
+    def process_response(self, request, response):
+        principals.bind_session(None)
+        return response
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ucamwebauth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RavenSession',
+            fields=[
+                ('id', models.AutoField(serialize=False, auto_created=True, primary_key=True, verbose_name='ID')),
+                ('session_key', models.CharField(max_length=40, unique=True)),
+                ('expire_date', models.DateTimeField(db_index=True)),
+                ('user', models.ForeignKey(related_name='raven_sessions', to=settings.AUTH_USER_MODEL,
+                                           on_delete=models.CASCADE)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucamwebauth', '0002_ravensession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='attributes_json',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
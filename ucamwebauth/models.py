@@ -1,8 +1,12 @@
-
+import json
 from django.contrib.auth.models import User
 from django.db import models
 
 
+def encode_attributes(attributes):
+    return json.dumps(attributes, sort_keys=True) if attributes else ''
+
+
 class UserProfile(models.Model):
     """
     The purpose is this model is to customise the User modal as per the recommendation in
@@ -11,7 +15,30 @@ class UserProfile(models.Model):
     ie has left the University but still has access to certain resources.
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
-    raven_for_life = models.BooleanField(default=False)
+    raven_for_life = models.BooleanField(default=False, db_index=True)
+    # JSON encoded directory attributes, see ucamwebauth.attributes
+    attributes_json = models.TextField(blank=True, default='')
+
+    @property
+    def attributes(self):
+        return json.loads(self.attributes_json) if self.attributes_json else {}
+
+    @attributes.setter
+    def attributes(self, value):
+        self.attributes_json = encode_attributes(value)
 
     def __str__(self):
         return str(self.user)
+
+
+class RavenSession(models.Model):
+    """
+    Index of the sessions of each user, maintained when UCAMWEBAUTH_SESSION_INDEX is enabled so that all the sessions
+    of a user can be deleted without decoding every session (see ucamwebauth.sessions).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="raven_sessions")
+    session_key = models.CharField(max_length=40, unique=True)
+    expire_date = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.user, self.session_key)
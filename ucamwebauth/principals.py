@@ -0,0 +1,135 @@
+"""Users that only exist in the session.
+
+RavenPrincipalBackend (see ucamwebauth.backends) returns a RavenUser instead of a User: a small object built from the
+verified WLS response, which carries the principal, the ptags and raven_for_life and is never stored in the database.
+
+django.contrib.auth.login() stores the primary key of the user in the session and get_user() hands it back to the
+backend. The primary key of a RavenUser is a short hash of the principal, read as an integer so that the integer
+primary key field of the User model accepts it. The principal and the ptags themselves are stored under their own
+session key (SESSION_KEY) when the user logs in, and RavenPrincipalBackend.get_user() reads them back from the session
+of the current request, which RavenPrincipalMiddleware binds to the thread. Logins and requests then make no database
+query beyond the ones of the session engine. Without a bound session (the middleware is missing or misplaced, or
+request.user is first read after the response has been returned, e.g. by a streaming response), get_user() raises
+ImproperlyConfigured rather than making every user anonymous.
+"""
+import hashlib
+import threading
+from django.core.exceptions import ImproperlyConfigured
+
+SESSION_KEY = 'ucamwebauth_principal'
+
+# The session of the request being handled by this thread
+_local = threading.local()
+
+
+def principal_pk(principal):
+    """Returns the primary key of the RavenUser of principal: a stable 60 bit integer"""
+    return int(hashlib.sha1(principal.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def bind_session(session):
+    """Makes get_user() read the identities from session in this thread (None to unbind it)"""
+    _local.session = session
+
+
+def record_login(sender, request, user, **kwargs):
+    """user_logged_in receiver: stores the identity of a RavenUser in the session"""
+    session = getattr(request, 'session', None)
+    if isinstance(user, RavenUser) and session is not None:
+        session[SESSION_KEY] = {'principal': user.username, 'ptags': user.ptags}
+
+
+def get_user(user_id):
+    """Returns the RavenUser with primary key user_id stored in the session bound to this thread, or None
+    @exception ImproperlyConfigured if no session is bound to this thread"""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        raise ImproperlyConfigured("RavenPrincipalBackend needs ucamwebauth.middleware.RavenPrincipalMiddleware after "
+                                   "SessionMiddleware and before AuthenticationMiddleware, and request.user must be "
+                                   "read before the response is returned")
+    identity = session.get(SESSION_KEY)
+    if identity is None:
+        return None
+    user = RavenUser(identity['principal'], identity['ptags'])
+    try:
+        matches = user.pk == int(user_id)
+    except (TypeError, ValueError):
+        matches = False
+    return user if matches else None
+
+
+class _PrimaryKey(object):
+    """Enough of a primary key field for django.contrib.auth.login()"""
+    name = attname = 'id'
+
+    def value_to_string(self, obj):
+        return str(obj.pk)
+
+
+class _Options(object):
+    pk = _PrimaryKey()
+
+
+class RavenUser(object):
+    """A user authenticated by Raven that is not stored in the database"""
+    __slots__ = ('username', 'ptags', 'pk', 'backend', 'last_login')
+
+    _meta = _Options()
+    is_active = True
+    is_staff = False
+    is_superuser = False
+    is_anonymous = False
+    is_authenticated = True
+
+    def __init__(self, principal, ptags=()):
+        self.username = principal
+        self.ptags = list(ptags or ())
+        self.pk = principal_pk(principal)
+        self.backend = None
+        self.last_login = None
+
+    @property
+    def id(self):
+        return self.pk
+
+    @property
+    def raven_for_life(self):
+        """Whether the user is not a current member of the University (see UserProfile.raven_for_life)"""
+        return 'current' not in self.ptags
+
+    def get_username(self):
+        return self.username
+
+    def __str__(self):
+        return self.username
+
+    def __repr__(self):
+        return '<RavenUser: %s>' % self.username
+
+    def __eq__(self, other):
+        return isinstance(other, RavenUser) and self.username == other.username and self.ptags == other.ptags
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def save(self, *args, **kwargs):
+        """Nothing to save (e.g. the last_login set by django.contrib.auth.login())"""
+        pass
+
+    def delete(self):
+        raise NotImplementedError("RavenUser is not stored in the database")
+
+    def has_perm(self, perm, obj=None):
+        return False
+
+    def has_perms(self, perm_list, obj=None):
+        return False
+
+    def has_module_perms(self, module):
+        return False
+
+    def get_all_permissions(self, obj=None):
+        return set()
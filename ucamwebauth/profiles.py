@@ -0,0 +1,183 @@
+"""Deferred UserProfile updates.
+
+With UCAMWEBAUTH_DEFER_PROFILE_UPDATES, RavenAuthBackend does not read or write the UserProfile during the login.
+It hands the new field values (raven_for_life and the attributes) to a ProfileWriter once the current transaction
+commits, and a background thread applies them. Updates for the same user are coalesced while they wait, the queue is
+bounded (when it is full the update is written synchronously) and pending updates are flushed when the process exits.
+
+Code that needs an up to date profile straight away should use get_profile(user), which also sees the updates
+deferred by the current transaction before it commits.
+"""
+import atexit
+import logging
+import threading
+import weakref
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from django.db import close_old_connections, transaction
+from ucamwebauth.models import UserProfile
+from ucamwebauth.utils import setting
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileWriter(object):
+    """Applies UserProfile updates from a background thread"""
+
+    def __init__(self, maxsize=1000, background=True):
+        """@param maxsize  The maximum number of users with a pending update in the queue
+        @param background  Whether a background thread applies the updates (otherwise, only flush() does)"""
+        # user id -> {field name: value}, for every user with a pending update
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        # Held while an update is applied, so that get_profile never reads a profile while it is being written
+        self.write_lock = threading.Lock()
+        self.queue = queue.Queue(maxsize)
+        self.background = background
+        self.thread = None
+
+    def submit(self, user_id, **fields):
+        """Schedules an update of fields in the profile of user_id"""
+        with self.pending_lock:
+            coalesced = user_id in self.pending
+            self.pending.setdefault(user_id, {}).update(fields)
+        if coalesced:
+            return
+        if self.background:
+            self._start()
+        try:
+            self.queue.put_nowait(user_id)
+        except queue.Full:
+            # Back-pressure: the caller pays for the write
+            self.write(user_id)
+
+    def write(self, user_id):
+        """Applies the pending update of user_id, if any, in the calling thread"""
+        with self.write_lock:
+            with self.pending_lock:
+                if user_id not in self.pending:
+                    return
+                fields = self.pending.pop(user_id)
+            profile, created = UserProfile.objects.get_or_create(user_id=user_id, defaults=fields)
+            if not created:
+                changed = dict((name, value) for name, value in fields.items() if getattr(profile, name) != value)
+                if changed:
+                    UserProfile.objects.filter(pk=profile.pk).update(**changed)
+
+    def flush(self):
+        """Applies every pending update in the calling thread"""
+        with self.pending_lock:
+            user_ids = list(self.pending)
+        for user_id in user_ids:
+            self.write(user_id)
+
+    def stop(self):
+        """Flushes the pending updates and stops the background thread"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def _start(self):
+        if self.thread is None:
+            with self.pending_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='ucamwebauth-profile-writer')
+                    self.thread.daemon = True
+                    self.thread.start()
+                    atexit.register(self.stop)
+
+    def _run(self):
+        while True:
+            user_id = self.queue.get()
+            if user_id is None:
+                break
+            try:
+                self.write(user_id)
+            except Exception:
+                logger.exception("Could not update the profile of user %s", user_id)
+            if self.queue.empty():
+                close_old_connections()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ProfileWriter(maxsize=setting('UCAMWEBAUTH_PROFILE_QUEUE_SIZE', default=1000))
+    return _writer
+
+
+# Per thread, the database alias -> weak references to the DeferredUpdate callbacks of its open transaction
+_uncommitted = threading.local()
+
+
+def _pending(connection):
+    pending = _uncommitted.__dict__.setdefault(connection.alias, [])
+    if not connection.in_atomic_block:
+        # The transaction has ended: committed updates have been handed over, and the others were rolled back
+        del pending[:]
+    return pending
+
+
+class DeferredUpdate(object):
+    """The on_commit callback of defer_update, which get_profile can find while the transaction is still open"""
+
+    def __init__(self, user_id, fields, alias):
+        self.user_id = user_id
+        self.fields = fields
+        self.alias = alias
+
+    def __call__(self):
+        pending = _uncommitted.__dict__.get(self.alias, [])
+        pending[:] = [ref for ref in pending if ref() not in (self, None)]
+        get_writer().submit(self.user_id, **self.fields)
+
+
+def defer_update(user, **fields):
+    """Updates fields in the profile of user in the background, once the current transaction (if any) commits"""
+    connection = transaction.get_connection()
+    update = DeferredUpdate(user.pk, fields, connection.alias)
+    if connection.in_atomic_block:
+        # Only the on_commit callbacks hold the update: when Django discards them, because the transaction or the
+        # savepoint that deferred it is rolled back, the update disappears from here too (right away in CPython,
+        # at the next garbage collection elsewhere)
+        _pending(connection).append(weakref.ref(update))
+    transaction.on_commit(update)
+
+
+def uncommitted_fields(user_id):
+    """Returns the fields deferred for user_id by the current transaction that it has not committed yet"""
+    fields = {}
+    pending = _pending(transaction.get_connection())
+    pending[:] = [ref for ref in pending if ref() is not None]
+    for ref in pending:
+        update = ref()
+        if update is not None and update.user_id == user_id:
+            fields.update(update.fields)
+    return fields
+
+
+def get_profile(user):
+    """Returns the UserProfile of user, applying first any deferred update for it.
+
+    An update deferred by the current transaction is written within that transaction, so that it is read back now and
+    rolled back with it. The callback still hands it over on commit, where it is then a no-op."""
+    if _writer is not None:
+        _writer.write(user.pk)
+    profile = UserProfile.objects.get_or_create(user=user)[0]
+    fields = uncommitted_fields(user.pk)
+    changed = dict((name, value) for name, value in fields.items() if getattr(profile, name) != value)
+    if changed:
+        UserProfile.objects.filter(pk=profile.pk).update(**changed)
+        for name, value in changed.items():
+            setattr(profile, name, value)
+    return profile
@@ -0,0 +1,91 @@
+"""Sampling cProfile hook for the Raven login path.
+
+raven_login, raven_return and RavenAuthBackend.authenticate are wrapped with profiled(). When UCAMWEBAUTH_PROFILE_DIR is
+set, a UCAMWEBAUTH_PROFILE_SAMPLE_RATE fraction of their calls are run under cProfile and the profiles are written to
+that directory as <name>-<time>-<pid>-<duration>ms.prof files, which pstats and snakeviz read. Only the
+UCAMWEBAUTH_PROFILE_MAX_FILES (default 100) most recent files are kept.
+
+With UCAMWEBAUTH_PROFILE_SLOW_THRESHOLD, the profiles of the sampled calls that took at most that many seconds are
+discarded, so that only the slow calls are kept.
+
+When UCAMWEBAUTH_PROFILE_DIR is not set, a call only pays for a settings lookup; when the sample misses, for a random
+number.
+"""
+import cProfile
+import functools
+import logging
+import os
+import random
+import threading
+from datetime import datetime
+try:
+    from datetime import timezone
+    utc = timezone.utc
+except ImportError:
+    # python 2
+    from django.utils.timezone import utc
+from ucamwebauth.utils import setting
+
+try:
+    from time import perf_counter
+except ImportError:
+    # python 2
+    from time import time as perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Whether a profile is running in this thread: calls nested in a profiled call are already in its profile
+_local = threading.local()
+
+
+def profiled(name):
+    """Decorator that profiles a sample of the calls of a function (see the module documentation)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            directory = setting('UCAMWEBAUTH_PROFILE_DIR')
+            if directory is None or getattr(_local, 'active', False):
+                return func(*args, **kwargs)
+            if random.random() < setting('UCAMWEBAUTH_PROFILE_SAMPLE_RATE', default=0):
+                return _profile(directory, name, func, args, kwargs)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _profile(directory, name, func, args, kwargs):
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is active (e.g. in another thread, on python >= 3.12)
+        return func(*args, **kwargs)
+    _local.active = True
+    start = perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        _local.active = False
+        duration = perf_counter() - start
+        threshold = setting('UCAMWEBAUTH_PROFILE_SLOW_THRESHOLD')
+        if threshold is None or duration > threshold:
+            _write(profiler, directory, name, duration)
+
+
+def _write(profiler, directory, name, duration):
+    """Writes a profile and removes the oldest ones beyond UCAMWEBAUTH_PROFILE_MAX_FILES. Errors are logged, so that
+    they never fail the request."""
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        profiler.dump_stats(os.path.join(directory, '%s-%s-%d-%dms.prof' % (
+            name, datetime.now(utc).strftime('%Y%m%dT%H%M%S.%f'), os.getpid(), duration * 1000)))
+        profiles = [os.path.join(directory, filename) for filename in os.listdir(directory)
+                    if filename.endswith('.prof')]
+        excess = len(profiles) - setting('UCAMWEBAUTH_PROFILE_MAX_FILES', default=100)
+        if excess > 0:
+            for path in sorted(profiles, key=os.path.getmtime)[:excess]:
+                os.unlink(path)
+    except (IOError, OSError) as e:
+        logger.error("Could not write the profile of %s to %s: %s", name, directory, e)
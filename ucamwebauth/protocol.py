@@ -0,0 +1,414 @@
+"""The WAA side of the WAA->WLS communication protocol (http://raven.cam.ac.uk/project/waa2wls-protocol.txt),
+independent of Django.
+"""
+import io
+import os
+import time
+import calendar
+from base64 import b64decode
+try:
+    from urlparse import parse_qs
+    from urllib import unquote, urlencode
+except ImportError:
+    from urllib.parse import parse_qs, unquote, urlencode
+from ucamwebauth.exceptions import MalformedResponseError, InvalidResponseError, PublicKeyNotFoundError
+
+_crypto = None
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _openssl():
+    """Returns OpenSSL.crypto, which is only imported when a certificate or a signature has to be checked"""
+    global _crypto
+    if _crypto is None:
+        from OpenSSL import crypto
+        _crypto = crypto
+    return _crypto
+
+
+def decode_sig(sig):
+    """Decodes a signature from the variant base64 used by raven.
+    @param sig  A string giving the signature in Raven's variant base-64
+    @return  A binary string containing the signature"""
+    sig = sig.replace("-", "+").replace(".", "/").replace("_", "=")
+    try:
+        return b64decode(sig)
+    except (TypeError, ValueError):  # binascii.Error is a ValueError in python 3
+        raise MalformedResponseError("Signature is not a valid base-64 encoded string")
+
+
+def parse_time(time_string):
+    """Converts a time of the form '20110729T123456Z' to a number of seconds
+    since the epoch.
+    @exception ValueError if the time is not a valid Raven time"""
+    # Parsed by hand rather than with time.strptime, which holds a module wide lock (and checks the locale) on every
+    # call, so that responses can be checked in parallel. It accepts the same times as strptime("%Y%m%dT%H%M%SZ"),
+    # except that every field must have all its digits, as the protocol requires.
+    if len(time_string) != 16 or time_string[8] != 'T' or time_string[15] != 'Z' or \
+            not time_string[0:8].isdigit() or not time_string[9:15].isdigit():
+        raise ValueError("Not a valid Raven time: %r" % time_string)
+    year, month, day = int(time_string[0:4]), int(time_string[4:6]), int(time_string[6:8])
+    hour, minute, second = int(time_string[9:11]), int(time_string[11:13]), int(time_string[13:15])
+    if not 1 <= month <= 12 or not 1 <= day <= calendar.monthrange(year, month)[1] or hour > 23 or minute > 59 or \
+            second > 61:
+        raise ValueError("Not a valid Raven time: %r" % time_string)
+    return calendar.timegm((year, month, day, hour, minute, second))
+
+
+def build_login_url(login_url, return_url, desc='', iact='', msg='', fail='', params=None):
+    """Returns the URL of an authentication request to the WLS at login_url.
+    @param params  A list of (name, value) pairs that the WLS returns unaltered in the params of the response"""
+    prefix, suffix = login_url_parts(login_url, return_url, desc, iact, msg, fail)
+    return prefix + encode_params(params) + suffix
+
+
+def login_url_parts(login_url, return_url, desc='', iact='', msg='', fail=''):
+    """Returns the parts of the URL of an authentication request that come before and after the params, which are the
+    only part that usually varies between requests (see build_login_url)"""
+    prefix = "%s?%s" % (login_url, urlencode([('ver', 3), ('url', return_url), ('desc', desc), ('iact', iact),
+                                              ('msg', msg)]))
+    return prefix, '&' + urlencode([('fail', fail)])
+
+
+def encode_params(params):
+    """Returns the params field of the URL of an authentication request (see build_login_url), with its leading '&'"""
+    if params is None:
+        return ''
+    return '&' + urlencode([('params', urlencode(params))])
+
+
+class StaticKeyStore(object):
+    """The public keys of the WLS, given as a dictionary of kid -> PEM certificate. Certificates are only parsed
+    once."""
+
+    def __init__(self, certs):
+        self.certs = certs
+        self._loaded = {}
+
+    def get(self, kid):
+        """Returns the certificate with id kid, or None"""
+        try:
+            return self._loaded[kid]
+        except KeyError:
+            pass
+        pem = self.certs.get(kid)
+        if pem is None:
+            return None
+        crypto = _openssl()
+        cert = self._loaded[kid] = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+        return cert
+
+
+class DirectoryKeyStore(object):
+    """The public keys of the WLS, read from the pubkey<kid>.crt files of a directory (the layout used by the other
+    Raven agents). The file of a kid is checked at most once every check_interval seconds, and only parsed again if its
+    modification time or inode has changed, so keys can be added or rotated without restarting."""
+
+    def __init__(self, directory, check_interval=60):
+        self.directory = directory
+        self.check_interval = check_interval
+        # kid -> (time of the last check, (mtime, inode) of the file, certificate or None)
+        self._entries = {}
+
+    def get(self, kid):
+        """Returns the certificate with id kid, or None"""
+        now = _monotonic()
+        entry = self._entries.get(kid)
+        if entry is not None and now - entry[0] < self.check_interval:
+            return entry[2]
+
+        path = os.path.join(self.directory, 'pubkey%d.crt' % kid)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Unknown kids are remembered too, so that they do not cost a stat per request
+            self._entries[kid] = (now, None, None)
+            return None
+        signature = (stat.st_mtime, stat.st_ino)
+        if entry is not None and entry[1] == signature:
+            self._entries[kid] = (now, signature, entry[2])
+            return entry[2]
+
+        crypto = _openssl()
+        try:
+            with io.open(path, 'rb') as cert_file:
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_file.read())
+        except (IOError, OSError, crypto.Error):
+            # e.g. a file being replaced: keep the previous certificate and try again at the next check
+            cert = entry[2] if entry is not None else None
+            signature = None
+        self._entries[kid] = (now, signature, cert)
+        return cert
+
+
+class WLSResponse(object):
+    """Transforms a WLS-Response (http://raven.cam.ac.uk/project/waa2wls-protocol.txt) from the
+    University of Cambridge web login service (WLS) a.k.a. Raven (http://raven.cam.ac.uk/) into an object with
+    accessible variables corresponding to the response parameters.
+
+    This class does not depend on Django: everything it needs to check the response is passed to the constructor.
+    RavenResponse builds one from a django request and the UCAMWEBAUTH_* settings."""
+
+    ver = status = msg = issue = ident = url = principal = ptags = auth = sso = life = params = kid = sig = None
+
+    STATUS = {200: 'Successful authentication',
+              410: 'The user cancelled the authentication request',
+              510: 'No mutually acceptable authentication types available',
+              520: 'Unsupported protocol version',
+              530: 'General request parameter error',
+              540: 'Interaction would be required',
+              560: 'WAA not authorised',
+              570: 'Authentication declined'}
+
+    # Default caps on the size of a response, which are checked before any parsing. Legitimate responses are far
+    # smaller: the largest fields are url and params.
+    MAX_LENGTH = 16384
+    MAX_FIELD_LENGTH = 4096
+    MAX_PARAMS = 32
+    MAX_PTAGS = 32
+
+    def __init__(self, response_str, url, keys, timeout=30, iact='', timer=None, max_length=None,
+                 max_field_length=None, max_params=None, max_ptags=None):
+        """Checks and parses a response of the Web login service (WLS) of the University of Cambridge
+        @param response_str The value of the WLS-Response parameter
+        @param url The URL that the response must have been sent to (the url of the authentication request)
+        @param keys The public keys of the WLS, an object whose get(kid) method returns a certificate or None (e.g.
+        StaticKeyStore)
+        @param timeout The time in seconds after which the response is considered timed out
+        @param iact The iact parameter of the authentication request
+        @param timer A ucamwebauth.timing.ServerTiming that records the parse, key and verify steps, or None
+        @param max_length The maximum length of response_str (default MAX_LENGTH)
+        @param max_field_length The maximum length of each (encoded) field of the response (default MAX_FIELD_LENGTH)
+        @param max_params The maximum number of parameters in params (default MAX_PARAMS)
+        @param max_ptags The maximum number of entries in ptags and in sso (default MAX_PTAGS)
+        """
+
+        # Hostile responses of any size can be sent to a public endpoint. Bound the work done on them before any
+        # tokenization.
+        if max_length is None:
+            max_length = self.MAX_LENGTH
+        if len(response_str) > max_length:
+            raise MalformedResponseError("Response is too long: %d characters, the maximum is %d" %
+                                         (len(response_str), max_length))
+
+        # The WLS sends an authentication response message as follows:  First a 'encoded response string' is formed by
+        # concatenating the values of the response fields below, in the order shown, using '!' as a separator character.
+        # If the characters '!'  or '%' appear in any
+        # field value they MUST be replaced by their %-encoded representation
+        # before concatenation.
+        # Parameters with no relevant value MUST be encoded as the empty string.
+        rawtokens = response_str.split('!')
+        if max_field_length is None:
+            max_field_length = self.MAX_FIELD_LENGTH
+        for rawtoken in rawtokens:
+            if len(rawtoken) > max_field_length:
+                raise MalformedResponseError("Response field is too long: %d characters, the maximum is %d" %
+                                             (len(rawtoken), max_field_length))
+        tokens = list(map(unquote, rawtokens))  # return a list for python3 compatibility
+
+        # ver: The version of the WLS protocol in use. May be the same as the 'ver' parameter
+        # supplied in the request
+        try:
+            self.ver = int(tokens[0])
+        except ValueError:
+            raise MalformedResponseError("Version number must be an integer, not %s" % tokens[0])
+        if not 4 > self.ver > 0:
+            raise MalformedResponseError("Unsupported version: %d" % self.ver)
+
+        if self.ver == 3:
+            versioni = 0
+        else:
+            versioni = 1
+
+        # Check that the number of parameters in the response is correct
+        if len(tokens) != (14-versioni):
+            raise MalformedResponseError("Wrong number of parameters in response: expected %d, got %d" %
+                                         ((14-versioni), len(tokens)))
+
+        # status: A three digit status code indicating the status of the authentication request. The list of possible
+        # statuses can be seen in the STATUS dict of the RavenResponse object.
+        try:
+            self.status = int(tokens[1])
+        except ValueError:
+            raise MalformedResponseError("Status code must be an integer, not %s" % tokens[1])
+
+        if self.status not in self.STATUS:
+            raise InvalidResponseError("Status returned not known")
+
+        # msg (optional): A text message further describing the status of the authentication request,
+        # suitable for display to end-user.
+        self.msg = tokens[2]
+
+        # issue: The date and time that the authentication response was created.
+        try:
+            self.issue = parse_time(tokens[3])
+        except ValueError:
+            raise MalformedResponseError("Issue time is not a valid time, got %s" % tokens[3])
+
+        # Check that the response is recent by comparing 'issue' with the current time. The WLS MUST and the WAA SHOULD
+        # have their clocks synchronised by NTP or a similar mechanism. Providing the WAA has access to an
+        # NTP-synchronised clock then allowing for a transmission time of 30-60 seconds is probably appropriate.
+        # Otherwise allowance must be made for the maximum expected clock skew.
+        if self.issue > time.time():
+            raise InvalidResponseError("The timestamp on the response is in the future")
+        if self.issue < time.time() - timeout:
+            raise InvalidResponseError("Response has timed out - issued %s, now %s" %
+                                       (time.asctime(time.gmtime(self.issue)), time.asctime()))
+
+        # ident: An identifier for this response. 'ident', combined with 'issue' provides a uid for this response.
+        self.ident = tokens[4]
+
+        if self.ident == "":
+            raise MalformedResponseError("Empty ID")
+
+        # url: The value of url supplied in the authentication request and used to form the authentication response.
+        self.url = tokens[5]
+
+        # Check that 'url' represents the resource currently being
+        # accessed.
+        if self.url != url:
+            raise InvalidResponseError("The URL in the response does not match the URL expected")
+
+        # principal: Only present if status == 200, indicates the authenticated identity of the user
+        if self.status == 200:
+            if tokens[6] != "":
+                self.principal = tokens[6]
+            else:
+                raise InvalidResponseError("The username is not present in the WLS response")
+        else:
+            if tokens[6] != "":
+                raise InvalidResponseError("The username should not be present if the status code is not 200")
+
+        # ptags (optional): A potentially empty sequence of text tokens separated by ',' indicating attributes
+        # or properties of the identified principal. Possible values of this tag are not standardised and are
+        # a matter for local definition by individual WLS operators (see note below). Web application agent (WAA)
+        # SHOULD ignore values that they do not recognise.
+        if max_ptags is None:
+            max_ptags = self.MAX_PTAGS
+        if versioni == 0:
+            if tokens[7].count(',') >= max_ptags:
+                raise MalformedResponseError("Too many ptags, the maximum is %d" % max_ptags)
+            self.ptags = tokens[7].split(',')
+
+        # auth (not-empty only if authentication was successfully established by interaction with the user):
+        # This indicates which authentication type was used. v3 only supports 'pwd'
+        self.auth = tokens[8-versioni]
+
+        # sso (not-empty only if 'auth' is empty): Authentication must have been established based on previous
+        # successful authentication interaction(s) with the user. This indicates which authentication types were used
+        # on these occasions. This value consists of a sequence of text tokens as described below, separated by ','.
+        if tokens[9-versioni].count(',') >= max_ptags:
+            raise MalformedResponseError("Too many sso authentication types, the maximum is %d" % max_ptags)
+        self.sso = tokens[9-versioni].split(',')
+
+        # life (optional): If the user has established an authenticated 'session' with the WLS, this indicates the
+        # remaining life (in seconds) of that session. If present, a WAA SHOULD use this to establish an upper limit
+        # to the lifetime of any session that it establishes.
+        # TODO limit the Django session accordingly, with SessionBase.set_expiry
+        # (https://docs.djangoproject.com/en/dev/topics/http/sessions/)
+        if tokens[10-versioni] != "":
+            try:
+                self.life = int(tokens[10-versioni])
+            except ValueError:
+                raise MalformedResponseError("Life parameter must be an integer, not %s" % tokens[10-versioni])
+
+        # params: a copy of the params parameter from the request
+        if max_params is None:
+            max_params = self.MAX_PARAMS
+        # parse_qs splits on '&' and, in older versions of python, on ';'
+        if tokens[11-versioni].count('&') + tokens[11-versioni].count(';') >= max_params:
+            raise MalformedResponseError("Too many parameters in params, the maximum is %d" % max_params)
+        try:
+            self.params = parse_qs(tokens[11-versioni])
+        except Exception:
+            raise MalformedResponseError("The params field contains wrong characters: %s" % tokens[11-versioni])
+
+        # REQUIRED to be a copy of the params parameter from the request
+        # if self.params != setting('UCAMWEBAUTH_PARAMS', default=''):
+        #     raise InvalidResponseError("The params are not equals to the request ones")
+
+        # kid (not-empty only if 'sig' is present): A string which identifies the RSA key which was used to form the
+        # signature supplied with the response. Typically these will be small integers.
+        if tokens[12-versioni] != "":
+            try:
+                self.kid = int(tokens[12-versioni])
+            except ValueError:
+                raise MalformedResponseError("kid parameter must be an integer, not %s" % tokens[12-versioni])
+
+        # sig (not-empty only if 'status' is 200): A public-key signature of the response data constructed from the
+        # entire parameter value except 'kid' and 'sig' (and their separating ':' characters) using the private key
+        # identified by 'kid', the SHA-1 hash algorithm and the 'RSASSA-PKCS1-v1_5' scheme as specified in PKCS #1 v2.1
+        # [RFC 3447] and the resulting signature encoded using the base64 scheme [RFC 1521] except that the
+        # characters '+', '/', and '=' are replaced by '-', '.' and '_' to reduce the URL-encoding overhead.
+        if tokens[13-versioni] != "":
+            if self.kid is None:
+                raise InvalidResponseError("kid must be present if signature is present")
+            self.sig = decode_sig(tokens[13-versioni])
+        else:
+            if self.status == 200:
+                raise InvalidResponseError("Signature must be present if status is 200")
+
+        if timer is not None:
+            timer.mark('parse')
+
+        # Check that 'kid', corresponds to a key/certificate present in the WAA. Is the only way to check the
+        # signature. The WAA has to use the public key/certificate made available by the WLS.
+        if (self.sig is not None) or (self.status == 200):
+            try:
+                cert = keys.get(self.kid)
+            except Exception:
+                cert = None
+            if timer is not None:
+                timer.mark('key')
+            if cert is None:
+                raise PublicKeyNotFoundError("The server do not have the public key corresponding to the key the web "
+                                             "login service signed the response with")
+
+            # Check that the signature matches the data supplied. To check this, the WAA uses the public key identified
+            # by 'kid'.
+            data = '!'.join(rawtokens[0:(12-versioni)])
+            # The data string that was signed in the WLS (everything from the  WLS-Response except 'kid' and 'sig'
+            try:
+                _openssl().verify(cert, self.sig, data.encode(), 'sha1')
+            except Exception:
+                raise InvalidResponseError("The signature for this response is not valid.")
+
+        if self.status == 200:
+
+            # Check that 'auth' and/or 'sso' contain values acceptable to the WAA. Simply setting 'aauth' and 'iact'
+            # values in an authentication request is not sufficient since an attacker could construct its own request.
+            # Conversely, the WAA MUST ensure that the values of 'aauth' and/or 'iact' in its authentication requests
+            # correctly reflect its requirement, to prevent the WLS sending it unacceptable responses.
+
+            # the authentication was successfully establish by interaction with the user
+            if self.auth != "":
+                # auth only supports 'pwd' in current version, therefore we compare it with 'pwd' only
+                # If more are supported in the future, a setting will be added to specify which ones the WAA wants to
+                # support and check that auth and sso match any element in this list.
+                if self.auth != "pwd":
+                    raise InvalidResponseError("The response used the wrong type of authentication (auth)")
+
+                if iact == 'no':
+                    # We had required a non-interactive authentication, but didn't get one
+                    raise InvalidResponseError("Non-interactive authentication required but not received")
+
+            # authentication was established on a previous interaction(s) with the user
+            else:
+                if self.sso != [""]:
+                    if self.sso != ["pwd"]:
+                        raise InvalidResponseError("The response used the wrong type of authentication (sso)")
+
+                    if iact == 'yes':
+                        # We had required an interactive authentication, but didn't get one
+                        raise InvalidResponseError("Interactive authentication required but not received")
+                else:
+                    # Both auth and sso are empty, which is not allowed
+                    raise MalformedResponseError("No authentication types supplied")
+
+        if timer is not None:
+            timer.mark('verify')
+
+    def validate(self):
+        """Returns True if this represents a successful authentication otherwise returns False."""
+        return self.status == 200
@@ -0,0 +1,41 @@
+"""Reads after writes with UCAMWEBAUTH_READ_DATABASE.
+
+A replica lags behind the primary, so a user (or their profile) read from it right after a write, e.g. the last_login
+written by the login or a change of the profile, can be stale. Every save of a User or UserProfile pins the user to
+the primary for UCAMWEBAUTH_READ_PIN_SECONDS (default 10): RavenAuthBackend reads them from the primary until then.
+The pins are kept in the UCAMWEBAUTH_READ_PIN_CACHE cache (default 'default'), so that they hold on every node that
+shares it. Writes that do not send post_save (e.g. QuerySet.update) can call pin_to_primary themselves.
+"""
+from django.core.cache import caches
+from ucamwebauth.utils import setting
+
+CACHE_PREFIX = 'ucamwebauth-primary:'
+
+
+def enabled():
+    return bool(setting('UCAMWEBAUTH_READ_DATABASE'))
+
+
+def _cache():
+    return caches[setting('UCAMWEBAUTH_READ_PIN_CACHE', default='default')]
+
+
+def pin_to_primary(user_id):
+    """Reads the user user_id and their profile from the primary for the next UCAMWEBAUTH_READ_PIN_SECONDS"""
+    _cache().set(CACHE_PREFIX + str(user_id), True, setting('UCAMWEBAUTH_READ_PIN_SECONDS', default=10))
+
+
+def is_pinned(user_id):
+    return _cache().get(CACHE_PREFIX + str(user_id)) is not None
+
+
+def user_saved(sender, instance, **kwargs):
+    """post_save receiver of the User model"""
+    if enabled():
+        pin_to_primary(instance.pk)
+
+
+def profile_saved(sender, instance, **kwargs):
+    """post_save receiver of UserProfile"""
+    if enabled():
+        pin_to_primary(instance.user_id)
@@ -0,0 +1,56 @@
+"""The Django side of the WLS response checks: RavenResponse reads the response from a request and everything needed
+to check it from the settings."""
+from ucamwebauth.utils import setting, get_return_url
+from ucamwebauth.exceptions import MalformedResponseError
+from ucamwebauth.protocol import WLSResponse, StaticKeyStore, DirectoryKeyStore
+
+# The certificates when UCAMWEBAUTH_CERTS is not set: always the same object, so that get_key_store keeps its key store
+_NO_CERTS = {}
+_key_store = StaticKeyStore(_NO_CERTS)
+
+
+def get_key_store():
+    """Returns the DirectoryKeyStore for settings.UCAMWEBAUTH_CERTS_DIR if set, or else the StaticKeyStore for
+    settings.UCAMWEBAUTH_CERTS"""
+    global _key_store
+    directory = setting('UCAMWEBAUTH_CERTS_DIR')
+    if directory is not None:
+        check_interval = setting('UCAMWEBAUTH_CERTS_CHECK_INTERVAL', 60)
+        if not isinstance(_key_store, DirectoryKeyStore) or _key_store.directory != directory or \
+                _key_store.check_interval != check_interval:
+            _key_store = DirectoryKeyStore(directory, check_interval)
+        return _key_store
+    certs = setting('UCAMWEBAUTH_CERTS', _NO_CERTS)
+    if not isinstance(_key_store, StaticKeyStore) or _key_store.certs is not certs:
+        _key_store = StaticKeyStore(certs)
+    return _key_store
+
+
+class RavenResponse(WLSResponse):
+    """Transforms a WLS-Response (http://raven.cam.ac.uk/project/waa2wls-protocol.txt) from the
+    University of Cambridge web login service (WLS) a.k.a. Raven (http://raven.cam.ac.uk/) into an object with
+    accessible variables corresponding to the response parameters"""
+
+    def __init__(self, response_req=None):
+        """Creates a RavenResponse object from the response of the Web login service (WLS) of the University of
+        Cambridge
+        @param response_req The HTTP request that contains the WLS response.
+        """
+
+        if response_req is None:
+            raise MalformedResponseError("no request supplied")
+        try:
+            response_str = response_req.GET['WLS-Response']
+        except KeyError:
+            raise MalformedResponseError("no WLS-Response")
+
+        # The request has already been checked against ALLOWED_HOSTS by Django, so the return URL built from it
+        # represents the resource currently being accessed.
+        super(RavenResponse, self).__init__(response_str, get_return_url(response_req), get_key_store(),
+                                            timeout=setting('UCAMWEBAUTH_TIMEOUT', 30),
+                                            iact=setting('UCAMWEBAUTH_IACT', ''),
+                                            timer=getattr(response_req, 'ucamwebauth_timing', None),
+                                            max_length=setting('UCAMWEBAUTH_MAX_RESPONSE_LENGTH'),
+                                            max_field_length=setting('UCAMWEBAUTH_MAX_FIELD_LENGTH'),
+                                            max_params=setting('UCAMWEBAUTH_MAX_PARAMS'),
+                                            max_ptags=setting('UCAMWEBAUTH_MAX_PTAGS'))
@@ -0,0 +1,125 @@
+"""Per-user session index.
+
+With UCAMWEBAUTH_SESSION_INDEX, the key of every session a user logs in to is recorded in RavenSession, and removed
+when the user logs out. invalidate_sessions(user) then ends all the sessions of the user, on every node sharing the
+session store, with one indexed query instead of decoding every session. It works with the database, cache and
+cached_db session engines, but not with signed cookies, which cannot be revoked on the server: invalidate_sessions
+raises ImproperlyConfigured with them. SessionIndexMiddleware follows the sessions whose key changes after the login
+(e.g. update_session_auth_hash after a password change).
+"""
+from importlib import import_module
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBSessionStore
+from django.contrib.sessions.backends.db import SessionStore as DBSessionStore
+from django.contrib.sessions.backends.signed_cookies import SessionStore as CookieSessionStore
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from ucamwebauth.models import RavenSession
+from ucamwebauth.utils import setting
+
+# Number of index entries checked against the session store at a time by prune_expired
+PRUNE_CHUNK_SIZE = 500
+
+
+def enabled():
+    return setting('UCAMWEBAUTH_SESSION_INDEX', default=False)
+
+
+def record_login(sender, request, user, **kwargs):
+    """user_logged_in receiver: records the session of request as one of the sessions of user"""
+    session = getattr(request, 'session', None)
+    # Users of RavenPrincipalBackend are not stored in the database, so their sessions cannot be indexed
+    if not enabled() or session is None or not isinstance(user, get_user_model()) or _uses_cookies():
+        return
+    if session.session_key is None:
+        # login() normally gives the session a key already
+        session.save()
+    if session.session_key is None:
+        return
+    RavenSession.objects.update_or_create(session_key=session.session_key,
+                                          defaults={'user': user, 'expire_date': session.get_expiry_date()})
+
+
+def record_logout(sender, request, user, **kwargs):
+    """user_logged_out receiver: forgets the session of request, which is about to be flushed"""
+    session = getattr(request, 'session', None)
+    if not enabled() or session is None or session.session_key is None:
+        return
+    RavenSession.objects.filter(session_key=session.session_key).delete()
+
+
+def record_rotation(old_session_key, session_key):
+    """Moves the index entry of a session whose key changed from old_session_key to session_key (None if the session
+    was flushed)"""
+    if not enabled() or old_session_key == session_key:
+        return
+    entries = RavenSession.objects.filter(session_key=old_session_key)
+    if session_key is None or RavenSession.objects.filter(session_key=session_key).exists():
+        # Flushed, or already recorded by a new login
+        entries.delete()
+    else:
+        entries.update(session_key=session_key)
+
+
+def _store_class():
+    return import_module(settings.SESSION_ENGINE).SessionStore
+
+
+def _uses_cookies():
+    return issubclass(_store_class(), CookieSessionStore)
+
+
+def _uses_database(store_class):
+    # cached_db sessions are also written to the database, which is authoritative
+    return issubclass(store_class, DBSessionStore)
+
+
+def _delete_sessions(session_keys):
+    store_class = _store_class()
+    if _uses_database(store_class) and not issubclass(store_class, CachedDBSessionStore):
+        store_class.get_model_class().objects.filter(session_key__in=session_keys).delete()
+    else:
+        # Cache based sessions are deleted one key at a time (cached_db also removes them from the database)
+        store = store_class()
+        for session_key in session_keys:
+            store.delete(session_key)
+
+
+def _live_sessions(session_keys):
+    """@return The subset of session_keys whose session still exists in the session store"""
+    store_class = _store_class()
+    if _uses_database(store_class):
+        return set(store_class.get_model_class().objects.filter(
+            session_key__in=session_keys, expire_date__gt=timezone.now()).values_list('session_key', flat=True))
+    store = store_class()
+    return set(session_key for session_key in session_keys if store.exists(session_key))
+
+
+def invalidate_sessions(user):
+    """Ends every indexed session of user.
+    @return The number of sessions ended"""
+    if _uses_cookies():
+        raise ImproperlyConfigured("Signed cookie sessions cannot be ended on the server")
+    session_keys = list(RavenSession.objects.filter(user=user).values_list('session_key', flat=True))
+    if session_keys:
+        _delete_sessions(session_keys)
+        RavenSession.objects.filter(user=user).delete()
+    return len(session_keys)
+
+
+def prune_expired():
+    """Forgets the sessions that have ended (see the clearsessions management command).
+
+    The expiry date recorded at the login only selects the candidates: sessions whose expiry slides forward
+    (SESSION_SAVE_EVERY_REQUEST, set_expiry) outlive it, so each candidate is looked up in the session store and kept
+    if it is still there.
+    @return The number of sessions forgotten"""
+    candidates = list(RavenSession.objects.filter(expire_date__lt=timezone.now()).values_list('session_key', flat=True))
+    pruned = 0
+    for start in range(0, len(candidates), PRUNE_CHUNK_SIZE):
+        chunk = candidates[start:start + PRUNE_CHUNK_SIZE]
+        ended = set(chunk) - _live_sessions(chunk)
+        if ended:
+            pruned += RavenSession.objects.filter(session_key__in=ended).delete()[0]
+    return pruned
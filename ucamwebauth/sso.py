@@ -0,0 +1,84 @@
+"""Shared SSO tickets for sibling Django sites.
+
+Sites that share a Django cache and a parent cookie domain can record each verified Raven identity in the cache, under
+a random ticket id sent to the browser in a cookie on the parent domain. raven_login on a sibling site then completes
+the login from the ticket, without the round trip to the WLS, for as long as the WLS session lasts (the 'life' of the
+WLS response).
+"""
+import re
+import time
+from django.core.cache import caches
+from django.utils.crypto import get_random_string
+from ucamwebauth.utils import setting
+
+CACHE_PREFIX = 'ucamwebauth-sso:'
+
+# Ticket ids are get_random_string(43): anything else in the cookie is not used as a cache key
+TICKET_ID_RE = re.compile(r'[a-zA-Z0-9]{43}\Z')
+
+
+def enabled():
+    return setting('UCAMWEBAUTH_SSO_CACHE') is not None
+
+
+def _cache():
+    return caches[setting('UCAMWEBAUTH_SSO_CACHE')]
+
+
+def _cookie_name():
+    return setting('UCAMWEBAUTH_SSO_COOKIE_NAME', default='ucamwebauth_sso')
+
+
+def create_ticket(raven_response):
+    """Records the identity of a verified RavenResponse in the shared cache.
+    @return (ticket id, lifetime in seconds) or (None, None) if the WLS did not report the life of its session"""
+    life = raven_response.life
+    max_age = setting('UCAMWEBAUTH_SSO_MAX_AGE')
+    if max_age is not None and (life is None or life > max_age):
+        life = max_age
+    if not life or life <= 0:
+        return None, None
+    ticket_id = get_random_string(43)
+    _cache().set(CACHE_PREFIX + ticket_id, {
+        'principal': raven_response.principal,
+        'ptags': raven_response.ptags,
+        'ver': raven_response.ver,
+        'issue': raven_response.issue,
+        'expires': time.time() + life,
+    }, life)
+    return ticket_id, life
+
+
+def _ticket_id(request):
+    """Returns the SSO ticket id of request, or None if it has none or a malformed one"""
+    ticket_id = request.COOKIES.get(_cookie_name())
+    if ticket_id is None or not TICKET_ID_RE.match(ticket_id):
+        return None
+    return ticket_id
+
+
+def get_ticket(request):
+    """Returns the identity recorded for the SSO ticket of request, or None"""
+    ticket_id = _ticket_id(request)
+    if ticket_id is None:
+        return None
+    ticket = _cache().get(CACHE_PREFIX + ticket_id)
+    if ticket is None or ticket['expires'] <= time.time():
+        return None
+    return ticket
+
+
+def delete_ticket(request):
+    """Forgets the SSO ticket of request, so that no sibling site can use it any more"""
+    ticket_id = _ticket_id(request)
+    if ticket_id is not None:
+        _cache().delete(CACHE_PREFIX + ticket_id)
+
+
+def set_cookie(request, response, ticket_id, life):
+    response.set_cookie(_cookie_name(), ticket_id, max_age=life, domain=setting('UCAMWEBAUTH_SSO_COOKIE_DOMAIN'),
+                        secure=request.is_secure(), httponly=True)
+
+
+def delete_cookie(response):
+    response.delete_cookie(_cookie_name(), domain=setting('UCAMWEBAUTH_SSO_COOKIE_DOMAIN'))
@@ -0,0 +1,19 @@
+from django import template
+from ucamwebauth.loginurl import get_login_url
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def raven_login_url(context, next_url=None):
+    """Renders the URL of an authentication request to the WLS, which sends the user back to next_url (by default, the
+    current page) after the login. Links to it skip the redirect through raven_login. The request must be in the context
+    (the django.template.context_processors.request context processor puts it there)."""
+    try:
+        request = context['request']
+    except KeyError:
+        raise template.TemplateSyntaxError("raven_login_url needs the request in the template context: enable the "
+                                           "django.template.context_processors.request context processor")
+    if next_url is None:
+        next_url = request.get_full_path()
+    return get_login_url(request, next_url)
@@ -2,28 +2,66 @@ from base64 import b64encode
 from datetime import datetime, timedelta
 from django.conf import settings
 
-from ucamwebauth.models import UserProfile
+from ucamwebauth.models import UserProfile, RavenSession
 
 try:
     from urlparse import urlparse, parse_qs
     from urllib import unquote, urlencode
+    from StringIO import StringIO
 except ImportError:
     from urllib.parse import urlparse, parse_qs, unquote, urlencode
+    from io import StringIO
+import calendar
+import json
+import logging
+import os
+import pstats
+import random
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 from OpenSSL.crypto import load_privatekey, FILETYPE_PEM, sign
 import requests
-from django.test import TestCase, RequestFactory
+import django
+from django.apps import apps
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, RequestFactory, override_settings
 from django.test.client import Client
 try:
     from django.urls import reverse
 except ImportError:
     from django.core.urlresolvers import reverse
-from django.contrib.auth.models import User
+from django.contrib.admin import AdminSite
+from django.contrib.auth import get_user, login, update_session_auth_hash
+from django.contrib.auth.models import User, AnonymousUser
+from django.contrib.messages import get_messages
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
+from django.core.paginator import EmptyPage, PageNotAnInteger
+from django.db import transaction
+from django.template import Template, TemplateSyntaxError, Context
+from django.utils import timezone
+from django.utils.html import escape
+import ucamwebauth
 from ucamwebauth import InvalidResponseError, MalformedResponseError, UserNotAuthorised, RavenResponse, \
-    PublicKeyNotFoundError
-from ucamwebauth.exceptions import OtherStatusCode
-from ucamwebauth.utils import get_next_from_wls_response, get_return_url
+    PublicKeyNotFoundError, TooManyLoginsError, admission, attributes, audit, principals, profiles, replica, \
+    sessions, sso
+from ucamwebauth.exceptions import OtherStatusCode, InvalidTokenError
+from ucamwebauth.utils import get_next_from_wls_response, get_return_url, setting, clear_settings
+from ucamwebauth.admin import CappedCountPaginator, UserProfileAdmin, RavenUserAdmin, set_raven_for_life, \
+    clear_raven_for_life
 from ucamwebauth.backends import RavenAuthBackend
+from ucamwebauth.gateway import RavenWSGIMiddleware
+from ucamwebauth.middleware import DefaultErrorBehaviour, RavenPrincipalMiddleware, SessionIndexMiddleware
+from ucamwebauth import loginurl, protocol
+from ucamwebauth.loginurl import get_login_url
+from ucamwebauth.principals import RavenUser
+from ucamwebauth.protocol import WLSResponse, StaticKeyStore, DirectoryKeyStore, build_login_url, parse_time
+from ucamwebauth.tokens import TokenSigner, verify_token
 
 RAVEN_TEST_USER = 'test0001'
 RAVEN_TEST_PWD = 'test'
@@ -439,3 +477,1487 @@ class RavenTestCase(TestCase):
             self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_ptags='')})
             profile = UserProfile.objects.get(user__username='test0001')
             self.assertTrue(profile.raven_for_life)
+
+
+class DefaultErrorBehaviourTestCase(TestCase):
+
+    def setUp(self):
+        self.middleware = DefaultErrorBehaviour()
+        self.request = RequestFactory().get(reverse('raven_return'))
+        self.request.session = SessionStore()
+        self.request._messages = FallbackStorage(self.request)
+        self.request.user = AnonymousUser()
+
+    def test_status_codes(self):
+        for exception, status_code in ((MalformedResponseError("malformed"), 500),
+                                       (InvalidResponseError("invalid"), 500),
+                                       (PublicKeyNotFoundError("no key"), 500),
+                                       (OtherStatusCode("other"), 500),
+                                       (UserNotAuthorised("not authorised"), 403)):
+            response = self.middleware.process_exception(self.request, exception)
+            self.assertContains(response, str(exception), status_code=status_code)
+
+    def test_subclasses_are_handled(self):
+        class CustomError(UserNotAuthorised):
+            pass
+        response = self.middleware.process_exception(self.request, CustomError("custom"))
+        self.assertContains(response, "custom", status_code=403)
+
+    def test_other_exceptions_are_ignored(self):
+        self.assertIsNone(self.middleware.process_exception(self.request, ValueError("other")))
+        self.assertIsNone(self.middleware.process_exception(self.request, ValueError("other")))
+
+    def test_messages_for_anonymous(self):
+        self.middleware.process_exception(self.request, MalformedResponseError("malformed"))
+        self.assertEqual([str(m) for m in get_messages(self.request)], ["malformed"])
+
+    def test_no_messages_for_anonymous(self):
+        with self.settings(UCAMWEBAUTH_ERROR_MESSAGES_FOR_ANONYMOUS=False):
+            response = self.middleware.process_exception(self.request, MalformedResponseError("malformed"))
+        self.assertContains(response, "malformed", status_code=500)
+        self.assertEqual(len(get_messages(self.request)), 0)
+
+    def test_messages_for_authenticated(self):
+        self.request.user = User.objects.create(username=RAVEN_NEW_USER)
+        with self.settings(UCAMWEBAUTH_ERROR_MESSAGES_FOR_ANONYMOUS=False):
+            self.middleware.process_exception(self.request, MalformedResponseError("malformed"))
+        self.assertEqual([str(m) for m in get_messages(self.request)], ["malformed"])
+
+    def test_new_style_middleware(self):
+        with self.settings(MIDDLEWARE=list(settings.MIDDLEWARE) + ['ucamwebauth.middleware.DefaultErrorBehaviour']):
+            response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_ver='9')})
+        self.assertContains(response, "Unsupported version: 9", status_code=500)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.append(threading.current_thread())
+
+
+class AuditTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.handler = ListHandler()
+        audit.logger.addHandler(self.handler)
+        audit.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        audit.logger.removeHandler(self.handler)
+        audit.logger.setLevel(logging.NOTSET)
+
+    def events(self):
+        audit.flush()
+        return [record.auth_event for record in self.handler.records]
+
+    def test_success_event(self):
+        self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()}, REMOTE_ADDR='10.0.0.1')
+        event = self.events()[0]
+        self.assertEqual(event['event'], audit.SUCCESS)
+        self.assertEqual(event['principal'], RAVEN_TEST_USER)
+        self.assertEqual(event['kid'], 901)
+        self.assertEqual(event['ip'], '10.0.0.1')
+        self.assertIsNone(event['failure'])
+        self.assertTrue(0 <= event['age'] < 60)
+
+    def test_failure_event(self):
+        with self.assertRaises(InvalidResponseError):
+            self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_status='100')})
+        event = self.events()[0]
+        self.assertEqual(event['event'], audit.FAILURE)
+        self.assertEqual(event['failure'], 'InvalidResponseError')
+        self.assertEqual(event['error'], 'Status returned not known')
+        self.assertEqual(self.handler.records[0].levelno, logging.ERROR)
+
+    def test_not_authorised_event(self):
+        with self.assertRaises(UserNotAuthorised):
+            self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_ptags='')})
+        event = self.events()[0]
+        self.assertEqual(event['failure'], 'UserNotAuthorised')
+        self.assertEqual(event['principal'], RAVEN_TEST_USER)
+
+    def test_sampling(self):
+        with self.settings(UCAMWEBAUTH_AUDIT_SAMPLE_RATES={'failure': 0, 'InvalidResponseError': 1}):
+            audit.auth_event(audit.FAILURE, exception=MalformedResponseError("malformed"))
+            audit.auth_event(audit.FAILURE, exception=InvalidResponseError("invalid"))
+            audit.auth_event(audit.SUCCESS, principal=RAVEN_TEST_USER)
+        self.assertEqual([(e['event'], e['failure']) for e in self.events()],
+                         [(audit.FAILURE, 'InvalidResponseError'), (audit.SUCCESS, None)])
+
+    def test_rate_limits(self):
+        with self.settings(UCAMWEBAUTH_AUDIT_RATE_LIMITS={'failure': 5}):
+            for _ in range(20):
+                audit.auth_event(audit.FAILURE, exception=MalformedResponseError("malformed"))
+            for _ in range(20):
+                audit.auth_event(audit.SUCCESS, principal=RAVEN_TEST_USER)
+        events = self.events()
+        self.assertEqual(len([e for e in events if e['event'] == audit.FAILURE]), 5)
+        self.assertEqual(len([e for e in events if e['event'] == audit.SUCCESS]), 20)
+
+    def test_async_handler(self):
+        target = ListHandler()
+        handler = audit.AsyncAuditHandler(target=target)
+        audit.logger.addHandler(handler)
+        try:
+            audit.auth_event(audit.SUCCESS, principal=RAVEN_TEST_USER)
+            audit.flush()
+        finally:
+            audit.logger.removeHandler(handler)
+            handler.close()
+        self.assertEqual([r.auth_event['principal'] for r in target.records], [RAVEN_TEST_USER])
+        self.assertEqual(target.records[0].getMessage(), "Raven authentication success for test0001")
+
+    def test_async_handler_full_queue(self):
+        handler = audit.AsyncAuditHandler(target=ListHandler(), maxsize=1)
+        handler.listener.stop()
+        handler.listener = None
+        for _ in range(3):
+            handler.handle(logging.makeLogRecord({'msg': 'event'}))
+        self.assertEqual(handler.dropped, 2)
+        handler.close()
+
+    def test_background_thread(self):
+        audit.auth_event(audit.SUCCESS, principal=RAVEN_TEST_USER)
+        self.assertEqual(len(self.events()), 1)
+        self.assertNotEqual(self.handler.threads[0], threading.current_thread())
+        with self.settings(UCAMWEBAUTH_AUDIT_ASYNC=False):
+            audit.auth_event(audit.SUCCESS, principal=RAVEN_TEST_USER)
+        self.assertEqual(len(self.handler.records), 2)
+        self.assertEqual(self.handler.threads[1], threading.current_thread())
+
+    def test_legacy_logger(self):
+        handler = ListHandler()
+        audit.legacy_logger.addHandler(handler)
+        try:
+            audit.auth_event(audit.FAILURE, exception=MalformedResponseError("malformed"))
+            audit.auth_event(audit.SUCCESS, principal=RAVEN_TEST_USER)
+            audit.flush()
+        finally:
+            audit.legacy_logger.removeHandler(handler)
+        self.assertEqual([record.getMessage() for record in handler.records], ["MalformedResponseError: malformed"])
+
+    def test_legacy_logger_without_audit(self):
+        handler = ListHandler()
+        audit.legacy_logger.addHandler(handler)
+        audit.logger.setLevel(logging.CRITICAL)
+        try:
+            with self.settings(UCAMWEBAUTH_AUDIT_SAMPLE_RATES={'failure': 0}):
+                audit.auth_event(audit.FAILURE, exception=MalformedResponseError("malformed"))
+            audit.logger.setLevel(logging.INFO)
+            with self.settings(UCAMWEBAUTH_AUDIT_SAMPLE_RATES={'failure': 0}):
+                audit.auth_event(audit.FAILURE, exception=InvalidResponseError("invalid"))
+            audit.flush()
+        finally:
+            audit.legacy_logger.removeHandler(handler)
+        self.assertEqual([record.getMessage() for record in handler.records],
+                         ["MalformedResponseError: malformed", "InvalidResponseError: invalid"])
+        self.assertEqual(self.events(), [])
+
+
+class TokenTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def test_sign_and_verify(self):
+        signer = TokenSigner('secret')
+        token = signer.sign(RAVEN_TEST_USER, ['current'], 1500000000)
+        identity = verify_token(token, 'secret')
+        self.assertEqual(identity['principal'], RAVEN_TEST_USER)
+        self.assertEqual(identity['ptags'], ['current'])
+        self.assertEqual(identity['issue'], 1500000000)
+
+    def test_bad_signature(self):
+        token = TokenSigner('secret').sign(RAVEN_TEST_USER)
+        with self.assertRaises(InvalidTokenError):
+            verify_token(token, 'other secret')
+        signature = token.split('.')[1]
+        forged = TokenSigner('secret').sign('test0002').split('.')[0]
+        with self.assertRaises(InvalidTokenError):
+            verify_token(forged + '.' + signature, 'secret')
+        with self.assertRaises(InvalidTokenError):
+            verify_token('garbage', 'secret')
+        with self.assertRaises(InvalidTokenError):
+            verify_token(u'é.é', 'secret')
+
+    def test_expired(self):
+        token = TokenSigner('secret').sign(RAVEN_TEST_USER, ttl=-1)
+        with self.assertRaises(InvalidTokenError) as excep:
+            verify_token(token, 'secret')
+        self.assertEqual(str(excep.exception), "Token has expired")
+
+    def test_token_view_disabled(self):
+        self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        self.assertEqual(self.client.get(reverse('raven_token')).status_code, 404)
+
+    def test_token_view(self):
+        with self.settings(UCAMWEBAUTH_TOKEN_KEY='secret', UCAMWEBAUTH_TOKEN_TTL=60):
+            self.assertEqual(self.client.get(reverse('raven_token')).status_code, 403)
+            self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+            response = self.client.get(reverse('raven_token'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['expires_in'], 60)
+        identity = verify_token(response.json()['token'], 'secret')
+        self.assertEqual(identity['principal'], RAVEN_TEST_USER)
+        self.assertEqual(identity['ptags'], ['current'])
+
+
+@override_settings(UCAMWEBAUTH_SSO_CACHE='default', UCAMWEBAUTH_SSO_COOKIE_DOMAIN='.example.com')
+class SSOTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def login_sibling(self):
+        response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        cookie = response.cookies['ucamwebauth_sso']
+        self.assertEqual(cookie['domain'], '.example.com')
+        self.assertEqual(cookie['max-age'], 36000)
+        sibling = Client()
+        sibling.cookies['ucamwebauth_sso'] = cookie.value
+        return sibling
+
+    def test_sibling_login(self):
+        sibling = self.login_sibling()
+        response = sibling.get(reverse('raven_login'), {'next': '/somewhere/'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], '/somewhere/')
+        self.assertIn('_auth_user_id', sibling.session)
+
+    @override_settings(UCAMWEBAUTH_MAX_CONCURRENT_LOGINS=1)
+    def test_sibling_login_admission(self):
+        sibling = self.login_sibling()
+        self.addCleanup(setattr, admission, 'controller', admission.controller)
+        controller = admission.controller = admission.AdmissionController()
+        ticket = controller.acquire()
+        with self.assertRaises(TooManyLoginsError):
+            sibling.get(reverse('raven_login'))
+        self.assertNotIn('_auth_user_id', sibling.session)
+        controller.release(ticket)
+        self.assertEqual(sibling.get(reverse('raven_login')).status_code, 302)
+        self.assertEqual(controller.stats(), {'in_flight': 0, 'peak': 1, 'admitted': 2, 'shed': 1})
+
+    def test_logout_deletes_ticket(self):
+        sibling = self.login_sibling()
+        self.client.get(reverse('raven_logout'))
+        response = sibling.get(reverse('raven_login'))
+        self.assertEqual(response.status_code, 303)
+        self.assertNotIn('_auth_user_id', sibling.session)
+
+    def test_interactive_authentication(self):
+        sibling = self.login_sibling()
+        with self.settings(UCAMWEBAUTH_IACT='yes'):
+            response = sibling.get(reverse('raven_login'))
+        self.assertEqual(response.status_code, 303)
+
+    def test_unknown_ticket(self):
+        self.client.cookies['ucamwebauth_sso'] = 'unknown'
+        self.assertEqual(self.client.get(reverse('raven_login')).status_code, 303)
+
+    def test_no_life(self):
+        response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_life='')})
+        self.assertNotIn('ucamwebauth_sso', response.cookies)
+
+    def test_max_age(self):
+        with self.settings(UCAMWEBAUTH_SSO_MAX_AGE=600):
+            response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        self.assertEqual(response.cookies['ucamwebauth_sso']['max-age'], 600)
+
+    def test_offsite_next(self):
+        for next_url in ('http://evil.example/', '//evil.example/', 'javascript:alert(1)'):
+            sibling = self.login_sibling()
+            response = sibling.get(reverse('raven_login'), {'next': next_url})
+            self.assertEqual(response['Location'], '/')
+        with self.settings(UCAMWEBAUTH_REDIRECT_AFTER_LOGIN='/home/'):
+            response = self.login_sibling().get(reverse('raven_login'), {'next': 'http://evil.example/'})
+        self.assertEqual(response['Location'], '/home/')
+        response = self.login_sibling().get(reverse('raven_login'), {'next': 'http://testserver/here/'})
+        self.assertEqual(response['Location'], 'http://testserver/here/')
+
+    def test_malformed_ticket_id(self):
+        for ticket_id in ('x' * 1000, 'a' * 42 + '\u00e9', 'a b' * 15):
+            request = RequestFactory().get(reverse('raven_login'))
+            request.COOKIES['ucamwebauth_sso'] = ticket_id
+            self.assertIsNone(sso.get_ticket(request))
+
+    def test_sibling_identity_token(self):
+        with self.settings(UCAMWEBAUTH_TOKEN_KEY='secret'):
+            sibling = self.login_sibling()
+            sibling.get(reverse('raven_login'))
+            response = sibling.get(reverse('raven_token'))
+        self.assertEqual(response.status_code, 200)
+        identity = verify_token(response.json()['token'], 'secret')
+        self.assertEqual(identity['principal'], RAVEN_TEST_USER)
+        self.assertEqual(identity['ptags'], ['current'])
+
+
+class GatewayTestCase(TestCase):
+    return_url = 'http://gateway.example/files/raven_return/'
+
+    def setUp(self):
+        self.calls = []
+
+        def app(environ, start_response):
+            self.calls.append(environ)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'file']
+
+        self.middleware = RavenWSGIMiddleware(app, login_url=settings.UCAMWEBAUTH_LOGIN_URL,
+                                              certs=settings.UCAMWEBAUTH_CERTS, secret_key='secret',
+                                              allowed_hosts=['gateway.example'])
+
+    def call(self, path, query_string='', cookie=None, host='gateway.example'):
+        environ = {'wsgi.url_scheme': 'http', 'HTTP_HOST': host, 'SCRIPT_NAME': '/files',
+                   'PATH_INFO': path, 'QUERY_STRING': query_string}
+        if cookie is not None:
+            environ['HTTP_COOKIE'] = cookie
+        result = {}
+
+        def start_response(status, headers):
+            result['status'] = status
+            result['headers'] = headers
+
+        result['body'] = b''.join(self.middleware(environ, start_response))
+        return result
+
+    def test_login_redirect(self):
+        result = self.call('/report.pdf', 'v=1')
+        self.assertEqual(result['status'], '303 See Other')
+        location = dict(result['headers'])['Location']
+        self.assertTrue(location.startswith(settings.UCAMWEBAUTH_LOGIN_URL + '?'))
+        query = parse_qs(urlparse(location).query)
+        self.assertEqual(query['url'], [self.return_url])
+        self.assertEqual(parse_qs(query['params'][0])['next'], ['/files/report.pdf?v=1'])
+        self.assertEqual(self.calls, [])
+
+    def test_return_and_cookie(self):
+        wls_response = create_wls_response(raven_url=self.return_url,
+                                           raven_params='next=/files/report.pdf')
+        result = self.call('/raven_return/', urlencode({'WLS-Response': wls_response}))
+        self.assertEqual(result['status'], '303 See Other')
+        headers = dict(result['headers'])
+        self.assertEqual(headers['Location'], '/files/report.pdf')
+        cookie = headers['Set-Cookie'].split(';')[0]
+
+        result = self.call('/report.pdf', cookie=cookie)
+        self.assertEqual(result['status'], '200 OK')
+        self.assertEqual(result['body'], b'file')
+        self.assertEqual(self.calls[0]['REMOTE_USER'], RAVEN_TEST_USER)
+        self.assertEqual(self.calls[0]['ucamwebauth.identity']['ptags'], ['current'])
+
+    def test_offsite_next(self):
+        wls_response = create_wls_response(raven_url=self.return_url,
+                                           raven_params='next=//evil.example/')
+        result = self.call('/raven_return/', urlencode({'WLS-Response': wls_response}))
+        self.assertEqual(dict(result['headers'])['Location'], '/files/')
+
+    def test_bad_responses(self):
+        result = self.call('/raven_return/', urlencode({'WLS-Response': create_wls_response(
+            raven_url=self.return_url, raven_key_pem=BAD_PRIV_KEY_PEM)}))
+        self.assertEqual(result['status'], '500 Internal Server Error')
+        self.assertEqual(result['body'], b'The signature for this response is not valid.')
+        result = self.call('/raven_return/', urlencode({'WLS-Response': create_wls_response(
+            raven_url=self.return_url, raven_ptags='')}))
+        self.assertEqual(result['status'], '403 Forbidden')
+        self.assertEqual(self.call('/raven_return/')['status'], '500 Internal Server Error')
+
+    def test_foreign_host(self):
+        """A response issued to another Raven site is not accepted when sent with the Host of that site"""
+        wls_response = create_wls_response(raven_url='http://evil.example/files/raven_return/')
+        result = self.call('/raven_return/', urlencode({'WLS-Response': wls_response}), host='evil.example')
+        self.assertEqual(result['status'], '400 Bad Request')
+        self.assertNotIn('Set-Cookie', dict(result['headers']))
+        self.assertEqual(self.call('/report.pdf', host='evil.example')['status'], '400 Bad Request')
+        self.assertEqual(self.call('/report.pdf', host='GATEWAY.example:8080')['status'], '303 See Other')
+
+    def test_return_url(self):
+        self.middleware.gateway.return_url = self.return_url
+        wls_response = create_wls_response(raven_url='http://evil.example/files/raven_return/')
+        result = self.call('/raven_return/', urlencode({'WLS-Response': wls_response}), host='evil.example')
+        self.assertEqual(result['status'], '500 Internal Server Error')
+        self.assertNotIn('Set-Cookie', dict(result['headers']))
+        with self.assertRaises(ValueError):
+            RavenWSGIMiddleware(None, login_url=settings.UCAMWEBAUTH_LOGIN_URL, certs=settings.UCAMWEBAUTH_CERTS,
+                                secret_key='secret')
+
+    def test_bad_cookie(self):
+        self.assertEqual(self.call('/report.pdf', cookie='ucamwebauth_identity=forged')['status'], '303 See Other')
+        forged = TokenSigner('other secret').sign(RAVEN_TEST_USER)
+        self.assertEqual(self.call('/report.pdf', cookie='ucamwebauth_identity=' + forged)['status'], '303 See Other')
+
+    def test_asgi(self):
+        import asyncio
+        from ucamwebauth.gateway import RavenASGIMiddleware
+        scopes = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+
+        middleware = RavenASGIMiddleware(app, login_url=settings.UCAMWEBAUTH_LOGIN_URL,
+                                         certs=settings.UCAMWEBAUTH_CERTS, secret_key='secret',
+                                         allowed_hosts=['gateway.example'])
+
+        def call(path, query_string=b'', cookie=None):
+            headers = [(b'host', b'gateway.example')]
+            if cookie is not None:
+                headers.append((b'cookie', cookie.encode()))
+            scope = {'type': 'http', 'scheme': 'http', 'root_path': '/files', 'path': path,
+                     'query_string': query_string, 'headers': headers}
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            asyncio.run(middleware(scope, None, send))
+            return sent
+
+        sent = call('/report.pdf')
+        self.assertEqual(sent[0]['status'], 303)
+        wls_response = create_wls_response(raven_url=self.return_url)
+        sent = call('/raven_return/', urlencode({'WLS-Response': wls_response}).encode())
+        headers = dict(sent[0]['headers'])
+        self.assertEqual(headers[b'location'], b'/files/')
+        call('/report.pdf', cookie=headers[b'set-cookie'].decode().split(';')[0])
+        self.assertEqual(scopes[0]['ucamwebauth.identity']['principal'], RAVEN_TEST_USER)
+
+
+class ImportTestCase(SimpleTestCase):
+
+    def test_import_is_light(self):
+        """Importing the package, the parser, the tokens or the gateway must load neither Django nor pyOpenSSL"""
+        code = ("import sys\n"
+                "import ucamwebauth, ucamwebauth.protocol, ucamwebauth.tokens, ucamwebauth.gateway\n"
+                "from ucamwebauth import MalformedResponseError\n"
+                "print(' '.join(m for m in sys.modules if m.split('.')[0] in ('django', 'OpenSSL')))\n")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(ucamwebauth.__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root,
+                                         env=dict(os.environ, PYTHONPATH=root, DJANGO_SETTINGS_MODULE=''))
+        self.assertEqual(output.strip(), b'')
+
+    def test_lazy_attributes(self):
+        self.assertIs(ucamwebauth.RavenResponse, RavenResponse)
+        self.assertIs(ucamwebauth.WLSResponse, WLSResponse)
+        with self.assertRaises(AttributeError):
+            ucamwebauth.DoesNotExist
+
+    def test_default_app_config(self):
+        # Django >= 3.2 finds the AppConfig by itself and warns about default_app_config
+        self.assertEqual(hasattr(ucamwebauth, 'default_app_config'), django.VERSION < (3, 2))
+        self.assertEqual(apps.get_app_config('ucamwebauth').__class__.__name__, 'UcamWebauthConfig')
+
+
+class ServerTimingTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def test_server_timing(self):
+        with self.settings(UCAMWEBAUTH_SERVER_TIMING=True):
+            response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        entries = [entry.split(';') for entry in response['Server-Timing'].split(', ')]
+        self.assertEqual([name for name, _ in entries], ['parse', 'key', 'verify', 'provision', 'login'])
+        for _, duration in entries:
+            self.assertTrue(duration.startswith('dur='))
+            self.assertTrue(float(duration[4:]) >= 0)
+
+    def test_disabled(self):
+        response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class ParserFuzzTestCase(SimpleTestCase):
+    """Adversarial WLS responses must be rejected with one of our exceptions, at a cost linear in their size and
+    bounded by the size caps"""
+    url = 'http://testserver/raven_return/'
+    alphabet = '!%,&;=_-.0123456789abcdefABCDEF '
+    exceptions = (MalformedResponseError, InvalidResponseError, PublicKeyNotFoundError)
+
+    def parse(self, response_str, **kwargs):
+        try:
+            WLSResponse(response_str, self.url, StaticKeyStore(settings.UCAMWEBAUTH_CERTS), **kwargs)
+        except self.exceptions:
+            pass
+
+    def random_field(self, rng, length):
+        return ''.join(rng.choice(self.alphabet) for _ in range(length))
+
+    def test_random_responses(self):
+        rng = random.Random(1234)
+        valid = create_wls_response(raven_url=self.url).split('!')
+        for _ in range(2000):
+            if rng.random() < 0.2:
+                response_str = self.random_field(rng, rng.randint(0, 200))
+            else:
+                # Keep most of a valid response so that the parser gets past the first checks
+                fields = list(valid)
+                for _ in range(rng.randint(1, 3)):
+                    fields[rng.randrange(len(fields))] = self.random_field(rng, rng.randint(0, 50))
+                response_str = '!'.join(fields)
+            self.parse(response_str)
+
+    def test_size_caps(self):
+        valid = create_wls_response(raven_url=self.url).split('!')
+        for index, value, kwargs in ((5, 'x' * 5000, {}),
+                                     (7, ',' * 40, {}),
+                                     (9, ',' * 40, {}),
+                                     (11, '&' * 40, {}),
+                                     (11, 'a=b&' * 5, {'max_params': 4})):
+            fields = list(valid)
+            fields[index] = value
+            with self.assertRaises(MalformedResponseError) as excep:
+                WLSResponse('!'.join(fields), self.url, StaticKeyStore(settings.UCAMWEBAUTH_CERTS), **kwargs)
+            self.assertIn('too', str(excep.exception).lower())
+        with self.assertRaises(MalformedResponseError) as excep:
+            WLSResponse('!' * 20000, self.url, StaticKeyStore({}))
+        self.assertEqual(str(excep.exception), "Response is too long: 20000 characters, the maximum is 16384")
+
+    def count_work(self):
+        """Records the length of every string that WLSResponse unquotes or parses with parse_qs"""
+        work = {'unquote': [], 'parse_qs': []}
+        for name in work:
+            function = getattr(protocol, name)
+
+            def counting(value, _function=function, _calls=work[name]):
+                _calls.append(len(value))
+                return _function(value)
+            setattr(protocol, name, counting)
+            self.addCleanup(setattr, protocol, name, function)
+        return work
+
+    def test_bounded_work(self):
+        work = self.count_work()
+        # Oversized responses and fields, and too many ptags or params, are rejected before they are unquoted or parsed
+        valid = create_wls_response(raven_url=self.url).split('!')
+        responses = ['%21!' * 2500000]
+        for index, value in ((2, '%21' * 2000), (7, ',current' * 40), (11, '&a=b' * 40)):
+            fields = list(valid)
+            fields[index] = value
+            responses.append('!'.join(fields))
+        for response_str in responses:
+            with self.assertRaises(MalformedResponseError):
+                WLSResponse(response_str, self.url, StaticKeyStore(settings.UCAMWEBAUTH_CERTS))
+        self.assertEqual(work['parse_qs'], [])
+        # Only the responses with too many ptags or params got as far as unquoting their fields (once each)
+        self.assertEqual(len(work['unquote']), 2 * len(valid))
+
+        # Below the caps, each field is unquoted once and params is parsed once, so the work is linear in the size
+        # of the response
+        del work['unquote'][:]
+        unlimited = {'max_length': 10 ** 8, 'max_field_length': 10 ** 8, 'max_params': 10 ** 8, 'max_ptags': 10 ** 8}
+        fields = list(valid)
+        fields[11] = '&a=b' * 10000
+        response_str = '!'.join(fields)
+        self.parse(response_str, **unlimited)
+        self.assertEqual(sorted(work['unquote']), sorted(len(field) for field in fields))
+        self.assertEqual(work['parse_qs'], [len(fields[11])])
+
+
+def status_feed():
+    return iter([(RAVEN_TEST_USER, False), (RAVEN_NEW_USER, True)])
+
+
+def broken_status_feed():
+    yield RAVEN_TEST_USER, False
+    yield RAVEN_NEW_USER, True
+    raise CommandError("feed interrupted")
+
+
+class SyncRavenForLifeTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.current = User.objects.create(username=RAVEN_NEW_USER)
+        UserProfile.objects.create(user=self.current, raven_for_life=True)
+        User.objects.create(username=RAVEN_FORLIVE_USER)
+        # test0001 has no profile yet
+
+    def sync(self, lines, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as feed:
+            feed.write(lines)
+        self.addCleanup(os.unlink, feed.name)
+        out = StringIO()
+        call_command('sync_raven_for_life', feed.name, *args, stdout=out)
+        return out.getvalue()
+
+    def flags(self):
+        return dict(UserProfile.objects.values_list('user__username', 'raven_for_life'))
+
+    def test_sync(self):
+        output = self.sync("test0001,not-current\n# comment\ntest0002,current\ntest0500,current\nunknown,current\n",
+                           '--chunk-size', '2')
+        self.assertEqual(self.flags(), {RAVEN_TEST_USER: True, RAVEN_NEW_USER: False, RAVEN_FORLIVE_USER: False})
+        self.assertTrue(output.startswith("4 records, 1 profiles updated, 2 profiles created"))
+        self.assertIn("rows/s", output)
+
+    def test_no_changes(self):
+        with self.assertNumQueries(1):
+            output = self.sync("test0002,not-current\n")
+        self.assertTrue(output.startswith("1 records, 0 profiles updated, 0 profiles created"))
+        # The savepoint of --atomic (within the transaction of the test)
+        with self.assertNumQueries(3):
+            output = self.sync("test0002,not-current\n", '--atomic')
+        self.assertTrue(output.startswith("1 records, 0 profiles updated, 0 profiles created"))
+
+    def test_dry_run(self):
+        self.sync("test0001,not-current\ntest0002,current\n", '--dry-run')
+        self.assertEqual(self.flags(), {RAVEN_NEW_USER: True})
+
+    def test_bad_feed(self):
+        with self.assertRaises(CommandError):
+            self.sync("test0001,maybe\n")
+
+    def test_bad_feed_after_first_chunk(self):
+        with self.assertRaises(CommandError):
+            self.sync("test0001,not-current\ntest0002,current\ntest0500,maybe\n", '--chunk-size', '1')
+        self.assertEqual(self.flags(), {RAVEN_NEW_USER: True})
+
+    def test_bad_feed_read_first(self):
+        """Without --atomic, the feed is read before the first chunk is committed"""
+        with self.settings(UCAMWEBAUTH_STATUS_FEED='ucamwebauth.tests.broken_status_feed'):
+            with self.assertNumQueries(0):
+                with self.assertRaises(CommandError):
+                    call_command('sync_raven_for_life', '--chunk-size', '1', stdout=StringIO())
+            with self.assertRaises(CommandError):
+                call_command('sync_raven_for_life', '--chunk-size', '1', '--atomic', stdout=StringIO())
+        self.assertEqual(self.flags(), {RAVEN_NEW_USER: True})
+
+    def test_atomic(self):
+        output = self.sync("test0001,not-current\ntest0002,current\n", '--chunk-size', '1', '--atomic')
+        self.assertEqual(self.flags(), {RAVEN_TEST_USER: True, RAVEN_NEW_USER: False})
+        self.assertTrue(output.startswith("2 records, 1 profiles updated, 1 profiles created"))
+
+    def test_feed_setting(self):
+        with self.settings(UCAMWEBAUTH_STATUS_FEED='ucamwebauth.tests.status_feed'):
+            call_command('sync_raven_for_life', stdout=StringIO())
+        self.assertEqual(self.flags(), {RAVEN_TEST_USER: True, RAVEN_NEW_USER: False})
+
+
+class DeferredProfileTestCase(TransactionTestCase):
+    # on_commit callbacks never run inside the transaction of a TestCase
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username=RAVEN_TEST_USER)
+        self.writer = profiles.ProfileWriter(maxsize=1, background=False)
+        self.addCleanup(setattr, profiles, '_writer', profiles._writer)
+        profiles._writer = self.writer
+
+    def test_deferred_login(self):
+        with self.settings(UCAMWEBAUTH_DEFER_PROFILE_UPDATES=True):
+            with self.assertNumQueries(1):
+                user = RavenAuthBackend().authenticate(raven_ticket={'principal': RAVEN_TEST_USER, 'ver': 3,
+                                                                     'ptags': ['current']})
+        self.assertEqual(user, self.user)
+        self.assertFalse(UserProfile.objects.exists())
+        self.assertEqual(self.writer.pending, {self.user.pk: {'raven_for_life': False}})
+        self.writer.flush()
+        self.assertFalse(UserProfile.objects.get(user=self.user).raven_for_life)
+
+    def test_coalesce(self):
+        self.writer.submit(self.user.pk, raven_for_life=True)
+        self.writer.submit(self.user.pk, raven_for_life=False)
+        self.writer.submit(self.user.pk, raven_for_life=True)
+        self.assertEqual(self.writer.queue.qsize(), 1)
+        self.writer.flush()
+        self.assertTrue(UserProfile.objects.get(user=self.user).raven_for_life)
+        # The queued user id is a no-op once flushed
+        self.writer.write(self.writer.queue.get_nowait())
+        self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_back_pressure(self):
+        other = User.objects.create(username=RAVEN_NEW_USER)
+        self.writer.submit(self.user.pk, raven_for_life=True)
+        # The queue is full, so the update is written synchronously
+        self.writer.submit(other.pk, raven_for_life=True)
+        self.assertEqual(list(self.writer.pending), [self.user.pk])
+        self.assertTrue(UserProfile.objects.get(user=other).raven_for_life)
+
+    def test_get_profile(self):
+        UserProfile.objects.create(user=self.user, raven_for_life=False)
+        self.writer.submit(self.user.pk, raven_for_life=True)
+        self.assertTrue(profiles.get_profile(self.user).raven_for_life)
+        self.assertEqual(self.writer.pending, {})
+
+    def test_get_profile_before_commit(self):
+        UserProfile.objects.create(user=self.user, raven_for_life=False)
+        with transaction.atomic():
+            profiles.defer_update(self.user, raven_for_life=True)
+            self.assertTrue(profiles.get_profile(self.user).raven_for_life)
+        self.assertEqual(self.writer.pending, {self.user.pk: {'raven_for_life': True}})
+        self.writer.flush()
+        self.assertTrue(UserProfile.objects.get(user=self.user).raven_for_life)
+
+    def test_get_profile_rolled_back(self):
+        UserProfile.objects.create(user=self.user, raven_for_life=False)
+        with transaction.atomic():
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    profiles.defer_update(self.user, raven_for_life=True)
+                    raise ValueError
+            self.assertFalse(profiles.get_profile(self.user).raven_for_life)
+        self.assertEqual(self.writer.pending, {})
+
+    def test_get_profile_after_rollback(self):
+        UserProfile.objects.create(user=self.user, raven_for_life=False)
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                profiles.defer_update(self.user, raven_for_life=True)
+                raise ValueError
+        with transaction.atomic():
+            self.assertEqual(profiles.uncommitted_fields(self.user.pk), {})
+            self.assertFalse(profiles.get_profile(self.user).raven_for_life)
+        self.assertEqual(self.writer.pending, {})
+
+    def test_committed_updates_forgotten(self):
+        with transaction.atomic():
+            profiles.defer_update(self.user, raven_for_life=True)
+            self.assertEqual(profiles.uncommitted_fields(self.user.pk), {'raven_for_life': True})
+        self.assertEqual(profiles._uncommitted.__dict__['default'], [])
+        with transaction.atomic():
+            self.assertEqual(profiles.uncommitted_fields(self.user.pk), {})
+
+    def test_background_thread(self):
+        writer = profiles.ProfileWriter()
+        writer.submit(self.user.pk, raven_for_life=True)
+        writer.stop()
+        self.assertTrue(UserProfile.objects.get(user=self.user).raven_for_life)
+
+
+@override_settings(UCAMWEBAUTH_SESSION_INDEX=True)
+class SessionIndexTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username=RAVEN_TEST_USER)
+
+    def login(self):
+        client = Client()
+        client.force_login(self.user)
+        return client
+
+    def assertLoggedIn(self, client, logged_in=True):
+        request = RequestFactory().get('/')
+        request.session = client.session
+        self.assertEqual(get_user(request).is_authenticated, logged_in)
+
+    def test_index(self):
+        first, second = self.login(), self.login()
+        self.assertEqual(set(RavenSession.objects.values_list('session_key', flat=True)),
+                         {first.session.session_key, second.session.session_key})
+        first.logout()
+        self.assertEqual(list(RavenSession.objects.values_list('session_key', flat=True)),
+                         [second.session.session_key])
+
+    def test_disabled(self):
+        with self.settings(UCAMWEBAUTH_SESSION_INDEX=False):
+            self.login()
+        self.assertFalse(RavenSession.objects.exists())
+
+    def test_invalidate(self):
+        first, second = self.login(), self.login()
+        other = Client()
+        other.force_login(User.objects.create(username=RAVEN_NEW_USER))
+        with self.assertNumQueries(3):
+            self.assertEqual(sessions.invalidate_sessions(self.user), 2)
+        self.assertLoggedIn(first, False)
+        self.assertLoggedIn(second, False)
+        self.assertLoggedIn(other)
+        self.assertEqual(RavenSession.objects.count(), 1)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cache')
+    def test_invalidate_cache(self):
+        client = self.login()
+        self.assertLoggedIn(client)
+        self.assertEqual(sessions.invalidate_sessions(self.user), 1)
+        self.assertLoggedIn(client, False)
+
+    def test_prune_live_session(self):
+        client = self.login()
+        # SESSION_SAVE_EVERY_REQUEST or set_expiry moved the expiry of the session past the one recorded at the login
+        RavenSession.objects.update(expire_date=timezone.now() - timedelta(days=1))
+        self.assertEqual(sessions.prune_expired(), 0)
+        self.assertEqual(RavenSession.objects.count(), 1)
+        SessionStore().delete(client.session.session_key)
+        self.assertEqual(sessions.prune_expired(), 1)
+        self.assertFalse(RavenSession.objects.exists())
+
+    def test_rotation(self):
+        client = self.login()
+        request = RequestFactory().get('/')
+        request.session = client.session
+        request.user = self.user
+        middleware = SessionIndexMiddleware()
+        middleware.process_request(request)
+        update_session_auth_hash(request, self.user)
+        middleware.process_response(request, None)
+        self.assertNotEqual(request.session.session_key, client.session.session_key)
+        self.assertEqual(list(RavenSession.objects.values_list('session_key', flat=True)),
+                         [request.session.session_key])
+        self.assertEqual(sessions.invalidate_sessions(self.user), 1)
+        self.assertFalse(SessionStore().exists(request.session.session_key))
+
+    def test_principal_user(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        sessions.record_login(None, request, RavenUser(RAVEN_TEST_USER))
+        self.assertFalse(RavenSession.objects.exists())
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookies(self):
+        self.login()
+        self.assertFalse(RavenSession.objects.exists())
+        with self.assertRaises(ImproperlyConfigured):
+            sessions.invalidate_sessions(self.user)
+        with self.assertRaises(CommandError):
+            call_command('invalidate_raven_sessions', RAVEN_TEST_USER, stdout=StringIO())
+
+    def test_command(self):
+        client = self.login()
+        RavenSession.objects.create(user=User.objects.create(username=RAVEN_NEW_USER), session_key='expired',
+                                    expire_date=timezone.now() - timedelta(days=1))
+        out = StringIO()
+        call_command('invalidate_raven_sessions', RAVEN_TEST_USER, '--prune', stdout=out)
+        self.assertEqual(out.getvalue(), "test0001: 1 sessions ended\n1 expired sessions removed from the index\n")
+        self.assertLoggedIn(client, False)
+        with self.assertRaises(CommandError):
+            call_command('invalidate_raven_sessions', 'unknown', stdout=out)
+
+
+directory_calls = []
+
+
+def directory_provider(principal):
+    directory_calls.append(principal)
+    return {'displayName': 'Test User %s' % principal, 'instID': 'UIS'}
+
+
+def groups_provider(principal):
+    return {'groups': ['101888'], 'instID': 'CL'}
+
+
+hung_provider_release = threading.Event()
+
+
+def hung_provider(principal):
+    # Answers after the timeout of the login, when the test releases it
+    hung_provider_release.wait()
+    return {'hung': True}
+
+
+def failing_provider(principal):
+    raise IOError("directory unavailable")
+
+
+@override_settings(UCAMWEBAUTH_ATTRIBUTE_PROVIDERS=['ucamwebauth.tests.directory_provider',
+                                                    'ucamwebauth.tests.groups_provider'],
+                   UCAMWEBAUTH_ATTRIBUTE_TIMEOUT=0.2)
+class AttributesTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        attributes._cache().clear()
+        del directory_calls[:]
+        hung_provider_release.clear()
+        self.addCleanup(hung_provider_release.set)
+        self.handler = ListHandler()
+        attributes.logger.addHandler(self.handler)
+        self.addCleanup(attributes.logger.removeHandler, self.handler)
+
+    def wait_for_refresh(self):
+        for _ in range(100):
+            if not attributes._refreshing:
+                break
+            time.sleep(0.01)
+
+    def test_login(self):
+        user = RavenAuthBackend().authenticate(raven_ticket={'principal': RAVEN_TEST_USER, 'ver': 3,
+                                                             'ptags': ['current']})
+        self.assertEqual(UserProfile.objects.get(user=user).attributes,
+                         {'displayName': 'Test User test0001', 'instID': 'CL', 'groups': ['101888']})
+
+    @override_settings(UCAMWEBAUTH_ATTRIBUTE_PROVIDERS=['ucamwebauth.tests.failing_provider',
+                                                        'ucamwebauth.tests.directory_provider'])
+    def test_login_incomplete(self):
+        user = User.objects.get(username=RAVEN_TEST_USER)
+        UserProfile.objects.create(user=user, attributes={'displayName': 'Kept'})
+        backend = RavenAuthBackend()
+        for _ in range(2):
+            # On a cold cache, then from the incomplete cache entry
+            backend.authenticate(raven_ticket={'principal': RAVEN_TEST_USER, 'ver': 3, 'ptags': ['current']})
+            self.assertEqual(UserProfile.objects.get(user=user).attributes, {'displayName': 'Kept'})
+        self.assertEqual(attributes.lookup(RAVEN_TEST_USER),
+                         ({'displayName': 'Test User test0001', 'instID': 'UIS'}, False))
+        self.wait_for_refresh()
+
+    def test_cache(self):
+        attributes.get_attributes(RAVEN_TEST_USER)
+        self.assertEqual(attributes.get_attributes(RAVEN_TEST_USER)['instID'], 'CL')
+        self.assertEqual(directory_calls, [RAVEN_TEST_USER])
+
+    @override_settings(UCAMWEBAUTH_ATTRIBUTE_PROVIDERS=['ucamwebauth.tests.hung_provider',
+                                                        'ucamwebauth.tests.failing_provider',
+                                                        'ucamwebauth.tests.directory_provider'])
+    def test_timeout(self):
+        result = attributes.get_attributes(RAVEN_TEST_USER)
+        self.assertEqual([record.levelname for record in self.handler.records], ['WARNING', 'ERROR'])
+        self.assertEqual(result, {'displayName': 'Test User test0001', 'instID': 'UIS'})
+        # Incomplete results are retried at the next login
+        entry = attributes._cache().get(attributes.CACHE_PREFIX + RAVEN_TEST_USER)
+        self.assertLess(entry['fetched'], time.time() - 3000)
+
+    @override_settings(UCAMWEBAUTH_ATTRIBUTE_PROVIDERS=['ucamwebauth.tests.hung_provider',
+                                                        'ucamwebauth.tests.directory_provider'],
+                       UCAMWEBAUTH_ATTRIBUTE_MAX_IN_FLIGHT=1, UCAMWEBAUTH_ATTRIBUTE_TIMEOUT=0.05)
+    def test_in_flight(self):
+        attributes.fetch(RAVEN_TEST_USER)
+        # The hung call still holds its worker, so the provider is not called again
+        self.assertEqual(attributes.fetch(RAVEN_NEW_USER), ({'displayName': 'Test User test0002', 'instID': 'UIS'},
+                                                            False))
+        self.assertIn("too many calls", self.handler.records[-1].getMessage())
+        self.assertEqual(attributes._in_flight[hung_provider], 1)
+        hung_provider_release.set()
+        for _ in range(100):
+            if not attributes._in_flight[hung_provider]:
+                break
+            time.sleep(0.01)
+        self.assertEqual(attributes.fetch(RAVEN_TEST_USER)[1], True)
+
+    def test_stale_while_revalidate(self):
+        attributes._cache().set(attributes.CACHE_PREFIX + RAVEN_TEST_USER,
+                                {'attributes': {'displayName': 'Old'}, 'fetched': time.time() - 7200})
+        self.assertEqual(attributes.get_attributes(RAVEN_TEST_USER), {'displayName': 'Old'})
+        self.wait_for_refresh()
+        self.assertEqual(attributes.get_attributes(RAVEN_TEST_USER)['displayName'], 'Test User test0001')
+
+    @override_settings(UCAMWEBAUTH_ATTRIBUTE_PROVIDERS=['ucamwebauth.tests.hung_provider',
+                                                        'ucamwebauth.tests.directory_provider'],
+                       UCAMWEBAUTH_ATTRIBUTE_TIMEOUT=0.05)
+    def test_incomplete_refresh(self):
+        stale = {'attributes': {'displayName': 'Old', 'hung': True}, 'fetched': time.time() - 7200}
+        attributes._cache().set(attributes.CACHE_PREFIX + RAVEN_TEST_USER, stale)
+        self.assertEqual(attributes.get_attributes(RAVEN_TEST_USER), stale['attributes'])
+        self.wait_for_refresh()
+        # The refresh timed out, so the stale attributes are kept rather than replaced by partial ones
+        self.assertEqual(attributes._cache().get(attributes.CACHE_PREFIX + RAVEN_TEST_USER), stale)
+        self.assertIn("stale ones are kept", self.handler.records[-1].getMessage())
+
+    def test_hung_provider_at_exit(self):
+        """A provider that never returns does not keep the process from exiting"""
+        code = ("import threading\n"
+                "from django.conf import settings\n"
+                "settings.configure(UCAMWEBAUTH_ATTRIBUTE_TIMEOUT=0.05)\n"
+                "from ucamwebauth import attributes\n"
+                "print(attributes.fetch('test0001', [lambda principal: threading.Event().wait()]))\n")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(ucamwebauth.__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root, timeout=60,
+                                         env=dict(os.environ, PYTHONPATH=root, DJANGO_SETTINGS_MODULE=''))
+        self.assertEqual(output.strip(), b'({}, False)')
+
+
+class ExportTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        forlife = User.objects.create(username=RAVEN_FORLIVE_USER, last_login=datetime(2018, 1, 1, tzinfo=timezone.utc))
+        UserProfile.objects.create(user=forlife, raven_for_life=True)
+        self.staff = User.objects.create(username=RAVEN_NEW_USER, is_staff=True)
+
+    def export(self, *args):
+        out = StringIO()
+        call_command('export_raven_users', *args, stdout=out)
+        return out.getvalue()
+
+    def test_csv(self):
+        with self.assertNumQueries(1):
+            output = self.export('--chunk-size', '1')
+        self.assertEqual(output.splitlines(), [
+            'username,raven_for_life,last_login',
+            'test0001,False,2012-09-10T21:52:17.387000+00:00',
+            'test0500,True,2018-01-01T00:00:00+00:00',
+            'test0002,False,',
+        ])
+
+    def test_filters(self):
+        lines = self.export('--format', 'jsonl', '--raven-for-life').splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'username': 'test0500', 'raven_for_life': True, 'last_login': '2018-01-01T00:00:00+00:00'}])
+        self.assertEqual(len(self.export('--not-raven-for-life').splitlines()), 3)
+        self.assertEqual(self.export('--last-login-after', '2012-01-01', '--last-login-before', '2013-01-01')
+                         .splitlines()[1:], ['test0001,False,2012-09-10T21:52:17.387000+00:00'])
+        with self.assertRaises(CommandError):
+            self.export('--last-login-after', 'yesterday')
+
+    def test_view(self):
+        client = Client()
+        with self.settings(UCAMWEBAUTH_EXPORT_VIEW=True):
+            self.assertEqual(client.get(reverse('raven_export')).status_code, 403)
+            client.force_login(self.staff)
+            response = client.get(reverse('raven_export'), {'format': 'jsonl', 'raven_for_life': 'false'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            lines = b''.join(response.streaming_content).decode().splitlines()
+            self.assertEqual([json.loads(line)['username'] for line in lines], ['test0001', 'test0002'])
+            self.assertEqual(client.get(reverse('raven_export'), {'last_login_after': 'x'}).status_code, 400)
+        self.assertEqual(client.get(reverse('raven_export')).status_code, 404)
+
+
+@override_settings(UCAMWEBAUTH_READ_DATABASE='replica')
+class ReadReplicaTestCase(TestCase):
+    multi_db = True  # Django < 2.2
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        replica._cache().clear()
+
+    def create_user(self, *databases):
+        for database in databases:
+            user = User.objects.db_manager(database).create(pk=1, username=RAVEN_TEST_USER)
+            UserProfile.objects.using(database).create(pk=1, user=user, raven_for_life=False)
+        # As if the replica had caught up long ago
+        replica._cache().clear()
+
+    def authenticate(self, ptags=('current', )):
+        return RavenAuthBackend().authenticate(raven_ticket={'principal': RAVEN_TEST_USER, 'ver': 3, 'ptags': ptags})
+
+    def test_read_from_replica(self):
+        self.create_user('default', 'replica')
+        with self.assertNumQueries(0), self.assertNumQueries(2, using='replica'):
+            user = self.authenticate()
+        self.assertEqual(user.pk, 1)
+        self.assertEqual(user._state.db, 'default')
+
+    def test_create_on_primary(self):
+        user = self.authenticate()
+        self.assertEqual(user._state.db, 'default')
+        self.assertTrue(UserProfile.objects.filter(user=user).exists())
+        self.assertFalse(User.objects.using('replica').exists())
+
+    def test_profile_change_on_primary(self):
+        self.create_user('default', 'replica')
+        with self.settings(UCAMWEBAUTH_NOT_CURRENT=True):
+            self.authenticate(ptags=[])
+        self.assertTrue(UserProfile.objects.get(pk=1).raven_for_life)
+        self.assertFalse(UserProfile.objects.using('replica').get(pk=1).raven_for_life)
+
+    def test_get_user(self):
+        self.create_user('replica')
+        with self.assertNumQueries(0):
+            user = RavenAuthBackend().get_user(1)
+        self.assertEqual(user._state.db, 'default')
+        # Not replicated yet
+        self.assertIsNone(RavenAuthBackend().get_user(2))
+        User.objects.create(pk=2, username=RAVEN_NEW_USER)
+        self.assertEqual(RavenAuthBackend().get_user(2).username, RAVEN_NEW_USER)
+
+    def test_read_after_write(self):
+        self.create_user('default', 'replica')
+        user = User.objects.get(pk=1)
+        user.first_name = 'Primary'
+        user.save(update_fields=['first_name'])
+        # The replica has not caught up with the save yet
+        self.assertTrue(replica.is_pinned(1))
+        with self.assertNumQueries(0, using='replica'):
+            self.assertEqual(RavenAuthBackend().get_user(1).first_name, 'Primary')
+        # The user is looked up by username on the replica, then read again from the primary
+        with self.assertNumQueries(1, using='replica'):
+            self.assertEqual(self.authenticate().first_name, 'Primary')
+        with self.settings(UCAMWEBAUTH_READ_PIN_SECONDS=0):
+            user.save(update_fields=['first_name'])
+        self.assertFalse(replica.is_pinned(1))
+        self.assertEqual(RavenAuthBackend().get_user(1).first_name, '')
+
+    def test_profile_write(self):
+        self.create_user('default', 'replica')
+        profile = UserProfile.objects.get(pk=1)
+        profile.save()
+        self.assertTrue(replica.is_pinned(1))
+
+
+class AdminTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        for username in ('test0001', 'test0002', 'test0003'):
+            UserProfile.objects.create(user=User.objects.get_or_create(username=username)[0])
+        self.request = RequestFactory().post('/')
+        self.request.session = SessionStore()
+        self.request._messages = FallbackStorage(self.request)
+
+    def test_capped_count(self):
+        with self.settings(UCAMWEBAUTH_ADMIN_COUNT_LIMIT=2):
+            paginator = CappedCountPaginator(UserProfile.objects.order_by('pk'), 1)
+            with self.assertNumQueries(1):
+                self.assertEqual(paginator.count, 2)
+            self.assertEqual(list(paginator.page_range), [1, 2])
+        self.assertEqual(CappedCountPaginator(UserProfile.objects.order_by('pk'), 1).count, 3)
+
+    def test_past_the_cap(self):
+        profiles = list(UserProfile.objects.order_by('pk'))
+        with self.settings(UCAMWEBAUTH_ADMIN_COUNT_LIMIT=2):
+            paginator = CappedCountPaginator(UserProfile.objects.order_by('pk'), 1)
+            self.assertEqual(paginator.page(1).object_list, [profiles[0]])
+            self.assertEqual(list(paginator.page_range), [1, 2])
+            # Page 2 has a next page, which is then listed and can be read although it is past the count
+            self.assertTrue(paginator.page(2).has_next())
+            self.assertEqual(list(paginator.page_range), [1, 2, 3])
+            page = paginator.page(3)
+            self.assertEqual(page.object_list, [profiles[2]])
+            self.assertFalse(page.has_next())
+            with self.assertRaises(EmptyPage):
+                paginator.page(4)
+            with self.assertRaises(PageNotAnInteger):
+                paginator.page('last')
+
+    def test_actions(self):
+        model_admin = UserProfileAdmin(UserProfile, AdminSite())
+        with self.assertNumQueries(1):
+            set_raven_for_life(model_admin, self.request, UserProfile.objects.exclude(user__username='test0002'))
+        self.assertEqual(UserProfile.objects.filter(raven_for_life=True).count(), 2)
+        with self.assertNumQueries(1):
+            clear_raven_for_life(model_admin, self.request, UserProfile.objects.all())
+        self.assertFalse(UserProfile.objects.filter(raven_for_life=True).exists())
+        self.assertEqual([str(message) for message in get_messages(self.request)],
+                         ["2 profiles marked as raven for life", "3 profiles marked as not raven for life"])
+
+    def test_user_admin(self):
+        user_admin = RavenUserAdmin(User, AdminSite())
+        users = User.objects.select_related(*user_admin.list_select_related).order_by('pk')
+        with self.assertNumQueries(1):
+            self.assertEqual([user_admin.raven_for_life(user) for user in users], [False, False, False])
+
+
+class DirectoryKeyStoreTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, kid, pem):
+        # Like a key rotation: a new file (hence inode) replaces the old one
+        path = os.path.join(self.directory, 'pubkey%d.crt' % kid)
+        with open(path + '.new', 'w') as cert_file:
+            cert_file.write(pem)
+        os.rename(path + '.new', path)
+
+    def test_reload(self):
+        keys = DirectoryKeyStore(self.directory, check_interval=0)
+        self.assertIsNone(keys.get(901))
+        self.write(901, settings.UCAMWEBAUTH_CERTS[901])
+        cert = keys.get(901)
+        self.assertIsNotNone(cert)
+        self.assertIs(keys.get(901), cert)
+        self.write(901, settings.UCAMWEBAUTH_CERTS[901])
+        reloaded = keys.get(901)
+        self.assertIsNotNone(reloaded)
+        self.assertIsNot(reloaded, cert)
+        # A broken file does not replace a good certificate
+        self.write(901, "not a certificate")
+        self.assertIs(keys.get(901), reloaded)
+
+    def test_check_interval(self):
+        keys = DirectoryKeyStore(self.directory, check_interval=3600)
+        self.write(901, settings.UCAMWEBAUTH_CERTS[901])
+        cert = keys.get(901)
+        os.unlink(os.path.join(self.directory, 'pubkey901.crt'))
+        self.assertIs(keys.get(901), cert)
+        self.assertIsNone(keys.get(902))
+        self.write(902, settings.UCAMWEBAUTH_CERTS[901])
+        self.assertIsNone(keys.get(902))
+
+    def test_setting(self):
+        self.write(901, settings.UCAMWEBAUTH_CERTS[901])
+        with self.settings(UCAMWEBAUTH_CERTS_DIR=self.directory, UCAMWEBAUTH_CERTS={}):
+            response = RavenResponse(RequestFactory().get(reverse('raven_return'),
+                                                          {'WLS-Response': create_wls_response()}))
+            self.assertEqual(response.principal, RAVEN_TEST_USER)
+            self.assertIsInstance(ucamwebauth.get_key_store(), DirectoryKeyStore)
+        self.assertIsInstance(ucamwebauth.get_key_store(), StaticKeyStore)
+
+
+class AdmissionTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.addCleanup(setattr, admission, 'controller', admission.controller)
+        self.controller = admission.controller = admission.AdmissionController()
+        admission._cache().delete(admission.CACHE_KEY)
+
+    def raven_return(self):
+        return self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+
+    @override_settings(UCAMWEBAUTH_MAX_CONCURRENT_LOGINS=1, UCAMWEBAUTH_RETRY_AFTER=7)
+    def test_shed(self):
+        self.assertEqual(self.raven_return().status_code, 302)
+        ticket = self.controller.acquire()
+        with self.assertRaises(TooManyLoginsError) as cm:
+            self.raven_return()
+        self.controller.release(ticket)
+        self.assertEqual(self.controller.stats(), {'in_flight': 0, 'peak': 1, 'admitted': 2, 'shed': 1})
+
+        request = RequestFactory().get(reverse('raven_return'))
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+        with self.settings(UCAMWEBAUTH_ERROR_MESSAGES_FOR_ANONYMOUS=True):
+            response = DefaultErrorBehaviour().process_exception(request, cm.exception)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertIn(b"try again in 7 seconds", response.content)
+        # Shedding does not write to the session
+        self.assertEqual(list(get_messages(request)), [])
+        self.assertFalse(request.session.modified)
+
+    @override_settings(UCAMWEBAUTH_CLUSTER_MAX_CONCURRENT_LOGINS=2)
+    def test_cluster(self):
+        cache = admission._cache()
+        ticket = self.controller.acquire()
+        self.assertEqual(cache.get(admission.CACHE_KEY), 1)
+        # Another process is authenticating a user
+        cache.incr(admission.CACHE_KEY)
+        with self.assertRaises(TooManyLoginsError):
+            self.controller.acquire()
+        self.assertEqual(cache.get(admission.CACHE_KEY), 2)
+        self.controller.release(ticket)
+        self.assertEqual(self.controller.stats(), {'in_flight': 0, 'peak': 2, 'admitted': 1, 'shed': 1,
+                                                   'cluster_in_flight': 1})
+        self.assertEqual(self.raven_return().status_code, 302)
+        self.assertEqual(cache.get(admission.CACHE_KEY), 1)
+
+
+@override_settings(AUTHENTICATION_BACKENDS=['ucamwebauth.backends.RavenPrincipalBackend'],
+                   SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies', UCAMWEBAUTH_SESSION_INDEX=True)
+class PrincipalUserTestCase(TestCase):
+
+    def get_user(self, session):
+        request = RequestFactory().get('/')
+        request.session = session
+        middleware = RavenPrincipalMiddleware()
+        middleware.process_request(request)
+        try:
+            return get_user(request)
+        finally:
+            middleware.process_response(request, None)
+
+    def test_user(self):
+        user = RavenUser(RAVEN_TEST_USER, ['current'])
+        self.assertFalse(hasattr(user, '__dict__'))
+        self.assertEqual(user.pk, RavenUser(RAVEN_TEST_USER).pk)
+        self.assertNotEqual(user.pk, RavenUser(RAVEN_NEW_USER).pk)
+        self.assertFalse(user.raven_for_life)
+        self.assertTrue(RavenUser(RAVEN_FORLIVE_USER).raven_for_life)
+        session = {principals.SESSION_KEY: {'principal': RAVEN_TEST_USER, 'ptags': ['current']}}
+        principals.bind_session(session)
+        self.addCleanup(principals.bind_session, None)
+        self.assertEqual(principals.get_user(user._meta.pk.value_to_string(user)), user)
+        self.assertIsNone(principals.get_user(RavenUser(RAVEN_NEW_USER).pk))
+        self.assertIsNone(principals.get_user('12345x'))
+        principals.bind_session(None)
+        with self.assertRaises(ImproperlyConfigured):
+            principals.get_user(user.pk)
+
+    def test_long_identity(self):
+        # An integer encoding of the whole identity would have thousands of digits
+        user = RavenUser('x' * 5000, ['current'] * 1000)
+        self.assertLess(user.pk, 2 ** 60)
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        login(request, user, backend='ucamwebauth.backends.RavenPrincipalBackend')
+        self.assertEqual(self.get_user(request.session), user)
+
+    def test_login(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+            self.assertEqual(response.status_code, 302)
+            user = self.get_user(self.client.session)
+        self.assertIsInstance(user, RavenUser)
+        self.assertEqual(user.username, RAVEN_TEST_USER)
+        self.assertEqual(user.ptags, ['current'])
+        self.assertFalse(User.objects.exists())
+
+        # Logging in again (here as someone else) in the same session
+        response = self.client.get(reverse('raven_return'),
+                                   {'WLS-Response': create_wls_response(raven_principal=RAVEN_NEW_USER)})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.get_user(self.client.session).username, RAVEN_NEW_USER)
+
+    def test_not_current(self):
+        with self.assertRaises(UserNotAuthorised):
+            self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_ptags='')})
+
+    def test_middleware(self):
+        middleware = list(settings.MIDDLEWARE)
+        middleware.insert(middleware.index('django.contrib.auth.middleware.AuthenticationMiddleware'),
+                          'ucamwebauth.middleware.RavenPrincipalMiddleware')
+        with self.settings(MIDDLEWARE=middleware, UCAMWEBAUTH_TOKEN_KEY='secret'):
+            self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+            response = self.client.get(reverse('raven_token'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response.wsgi_request.user, RavenUser)
+        self.assertEqual(response.wsgi_request.user.username, RAVEN_TEST_USER)
+        # Without the middleware (the client loads the middleware once)
+        client = Client()
+        client.cookies = self.client.cookies
+        with self.settings(UCAMWEBAUTH_TOKEN_KEY='secret'):
+            with self.assertRaises(ImproperlyConfigured):
+                client.get(reverse('raven_token'))
+
+
+class ProfilingTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def profiles(self):
+        return sorted(filename.split('-')[0] for filename in os.listdir(self.directory))
+
+    def test_disabled(self):
+        self.client.get(reverse('raven_login'))
+        self.assertEqual(self.profiles(), [])
+
+    def test_sample(self):
+        with self.settings(UCAMWEBAUTH_PROFILE_DIR=self.directory, UCAMWEBAUTH_PROFILE_SAMPLE_RATE=1):
+            self.client.get(reverse('raven_login'))
+            self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        # authenticate ran inside the profile of raven_return
+        self.assertEqual(self.profiles(), ['raven_login', 'raven_return'])
+        stats = pstats.Stats(os.path.join(self.directory, [name for name in os.listdir(self.directory)
+                                                           if name.startswith('raven_return')][0]))
+        self.assertTrue(any(function[2] == '_authenticate' for function in stats.stats))
+
+    def test_rotation(self):
+        with self.settings(UCAMWEBAUTH_PROFILE_DIR=self.directory, UCAMWEBAUTH_PROFILE_SAMPLE_RATE=1,
+                           UCAMWEBAUTH_PROFILE_MAX_FILES=2):
+            for _ in range(4):
+                self.client.get(reverse('raven_login'))
+        self.assertEqual(self.profiles(), ['raven_login', 'raven_login'])
+
+    def test_slow(self):
+        with self.settings(UCAMWEBAUTH_PROFILE_DIR=self.directory, UCAMWEBAUTH_PROFILE_SAMPLE_RATE=1,
+                           UCAMWEBAUTH_PROFILE_SLOW_THRESHOLD=60):
+            self.client.get(reverse('raven_login'))
+            self.assertEqual(self.profiles(), [])
+            with self.settings(UCAMWEBAUTH_PROFILE_SLOW_THRESHOLD=0):
+                self.client.get(reverse('raven_login'))
+            # The slow call itself is kept
+            self.assertEqual(self.profiles(), ['raven_login'])
+
+
+class LoginURLTestCase(TestCase):
+
+    def login_url(self, next_url=None, **extra):
+        request = RequestFactory().get('/', **extra)
+        return get_login_url(request, next_url)
+
+    def test_same_as_build_login_url(self):
+        with self.settings(UCAMWEBAUTH_DESC='A site', UCAMWEBAUTH_MSG='Please log in', UCAMWEBAUTH_FAIL='yes'):
+            for next_url in (None, '/', '/a page?x=1&y=2', '/a page?x=1&y=2'):
+                self.assertEqual(self.login_url(next_url), build_login_url(
+                    settings.UCAMWEBAUTH_LOGIN_URL, 'http://testserver/raven_return/', 'A site', '', 'Please log in',
+                    'yes', None if next_url is None else [('next', next_url)]))
+        # The cached URL is rebuilt when the settings change
+        self.assertIn('&desc=&', self.login_url('/x'))
+
+    def test_per_host(self):
+        with self.settings(ALLOWED_HOSTS=['example.com', 'testserver']):
+            self.assertIn('url=https%3A%2F%2Fexample.com%2Fraven_return%2F',
+                          self.login_url(HTTP_HOST='example.com', secure=True))
+            self.assertIn('url=http%3A%2F%2Ftestserver%2Fraven_return%2F', self.login_url())
+
+    def test_lru(self):
+        with self.settings(UCAMWEBAUTH_LOGIN_URL_CACHE_SIZE=2):
+            for next_url in ('/1', '/2', '/1', '/3'):
+                self.login_url(next_url)
+            self.assertEqual(list(loginurl._params), ['/1', '/3'])
+
+    def test_hosts_lru(self):
+        with self.settings(ALLOWED_HOSTS=['*'], UCAMWEBAUTH_LOGIN_URL_CACHE_SIZE=2):
+            for host in ('a.example.com', 'b.example.com', 'a.example.com', 'c.example.com'):
+                self.login_url(HTTP_HOST=host)
+            self.assertEqual([key[1] for key in loginurl._parts], ['a.example.com', 'c.example.com'])
+
+    def test_template_tag(self):
+        request = RequestFactory().get('/page/?a=b')
+        rendered = Template('{% load raven %}{% raven_login_url %}|{% raven_login_url "/other/" %}').render(
+            Context({'request': request}))
+        here, other = rendered.split('|')
+        self.assertEqual(here, escape(get_login_url(request, '/page/?a=b')))
+        self.assertEqual(other, escape(get_login_url(request, '/other/')))
+
+    def test_template_tag_without_request(self):
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Template('{% load raven %}{% raven_login_url %}').render(Context({}))
+        self.assertIn('context_processors.request', str(cm.exception))
+
+
+class ConcurrencyTestCase(SimpleTestCase):
+
+    def test_parse_time_matches_strptime(self):
+        def strptime(time_string):
+            return calendar.timegm(time.strptime(time_string, "%Y%m%dT%H%M%SZ"))
+
+        rng = random.Random(1234)
+        times = ['20110729T123456Z', '20000229T000000Z', '21000229T000000Z', '20161231T235960Z', '20110729T240000Z',
+                 '20111301T000000Z', '20110700T000000Z']
+        times += ['%08dT%06dZ' % (rng.randint(10000000, 99999999), rng.randint(0, 999999)) for _ in range(2000)]
+        for time_string in times:
+            try:
+                expected = strptime(time_string)
+            except ValueError:
+                self.assertRaises(ValueError, parse_time, time_string)
+            else:
+                self.assertEqual(parse_time(time_string), expected, time_string)
+        # The fields of a Raven time have a fixed width
+        for time_string in ('2011729T123456Z', '20110729T12345Z', '20110729 123456Z', '20110729T123456', '',
+                            '2011-07-29T12:34:56Z', '+0110729T123456Z'):
+            self.assertRaises(ValueError, parse_time, time_string)
+
+    def test_setting_cache(self):
+        self.assertIsNone(setting('UCAMWEBAUTH_TEST_SETTING'))
+        self.assertEqual(setting('UCAMWEBAUTH_TEST_SETTING', 'default'), 'default')
+        with self.settings(UCAMWEBAUTH_TEST_SETTING='value'):
+            self.assertEqual(setting('UCAMWEBAUTH_TEST_SETTING', 'default'), 'value')
+        self.assertEqual(setting('UCAMWEBAUTH_TEST_SETTING', 'default'), 'default')
+
+    def test_setting_assignment(self):
+        self.addCleanup(clear_settings)
+        with self.settings():
+            # Other settings are not cached
+            settings.TEST_SETTING = 'value'
+            self.assertEqual(setting('TEST_SETTING'), 'value')
+            settings.TEST_SETTING = 'new value'
+            self.assertEqual(setting('TEST_SETTING'), 'new value')
+            # UCAMWEBAUTH_* settings assigned directly are only seen once the cache is cleared
+            self.assertIsNone(setting('UCAMWEBAUTH_TEST_SETTING'))
+            settings.UCAMWEBAUTH_TEST_SETTING = 'value'
+            self.assertIsNone(setting('UCAMWEBAUTH_TEST_SETTING'))
+            clear_settings()
+            self.assertEqual(setting('UCAMWEBAUTH_TEST_SETTING'), 'value')
+
+    def test_key_store_without_certs(self):
+        self.addCleanup(clear_settings)
+        with self.settings():
+            del settings.UCAMWEBAUTH_CERTS
+            clear_settings()
+            self.assertIs(ucamwebauth.get_key_store(), ucamwebauth.get_key_store())
+
+    def test_threads(self):
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response(
+            raven_issue=datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))})
+        principals = []
+        errors = []
+
+        def check():
+            try:
+                for _ in range(50):
+                    principals.append(RavenResponse(request).principal)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=check) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(principals, [RAVEN_TEST_USER] * 200)
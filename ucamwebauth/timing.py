@@ -0,0 +1,34 @@
+"""Server-Timing (https://www.w3.org/TR/server-timing/) breakdown of the cost of a Raven login.
+
+When UCAMWEBAUTH_SERVER_TIMING is True, raven_return attaches a ServerTiming to the request as
+request.ucamwebauth_timing and every step of the login marks the time it took. Otherwise the attribute is None and the
+steps only pay for an attribute check.
+"""
+try:
+    from time import perf_counter_ns
+except ImportError:
+    # python < 3.7
+    from time import perf_counter
+
+    def perf_counter_ns():
+        return int(perf_counter() * 1e9)
+
+
+class ServerTiming(object):
+    """Records the duration of consecutive steps"""
+
+    __slots__ = ('entries', 'last')
+
+    def __init__(self):
+        self.entries = []
+        self.last = perf_counter_ns()
+
+    def mark(self, name):
+        """Ends the step called name, which started when the previous one ended"""
+        now = perf_counter_ns()
+        self.entries.append((name, now - self.last))
+        self.last = now
+
+    def header(self):
+        """Returns the value of the Server-Timing header, with durations in milliseconds"""
+        return ', '.join('%s;dur=%.3f' % (name, duration / 1e6) for name, duration in self.entries)
@@ -0,0 +1,91 @@
+"""Compact HMAC-signed identity tokens.
+
+Once a user has been authenticated by Raven, services that share a secret key with the Django site can be given a
+token carrying the principal, the ptags and the issue time of the WLS response instead of the WLS-Response itself.
+Checking the token costs an HMAC-SHA256 instead of an RSA signature verification.
+
+A token is the base64url encoding (without padding) of a compact JSON payload, a '.' and the base64url encoding of the
+HMAC-SHA256 of the encoded payload. This module does not depend on Django, so it can be used by downstream services.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+from ucamwebauth.exceptions import InvalidTokenError
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class TokenSigner(object):
+    """Issues and verifies identity tokens signed with a shared secret key"""
+
+    def __init__(self, key, ttl=300):
+        """@param key  The shared secret key (str or bytes)
+        @param ttl  The lifetime in seconds of the tokens issued"""
+        if not key:
+            raise ValueError("A key is required to sign tokens")
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        self.key = key
+        self.ttl = ttl
+
+    def _signature(self, payload):
+        return _b64encode(hmac.new(self.key, payload, hashlib.sha256).digest())
+
+    def sign(self, principal, ptags=(), issue=None, ttl=None):
+        """Returns a token for principal.
+        @param principal  The authenticated identity
+        @param ptags  The ptags of the WLS response
+        @param issue  The issue time of the WLS response (seconds since the epoch), defaults to now
+        @param ttl  The lifetime of the token in seconds, defaults to the ttl of the signer"""
+        now = int(time.time())
+        payload = _b64encode(json.dumps({
+            'p': principal,
+            't': list(ptags or ()),
+            'i': now if issue is None else int(issue),
+            'e': now + (self.ttl if ttl is None else ttl),
+        }, separators=(',', ':')).encode('utf-8'))
+        return (payload + b'.' + self._signature(payload)).decode('ascii')
+
+    def verify(self, token):
+        """Checks the signature and expiry of token.
+        @return dict with the principal, ptags, issue and expires of the token
+        @exception InvalidTokenError if the token is not valid"""
+        if not isinstance(token, bytes):
+            try:
+                token = token.encode('ascii')
+            except (AttributeError, UnicodeError):
+                raise InvalidTokenError("Token is not an ASCII string")
+        payload, _, signature = token.rpartition(b'.')
+        if not payload or not hmac.compare_digest(signature, self._signature(payload)):
+            raise InvalidTokenError("The signature of the token is not valid")
+        try:
+            data = json.loads(_b64decode(payload).decode('utf-8'))
+            identity = {'principal': data['p'], 'ptags': data['t'], 'issue': data['i'], 'expires': data['e']}
+        except Exception:
+            raise InvalidTokenError("Token payload is malformed")
+        if identity['expires'] < time.time():
+            raise InvalidTokenError("Token has expired")
+        return identity
+
+
+def verify_token(token, key):
+    """Checks a token signed with key and returns the identity it carries (see TokenSigner.verify)"""
+    return TokenSigner(key).verify(token)
+
+
+def get_signer():
+    """Returns a TokenSigner configured with UCAMWEBAUTH_TOKEN_KEY and UCAMWEBAUTH_TOKEN_TTL, or None if tokens are not
+    enabled"""
+    from ucamwebauth.utils import setting
+    key = setting('UCAMWEBAUTH_TOKEN_KEY')
+    if not key:
+        return None
+    return TokenSigner(key, ttl=setting('UCAMWEBAUTH_TOKEN_TTL', default=300))
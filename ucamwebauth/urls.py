@@ -1,8 +1,10 @@
 from django.conf.urls import url
-from ucamwebauth.views import raven_login, raven_logout, raven_return
+from ucamwebauth.views import raven_login, raven_logout, raven_return, raven_token, raven_export
 
 urlpatterns = [
     url(r'^accounts/login/$', raven_login, name='raven_login'),
     url(r'^accounts/logout/$', raven_logout, name='raven_logout'),
     url(r'^raven_return/$', raven_return, name='raven_return'),
+    url(r'^raven_token/$', raven_token, name='raven_token'),
+    url(r'^raven_export/$', raven_export, name='raven_export'),
 ]
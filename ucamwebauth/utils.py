@@ -1,41 +1,52 @@
-import time
-import calendar
-from base64 import b64decode
 try:
     from urlparse import parse_qs
     from urllib import unquote
 except ImportError:
     from urllib.parse import parse_qs, unquote
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseRedirect
 try:
     from django.urls import reverse
 except ImportError:
     from django.core.urlresolvers import reverse
-from ucamwebauth.exceptions import MalformedResponseError
+# decode_sig and parse_time live in ucamwebauth.protocol, which does not depend on Django
+from ucamwebauth.protocol import decode_sig, parse_time  # noqa: F401
 
 
-def decode_sig(sig):
-    """Decodes a signature from the variant base64 used by raven.
-    @param sig  A string giving the signature in Raven's variant base-64
-    @return  A binary string containing the signature"""
-    sig = sig.replace("-", "+").replace(".", "/").replace("_", "=")
-    try:
-        return b64decode(sig)
-    except TypeError:
-        raise MalformedResponseError("Signature is not a valid base-64 encoded string")
+# Only the settings whose names start with this prefix are cached by setting()
+CACHED_PREFIX = 'UCAMWEBAUTH_'
+# name -> value of the setting, or _MISSING
+_settings = {}
+_MISSING = object()
 
 
-def setting(name, default=None):
-    """Returns a setting from the Django settings file"""
-    return getattr(settings, name, default)
+@receiver(setting_changed)
+def clear_setting(**kwargs):
+    _settings.pop(kwargs['setting'], None)
 
 
-def parse_time(time_string):
-    """Converts a time of the form '20110729T123456Z' to a number of seconds
-    since the epoch.
-    @exception ValueError if the time is not a valid Raven time"""
-    return calendar.timegm(time.strptime(time_string, "%Y%m%dT%H%M%SZ"))
+def clear_settings():
+    """Forgets every cached setting, e.g. after assigning settings.UCAMWEBAUTH_* directly"""
+    _settings.clear()
+
+
+def setting(name, default=None):
+    """Returns a setting from the Django settings file.
+
+    The values of the UCAMWEBAUTH_* settings are cached: most of them are not set, and looking them up on the settings
+    object raises and catches an AttributeError every time. The cache is only cleared by the setting_changed signal,
+    which override_settings sends but a direct assignment (settings.UCAMWEBAUTH_X = ...) does not: code that changes
+    these settings at run time must use override_settings or call clear_settings() afterwards. Other settings are read
+    from the settings object every time."""
+    if not name.startswith(CACHED_PREFIX):
+        return getattr(settings, name, default)
+    try:
+        value = _settings[name]
+    except KeyError:
+        value = _settings[name] = getattr(settings, name, _MISSING)
+    return default if value is _MISSING else value
 
 
 def get_next_from_wls_response(response_str):
@@ -63,3 +74,8 @@ class HttpResponseSeeOther(HttpResponseRedirect):
     """An HttpResponse with a 303 status code, since django doesn't provide one
     by default.  A 303 is required by the the WAA2WLS specification."""
     status_code = 303
+
+
+class HttpResponseServiceUnavailable(HttpResponse):
+    """An HttpResponse with a 503 status code, since django doesn't provide one"""
+    status_code = 503
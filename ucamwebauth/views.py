@@ -1,59 +1,149 @@
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest, JsonResponse, Http404, \
+    StreamingHttpResponse
 from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import redirect
 try:
-    from urllib import urlencode
+    from django.utils.http import url_has_allowed_host_and_scheme
 except ImportError:
-    from urllib.parse import urlencode
-from ucamwebauth import MalformedResponseError
-from ucamwebauth.utils import setting, HttpResponseSeeOther, get_next_from_wls_response, get_return_url
+    # django < 3.0
+    from django.utils.http import is_safe_url as url_has_allowed_host_and_scheme
+from ucamwebauth import MalformedResponseError, admission, export, sso
+from ucamwebauth.profiling import profiled
+from ucamwebauth.loginurl import get_login_url
+from ucamwebauth.timing import ServerTiming
+from ucamwebauth.tokens import get_signer
+from ucamwebauth.utils import setting, HttpResponseSeeOther, get_next_from_wls_response
 
 
+@profiled('raven_return')
 def raven_return(request):
     try:
         token = request.GET['WLS-Response']
     except KeyError:
         raise MalformedResponseError("no WLS-Response")
 
-    # See if this is a valid token
-    user = authenticate(request=request)
+    # Opt-in breakdown of the cost of the login in a Server-Timing header
+    timer = request.ucamwebauth_timing = ServerTiming() if setting('UCAMWEBAUTH_SERVER_TIMING') else None
+
+    # Shed the login if too many are in progress (see ucamwebauth.admission)
+    ticket = admission.controller.acquire()
+    try:
+        # See if this is a valid token
+        user = authenticate(request=request)
+
+        if user is None:
+            return redirect(setting('UCAMWEBAUTH_LOGOUT_REDIRECT', default='/'))
+        else:
+            login(request, user)
+            if timer is not None:
+                timer.mark('login')
+    finally:
+        admission.controller.release(ticket)
+
+    response = getattr(request, 'raven_response', None)
+    if response is not None:
+        _remember_identity(request, response.principal, response.ptags, response.issue)
 
-    if user is None:
-        return redirect(setting('UCAMWEBAUTH_LOGOUT_REDIRECT', default='/'))
-    else:
-        login(request, user)
-    
     # Redirect somewhere sensible
+    redirect_response = _redirect_after_login(get_next_from_wls_response(token))
+
+    if response is not None and sso.enabled():
+        # Let sibling sites log the user in without a round trip to the WLS
+        ticket_id, life = sso.create_ticket(response)
+        if ticket_id is not None:
+            sso.set_cookie(request, redirect_response, ticket_id, life)
+
+    if timer is not None:
+        redirect_response['Server-Timing'] = timer.header()
+
+    return redirect_response
 
-    redirect_url = get_next_from_wls_response(token)
 
+def _remember_identity(request, principal, ptags, issue):
+    """Keeps what raven_token needs to issue identity tokens for this session"""
+    if setting('UCAMWEBAUTH_TOKEN_KEY'):
+        request.session['ucamwebauth_identity'] = {'principal': principal, 'ptags': ptags or [], 'issue': issue}
+
+
+def _redirect_after_login(redirect_url):
     if redirect_url is not None and setting('UCAMWEBAUTH_REDIRECT_AFTER_LOGIN', default=None) is None:
         return HttpResponseRedirect(redirect_url)
     else:
         return HttpResponseRedirect(setting('UCAMWEBAUTH_REDIRECT_AFTER_LOGIN', default='/'))
 
 
+@profiled('raven_login')
 def raven_login(request):
-    # Get the Raven object and return a redirect to the Raven server
-    login_url = setting('UCAMWEBAUTH_LOGIN_URL')
-    return_url = get_return_url(request)
-    desc = setting('UCAMWEBAUTH_DESC', default='')
-    # aauth is ignored as v3 only supports 'pwd', therefore we do not need it.
-    iact = setting('UCAMWEBAUTH_IACT', default='')
-    msg = setting('UCAMWEBAUTH_MSG', default='')
-    fail = setting('UCAMWEBAUTH_FAIL', default='')
-    next_p = request.GET.get('next', None)
-    if next_p is not None:
-        params = urlencode([('next', next_p)])
-        msg = urlencode([('ver', 3), ('url', return_url), ('desc', desc), ('iact', iact), ('msg', msg),
-                         ('params', params), ('fail', fail)])
-    else:
-        msg = urlencode([('ver', 3), ('url', return_url), ('desc', desc), ('iact', iact), ('msg', msg),
-                         ('fail', fail)])
+    # A sibling site may already have authenticated the user with Raven. Interactive authentication can't be
+    # satisfied this way.
+    if sso.enabled() and setting('UCAMWEBAUTH_IACT', default='') != 'yes':
+        ticket = sso.get_ticket(request)
+        if ticket is not None:
+            # Provisioning the user costs as much as in raven_return, so these logins are admitted in the same way
+            admission_ticket = admission.controller.acquire()
+            try:
+                user = authenticate(request=request, raven_ticket=ticket)
+                if user is not None:
+                    login(request, user)
+            finally:
+                admission.controller.release(admission_ticket)
+            if user is not None:
+                _remember_identity(request, ticket['principal'], ticket['ptags'], ticket.get('issue'))
+                # Unlike the one in a WLS response, this next comes straight from the query string
+                next_url = request.GET.get('next', None)
+                if next_url is not None and not url_has_allowed_host_and_scheme(
+                        next_url, allowed_hosts={request.get_host()}, require_https=request.is_secure()):
+                    next_url = None
+                return _redirect_after_login(next_url)
 
-    return HttpResponseSeeOther("%s?%s" % (login_url, msg))
+    # Return a redirect to the Raven server
+    return HttpResponseSeeOther(get_login_url(request, request.GET.get('next', None)))
 
 
 def raven_logout(request):
     logout(request)
-    return redirect(setting('UCAMWEBAUTH_LOGOUT_REDIRECT', default='/'))
+    response = redirect(setting('UCAMWEBAUTH_LOGOUT_REDIRECT', default='/'))
+    if sso.enabled():
+        sso.delete_ticket(request)
+        sso.delete_cookie(response)
+    return response
+
+
+def raven_token(request):
+    """Returns a signed identity token (see ucamwebauth.tokens) for the user authenticated by Raven in this session"""
+    signer = get_signer()
+    if signer is None:
+        raise Http404("Identity tokens are not enabled")
+    identity = request.session.get('ucamwebauth_identity')
+    if identity is None or not request.user.is_authenticated or request.user.get_username() != identity['principal']:
+        return HttpResponseForbidden()
+    token = signer.sign(identity['principal'], identity['ptags'], identity['issue'])
+    response = JsonResponse({'token': token, 'expires_in': signer.ttl})
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def raven_export(request):
+    """Streams the users and their raven_for_life flag to staff users (see ucamwebauth.export), as CSV or JSON lines
+    depending on the format query parameter, filtered by the raven_for_life, last_login_after and last_login_before
+    query parameters"""
+    if not setting('UCAMWEBAUTH_EXPORT_VIEW', default=False):
+        raise Http404("The export of users is not enabled")
+    if not (request.user.is_active and request.user.is_staff):
+        return HttpResponseForbidden()
+    output_format = request.GET.get('format', 'csv')
+    if output_format not in export.FORMATS:
+        return HttpResponseBadRequest("Unknown format %s" % output_format)
+    filters = {}
+    if 'raven_for_life' in request.GET:
+        filters['raven_for_life'] = request.GET['raven_for_life'].lower() in ('1', 'true', 'yes')
+    try:
+        for name in ('last_login_after', 'last_login_before'):
+            if request.GET.get(name):
+                filters[name] = export.parse_when(request.GET[name])
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    response = StreamingHttpResponse(export.export(output_format, **filters),
+                                     content_type=export.CONTENT_TYPES[output_format])
+    response['Content-Disposition'] = 'attachment; filename="raven-users.%s"' % output_format
+    return response